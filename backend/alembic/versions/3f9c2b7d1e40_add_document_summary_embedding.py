@@ -0,0 +1,28 @@
+"""add_document_summary_embedding
+
+Revision ID: 3f9c2b7d1e40
+Revises: a6a8e192d594
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f9c2b7d1e40'
+down_revision: Union[str, None] = 'a6a8e192d594'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('documents', sa.Column('summary_embedding', sa.Text(), nullable=True))
+    op.add_column('documents', sa.Column('summary_embedding_model', sa.String(length=255), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('documents', 'summary_embedding_model')
+    op.drop_column('documents', 'summary_embedding')
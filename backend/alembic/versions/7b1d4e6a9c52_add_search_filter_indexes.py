@@ -0,0 +1,30 @@
+"""add_search_filter_indexes
+
+Revision ID: 7b1d4e6a9c52
+Revises: 3f9c2b7d1e40
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7b1d4e6a9c52'
+down_revision: Union[str, None] = '3f9c2b7d1e40'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_documents_user_id_file_type', 'documents', ['user_id', 'file_type'], unique=False)
+    op.create_index('ix_documents_user_id_created_at', 'documents', ['user_id', 'created_at'], unique=False)
+    op.create_index('ix_document_chunks_document_id_page_number', 'document_chunks', ['document_id', 'page_number'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_document_chunks_document_id_page_number', table_name='document_chunks')
+    op.drop_index('ix_documents_user_id_created_at', table_name='documents')
+    op.drop_index('ix_documents_user_id_file_type', table_name='documents')
@@ -0,0 +1,28 @@
+"""add_prompt_semantic_cache
+
+Revision ID: 8d4f2a6c1b73
+Revises: e5a7c3d9b261
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8d4f2a6c1b73'
+down_revision: Union[str, None] = 'e5a7c3d9b261'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table('prompts') as batch_op:
+        batch_op.add_column(sa.Column('semantic_cache', sa.Boolean(), nullable=False, server_default=sa.false()))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('prompts') as batch_op:
+        batch_op.drop_column('semantic_cache')
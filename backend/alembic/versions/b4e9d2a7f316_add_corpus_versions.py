@@ -0,0 +1,30 @@
+"""add_corpus_versions
+
+Revision ID: b4e9d2a7f316
+Revises: 8d4f2a6c1b73
+Create Date: 2026-10-19 20:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b4e9d2a7f316'
+down_revision: Union[str, None] = '8d4f2a6c1b73'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('corpus_version', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('documents', sa.Column('corpus_version', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('document_collections', sa.Column('corpus_version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('document_collections', 'corpus_version')
+    op.drop_column('documents', 'corpus_version')
+    op.drop_column('users', 'corpus_version')
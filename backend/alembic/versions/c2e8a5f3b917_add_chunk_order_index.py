@@ -0,0 +1,26 @@
+"""add_chunk_order_index
+
+Revision ID: c2e8a5f3b917
+Revises: 7b1d4e6a9c52
+Create Date: 2026-10-19 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c2e8a5f3b917'
+down_revision: Union[str, None] = '7b1d4e6a9c52'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_document_chunks_document_id_chunk_order', 'document_chunks', ['document_id', 'chunk_order'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_document_chunks_document_id_chunk_order', table_name='document_chunks')
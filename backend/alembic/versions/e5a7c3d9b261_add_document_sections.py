@@ -0,0 +1,51 @@
+"""add_document_sections
+
+Revision ID: e5a7c3d9b261
+Revises: c2e8a5f3b917
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5a7c3d9b261'
+down_revision: Union[str, None] = 'c2e8a5f3b917'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'document_sections',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('document_id', sa.Integer(), nullable=True),
+        sa.Column('content', sa.Text(), nullable=True),
+        sa.Column('section_metadata', sa.JSON(), nullable=True),
+        sa.Column('page_number', sa.Integer(), nullable=True),
+        sa.Column('section_order', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['document_id'], ['documents.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_document_sections_id'), 'document_sections', ['id'], unique=False)
+    op.create_index('ix_document_sections_document_id_section_order', 'document_sections', ['document_id', 'section_order'], unique=False)
+
+    with op.batch_alter_table('document_chunks') as batch_op:
+        batch_op.add_column(sa.Column('parent_id', sa.Integer(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_document_chunks_parent_id'), ['parent_id'], unique=False)
+        batch_op.create_foreign_key('fk_document_chunks_parent_id', 'document_sections', ['parent_id'], ['id'])
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('document_chunks') as batch_op:
+        batch_op.drop_constraint('fk_document_chunks_parent_id', type_='foreignkey')
+        batch_op.drop_index(batch_op.f('ix_document_chunks_parent_id'))
+        batch_op.drop_column('parent_id')
+
+    op.drop_index('ix_document_sections_document_id_section_order', table_name='document_sections')
+    op.drop_index(op.f('ix_document_sections_id'), table_name='document_sections')
+    op.drop_table('document_sections')
@@ -1,5 +1,6 @@
-from typing import Generator
-from fastapi import Depends, HTTPException, status
+import hmac
+from typing import Generator, Optional
+from fastapi import Depends, Header, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
 from pydantic import ValidationError
@@ -12,6 +13,7 @@ from app.db.models.user import User
 from app.schemas.user import UserInDB
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login", auto_error=False)
 
 def get_current_user(
     db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)
@@ -64,3 +66,19 @@ def get_current_active_superuser(
             detail="The user doesn't have enough privileges"
         )
     return current_user
+
+def require_internal_access(
+    db: Session = Depends(get_db),
+    token: Optional[str] = Depends(optional_oauth2_scheme),
+    x_metrics_token: Optional[str] = Header(None),
+) -> None:
+    """Allow monitoring endpoints for the configured metrics token or an active superuser"""
+    if settings.METRICS_TOKEN and x_metrics_token and hmac.compare_digest(x_metrics_token, settings.METRICS_TOKEN):
+        return
+    if token is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    get_current_active_superuser(get_current_active_user(get_current_user(db=db, token=token)))
@@ -1,4 +1,4 @@
-from typing import Any, List, Dict, Optional
+from typing import Any, List, Dict, Optional, Tuple
 from datetime import datetime, timedelta
 from fastapi import APIRouter, Depends, Query, Body
 from sqlalchemy.orm import Session
@@ -11,9 +11,26 @@ from app.db.models.prompt import Prompt
 from app.db.models.analytics import PromptAnalytics
 from app.db.models.test import Test, TestResult
 from app.integrations.llm_clients import get_llm_client
+from app.services.model_catalog import get_model_pricing
 
 router = APIRouter()
 
+def billed_token_usage(metrics: Dict[str, Any]) -> Tuple[int, int]:
+    """(входные, выходные) токены запуска; ответы из кэша провайдеру не оплачиваются"""
+    if metrics.get("cached"):
+        return 0, 0
+    usage = metrics.get("usage", {})
+    input_tokens = usage.get("prompt_tokens", 0) or usage.get("input_tokens", 0) or 0
+    output_tokens = usage.get("completion_tokens", 0) or usage.get("output_tokens", 0) or 0
+    return input_tokens, output_tokens
+
+def prompt_cache_usage(metrics: Dict[str, Any]) -> Tuple[int, int]:
+    """(прочитанные, записанные) токены кэша промптов провайдера; входят во входные токены"""
+    if metrics.get("cached"):
+        return 0, 0
+    usage = metrics.get("usage", {})
+    return usage.get("cache_read_tokens", 0) or 0, usage.get("cache_write_tokens", 0) or 0
+
 @router.get("/usage/prompts")
 def get_prompt_usage(
     days: int = Query(30, description="Number of days to consider for usage statistics"),
@@ -42,14 +59,17 @@ def get_prompt_usage(
         date_str = record.PromptAnalytics.date.strftime("%Y-%m-%d")
         
         # Извлекаем метрики использования из JSON
-        input_tokens = metrics.get("usage", {}).get("prompt_tokens", 0) or metrics.get("usage", {}).get("input_tokens", 0) or 0
-        output_tokens = metrics.get("usage", {}).get("completion_tokens", 0) or metrics.get("usage", {}).get("output_tokens", 0) or 0
+        input_tokens, output_tokens = billed_token_usage(metrics)
+        cache_read_tokens, cache_write_tokens = prompt_cache_usage(metrics)
         
         result.append({
             "date": date_str,
             "prompt_name": record.prompt_name,
             "runs": 1,  # Каждая запись - это один запуск
+            "cached": bool(metrics.get("cached")),
             "input_tokens": input_tokens,
+            "cache_read_tokens": cache_read_tokens,
+            "cache_write_tokens": cache_write_tokens,
             "output_tokens": output_tokens,
             "total_tokens": input_tokens + output_tokens,
             "provider": record.PromptAnalytics.provider
@@ -84,17 +104,24 @@ def get_provider_usage(
         if provider not in provider_stats:
             provider_stats[provider] = {
                 "runs": 0,
+                "cached_runs": 0,
                 "input_tokens": 0,
-                "output_tokens": 0
+                "output_tokens": 0,
+                "cache_read_tokens": 0,
+                "cache_write_tokens": 0
             }
         
         metrics = record.metrics
-        input_tokens = metrics.get("usage", {}).get("prompt_tokens", 0) or metrics.get("usage", {}).get("input_tokens", 0) or 0
-        output_tokens = metrics.get("usage", {}).get("completion_tokens", 0) or metrics.get("usage", {}).get("output_tokens", 0) or 0
+        input_tokens, output_tokens = billed_token_usage(metrics)
+        cache_read_tokens, cache_write_tokens = prompt_cache_usage(metrics)
         
         provider_stats[provider]["runs"] += 1
+        if metrics.get("cached"):
+            provider_stats[provider]["cached_runs"] += 1
         provider_stats[provider]["input_tokens"] += input_tokens
         provider_stats[provider]["output_tokens"] += output_tokens
+        provider_stats[provider]["cache_read_tokens"] += cache_read_tokens
+        provider_stats[provider]["cache_write_tokens"] += cache_write_tokens
     
     # Форматируем данные для фронтенда
     result = []
@@ -102,9 +129,12 @@ def get_provider_usage(
         result.append({
             "provider": provider,
             "runs": stats["runs"],
+            "cached_runs": stats["cached_runs"],
             "input_tokens": stats["input_tokens"],
             "output_tokens": stats["output_tokens"],
-            "total_tokens": stats["input_tokens"] + stats["output_tokens"]
+            "total_tokens": stats["input_tokens"] + stats["output_tokens"],
+            "cache_read_tokens": stats["cache_read_tokens"],
+            "cache_write_tokens": stats["cache_write_tokens"]
         })
     
     return result
@@ -156,13 +186,20 @@ def get_aggregated_analytics(
     
     # Агрегируем метрики
     total_runs = len(analytics_data)
+    cached_runs = 0
     total_input_tokens = 0
     total_output_tokens = 0
+    total_cache_read_tokens = 0
+    total_cache_write_tokens = 0
     
     for record in analytics_data:
         metrics = record.metrics
-        input_tokens = metrics.get("usage", {}).get("prompt_tokens", 0) or metrics.get("usage", {}).get("input_tokens", 0) or 0
-        output_tokens = metrics.get("usage", {}).get("completion_tokens", 0) or metrics.get("usage", {}).get("output_tokens", 0) or 0
+        input_tokens, output_tokens = billed_token_usage(metrics)
+        cache_read_tokens, cache_write_tokens = prompt_cache_usage(metrics)
+        total_cache_read_tokens += cache_read_tokens
+        total_cache_write_tokens += cache_write_tokens
+        if metrics.get("cached"):
+            cached_runs += 1
         
         total_input_tokens += input_tokens
         total_output_tokens += output_tokens
@@ -172,8 +209,11 @@ def get_aggregated_analytics(
         "total_prompts": total_prompts,
         "total_tests": total_tests,
         "total_runs": total_runs,
+        "cached_runs": cached_runs,
         "total_input_tokens": total_input_tokens,
         "total_output_tokens": total_output_tokens,
+        "total_cache_read_tokens": total_cache_read_tokens,
+        "total_cache_write_tokens": total_cache_write_tokens,
         "period": period
     }
     
@@ -381,38 +421,6 @@ def get_provider_pricing(provider, model):
     """
     Get pricing information for a specific provider and model.
     
-    In production, this should be stored in a database or fetched from provider APIs.
+    Prices come from the model catalog; unknown models get conservative defaults.
     """
-    # Simplified pricing data (approximate as of 2024)
-    pricing_data = {
-        "openai": {
-            "gpt-4o": {"input_price_per_1k": 0.01, "output_price_per_1k": 0.03},
-            "gpt-4-turbo": {"input_price_per_1k": 0.01, "output_price_per_1k": 0.03},
-            "gpt-4": {"input_price_per_1k": 0.03, "output_price_per_1k": 0.06},
-            "gpt-3.5-turbo": {"input_price_per_1k": 0.0005, "output_price_per_1k": 0.0015}
-        },
-        "anthropic": {
-            "claude-3-opus-20240229": {"input_price_per_1k": 0.015, "output_price_per_1k": 0.075},
-            "claude-3-sonnet-20240229": {"input_price_per_1k": 0.003, "output_price_per_1k": 0.015},
-            "claude-3-haiku-20240307": {"input_price_per_1k": 0.00025, "output_price_per_1k": 0.00125}
-        },
-        "mistral": {
-            "mistral-large-latest": {"input_price_per_1k": 0.002, "output_price_per_1k": 0.006},
-            "mistral-medium-latest": {"input_price_per_1k": 0.0006, "output_price_per_1k": 0.0018},
-            "mistral-small-latest": {"input_price_per_1k": 0.0002, "output_price_per_1k": 0.0006}
-        },
-        "google": {
-            "gemini-1.5-pro": {"input_price_per_1k": 0.0005, "output_price_per_1k": 0.0015},
-            "gemini-1.5-flash": {"input_price_per_1k": 0.00035, "output_price_per_1k": 0.00105},
-            "gemini-1.0-pro": {"input_price_per_1k": 0.0005, "output_price_per_1k": 0.0015}
-        }
-    }
-    
-    # Return pricing info for the specific model or default values
-    provider_pricing = pricing_data.get(provider, {})
-    model_pricing = provider_pricing.get(model, {
-        "input_price_per_1k": 0.01,  # Default fallback prices
-        "output_price_per_1k": 0.03
-    })
-    
-    return model_pricing
+    return get_model_pricing(provider, model)
@@ -1,26 +1,45 @@
-from typing import Any, List, Optional, Dict
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Query
+from typing import Any, List, Optional, Dict, Set
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Query, WebSocket, WebSocketDisconnect, status
 from fastapi.responses import JSONResponse
+from sqlalchemy import or_
 from sqlalchemy.orm import Session
+from datetime import datetime
 import os
+import json
+import time
+import asyncio
 import uuid
 import logging
 import re
 import math
 import numpy as np
 
-from app.api.deps import get_current_user, get_db
+from app.api.deps import get_current_active_user, get_current_user, get_db
+from app.core.config import settings
+from app.core.metrics import metrics
 from app.db.models.user import User
-from app.db.models.document import Document, DocumentChunk, ProcessingStatus
+from app.db.session import SessionLocal
+from app.db.models.document import Document, DocumentChunk, DocumentSection, ProcessingStatus
 from app.schemas.document import (
     DocumentCreate, 
     DocumentRead, 
     DocumentSearchParams,
     DocumentSearchResult,
+    SearchFilters,
     SearchResultItem
 )
 from app.services.document_processor import DocumentProcessor
-from app.services.local_embedding_service import LocalEmbeddingService
+from app.services.embedding_backfill import embedding_backfill_worker, get_document_coverage
+from app.services.local_embedding_service import get_local_embedding_service
+from app.services.lexical_search import extract_keywords, lexical_relevance, prefix_lexical_search
+from app.services.search_cache import search_cache, invalidate_document
+from app.services.vector_index import scoped_top_k
+from app.services.vector_search import (
+    STREAM_BATCH_SIZE,
+    TopKHeap,
+    scoped_chunk_query,
+    fetch_chunk_details
+)
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -125,6 +144,10 @@ async def upload_document(
             document.processing_status = ProcessingStatus.FAILED
             db.commit()
         
+        # Чанки, для которых не удалось создать эмбеддинги при обработке,
+        # дозаполнит фоновый воркер
+        embedding_backfill_worker.notify()
+        
         # Получаем актуальное состояние документа
         db.refresh(document)
         logger.info(f"Финальный статус документа ID: {document.id}: {document.processing_status}")
@@ -153,6 +176,294 @@ def read_documents(
     
     return documents
 
+@router.get("/search", response_model=DocumentSearchResult)
+async def search_documents(
+    query: str = Query(..., description="Поисковый запрос"),
+    document_ids: Optional[str] = Query(None, description="ID документов для поиска, разделенные запятыми"),
+    max_chunks: int = Query(5, description="Максимальное количество чанков для возврата"),
+    min_similarity: float = Query(0.0, description="Минимальное сходство для возврата результата", ge=0.0, le=1.0),
+    file_types: Optional[str] = Query(None, description="Типы файлов, разделенные запятыми (pdf,docx,...)"),
+    page_from: Optional[int] = Query(None, description="Начальная страница", ge=0),
+    page_to: Optional[int] = Query(None, description="Конечная страница", ge=0),
+    created_after: Optional[datetime] = Query(None, description="Документы, загруженные не раньше этой даты"),
+    created_before: Optional[datetime] = Query(None, description="Документы, загруженные не позже этой даты"),
+    metadata: Optional[str] = Query(None, description="JSON-объект с требуемыми значениями ключей метаданных чанка"),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Поиск по документам с использованием семантического поиска на основе векторных эмбеддингов.
+    Поиск производится либо по всем документам пользователя, либо по указанным ID документов.
+    Фильтры по типу файла, страницам, датам и метаданным применяются в SQL до подсчета сходства.
+    """
+    logger.info(f"Поисковый запрос: '{query}' от пользователя ID={current_user.id}")
+    logger.info(f"Параметры поиска: document_ids={document_ids}, max_chunks={max_chunks}, min_similarity={min_similarity}")
+    
+    # Парсим document_ids из строки в список
+    doc_ids = None
+    if document_ids:
+        try:
+            doc_ids = [int(id.strip()) for id in document_ids.split(",") if id.strip()]
+            logger.info(f"Поиск будет выполнен по документам с ID: {doc_ids}")
+        except ValueError:
+            logger.error(f"Неверный формат document_ids: {document_ids}")
+            raise HTTPException(
+                status_code=400,
+                detail="document_ids должны быть числами, разделенными запятыми"
+            )
+    
+    # Собираем структурные фильтры
+    try:
+        metadata_filter = json.loads(metadata) if metadata else None
+        if metadata_filter is not None and not isinstance(metadata_filter, dict):
+            raise ValueError("metadata должен быть JSON-объектом")
+        filters = SearchFilters(
+            file_types=[t.strip() for t in file_types.split(",") if t.strip()] if file_types else None,
+            page_from=page_from,
+            page_to=page_to,
+            created_after=created_after,
+            created_before=created_before,
+            metadata=metadata_filter
+        )
+    except ValueError as e:
+        logger.error(f"Неверный формат фильтров поиска: {e}")
+        raise HTTPException(status_code=400, detail=f"Неверный формат фильтров: {e}")
+    
+    # Используем общую для процесса локальную модель для семантического поиска
+    embedding_service = get_local_embedding_service()
+    
+    # Получаем эмбеддинг для запроса
+    try:
+        query_embedding = await embedding_service.get_embeddings(query)
+    except Exception as e:
+        logger.error(f"Ошибка при создании эмбеддинга для запроса: {e}")
+        # Если не удалось получить эмбеддинг, выполняем текстовый поиск
+        search_results = await text_based_search(query, db, current_user.id, doc_ids, max_chunks, min_similarity, filters=filters)
+        return {"query": query, "results": search_results, "count": len(search_results), "coverage": None}
+    
+    # Поиск по memory-mapped шарду пользователя (или потоковое сканирование БД),
+    # в памяти держится лишь top-k куча, а не все чанки
+    top_chunks, coverage = scoped_top_k(
+        db,
+        current_user.id,
+        query_embedding,
+        max_chunks,
+        min_similarity,
+        document_ids=doc_ids,
+        only_completed=True,
+        filters=filters
+    )
+    
+    # Чанки без эмбеддингов пропускаются, их дозаполняет фоновый воркер
+    
+    if coverage["partial_documents"]:
+        logger.info(f"Частичное покрытие эмбеддингами: {coverage['coverage_percent']}%")
+        embedding_backfill_worker.notify()
+    
+    # Содержимое и метаданные загружаем только для победителей
+    details = fetch_chunk_details(db, [chunk_id for _, chunk_id, _ in top_chunks])
+    search_results = [
+        format_search_result(details[chunk_id], similarity)
+        for similarity, chunk_id, _ in top_chunks
+        if chunk_id in details
+    ]
+    
+    # Если результатов мало, дополняем текстовым поиском
+    if len(search_results) < max_chunks:
+        logger.info(f"Недостаточно результатов ({len(search_results)}), дополняем текстовым поиском")
+        seen_chunks = {r["chunk_id"] for r in search_results}
+        text_results = await text_based_search(
+            query, db, current_user.id, doc_ids, max_chunks - len(search_results), min_similarity,
+            exclude_chunk_ids=seen_chunks,
+            filters=filters
+        )
+        search_results.extend(text_results)
+    
+    # Ограничиваем итоговое количество результатов
+    search_results = search_results[:max_chunks]
+    
+    logger.info(f"Возвращено {len(search_results)} результатов поиска")
+    return {"query": query, "results": search_results, "count": len(search_results), "coverage": coverage}
+
+@router.websocket("/search/live")
+async def live_search(
+    websocket: WebSocket,
+    token: str = Query(..., description="JWT токен (браузер не передает заголовки в WebSocket)")
+):
+    """
+    Поиск по мере ввода через одно WebSocket-соединение.
+    
+    Клиент отправляет {"seq", "query", "document_ids", "max_chunks", "min_similarity", "filters"}
+    на каждое изменение запроса. Новый запрос отменяет еще не завершенный предыдущий.
+    Сервер сразу отвечает лексическими совпадениями ({"type": "lexical"}), затем после
+    паузы SEARCH_LIVE_DEBOUNCE_MS считает эмбеддинг и присылает результаты плотного
+    поиска ({"type": "dense"}). Ответы помечены seq запроса, на который отвечают.
+    
+    Соединение не держит сессию БД: каждый запрос к БД открывает свою и выполняется
+    в потоке, чтобы не блокировать event loop на потоке нажатий клавиш.
+    """
+    db = SessionLocal()
+    try:
+        # Зависимости не работают до accept: проверки get_current_active_user повторяем вручную
+        user_id = get_current_active_user(get_current_user(db=db, token=token)).id
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    finally:
+        db.close()
+    
+    await websocket.accept()
+    task: Optional[asyncio.Task] = None
+    try:
+        while True:
+            message = await websocket.receive_json()
+            if task is not None and not task.done():
+                # Запрос устарел: отменяем его, пока он ждет паузы или эмбеддинга
+                task.cancel()
+                metrics.increment("search.live.cancelled")
+            task = asyncio.create_task(_live_search_task(websocket, user_id, message))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if task is not None:
+            task.cancel()
+
+async def _live_search_task(websocket: WebSocket, user_id: int, message: Dict[str, Any]) -> None:
+    # Исключения фоновой задачи иначе потерялись бы: логируем и сообщаем клиенту
+    try:
+        await run_live_search(websocket, user_id, message)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.exception(f"Ошибка поиска по мере ввода: {e}")
+        try:
+            await websocket.send_json({"type": "error", "seq": message.get("seq"), "detail": "Ошибка поиска"})
+        except Exception:
+            pass
+
+def _live_lexical_results(
+    user_id: int,
+    normalized_query: str,
+    max_chunks: int,
+    doc_ids: Optional[List[int]],
+    filters: Optional[SearchFilters]
+):
+    """Лексические совпадения для поиска по мере ввода; выполняется в потоке со своей сессией"""
+    db = SessionLocal()
+    try:
+        top_lexical, lexical_info = prefix_lexical_search(
+            db, user_id, normalized_query, max_chunks, document_ids=doc_ids, filters=filters
+        )
+        details = fetch_chunk_details(db, [chunk_id for _, chunk_id, _ in top_lexical])
+        results = [
+            format_search_result(details[chunk_id], relevance)
+            for relevance, chunk_id, _ in top_lexical
+            if chunk_id in details
+        ]
+        return results, lexical_info
+    finally:
+        db.close()
+
+def _live_dense_results(
+    user_id: int,
+    query_embedding: List[float],
+    max_chunks: int,
+    min_similarity: float,
+    doc_ids: Optional[List[int]],
+    filters: Optional[SearchFilters]
+):
+    """Результаты плотного поиска по мере ввода; выполняется в потоке со своей сессией"""
+    db = SessionLocal()
+    try:
+        top_chunks, coverage = scoped_top_k(
+            db,
+            user_id,
+            query_embedding,
+            max_chunks,
+            min_similarity,
+            document_ids=doc_ids,
+            only_completed=True,
+            filters=filters
+        )
+        details = fetch_chunk_details(db, [chunk_id for _, chunk_id, _ in top_chunks])
+        results = [
+            format_search_result(details[chunk_id], similarity)
+            for similarity, chunk_id, _ in top_chunks
+            if chunk_id in details
+        ]
+        return results, coverage
+    finally:
+        db.close()
+
+async def run_live_search(websocket: WebSocket, user_id: int, message: Dict[str, Any]) -> None:
+    """Отвечает на одно сообщение поиска по мере ввода: сначала лексически, затем плотным поиском"""
+    seq = message.get("seq")
+    query = str(message.get("query") or "")
+    normalized_query = search_cache.normalize_query(query)
+    metrics.increment("search.live.queries")
+    
+    try:
+        doc_ids = [int(doc_id) for doc_id in message.get("document_ids") or []] or None
+        max_chunks = max(1, min(int(message.get("max_chunks", 5)), 20))
+        min_similarity = float(message.get("min_similarity", 0.0))
+        filters = SearchFilters(**message["filters"]) if message.get("filters") else None
+    except (TypeError, ValueError) as e:
+        await websocket.send_json({"type": "error", "seq": seq, "detail": f"Неверные параметры поиска: {e}"})
+        return
+    
+    if len(normalized_query) < settings.SEARCH_LIVE_MIN_QUERY_LENGTH:
+        await websocket.send_json({"type": "lexical", "seq": seq, "query": query, "results": []})
+        return
+    
+    # Лексические совпадения отдаем сразу: кандидаты уточняются из кэша префиксов
+    start_time = time.monotonic()
+    lexical_results, lexical_info = await asyncio.to_thread(
+        _live_lexical_results, user_id, normalized_query, max_chunks, doc_ids, filters
+    )
+    lexical_ms = round((time.monotonic() - start_time) * 1000, 2)
+    metrics.observe("search.live.lexical_ms", lexical_ms)
+    await websocket.send_json({
+        "type": "lexical",
+        "seq": seq,
+        "query": query,
+        "results": lexical_results,
+        "elapsed_ms": lexical_ms,
+        **lexical_info
+    })
+    
+    # Эмбеддинг считаем, только если за время паузы не пришел более новый запрос
+    embedding_service = get_local_embedding_service()
+    embedding_key = search_cache.embedding_key("local", embedding_service.model_name, normalized_query)
+    query_embedding = search_cache.query_embeddings.get(embedding_key)
+    if query_embedding is None:
+        await asyncio.sleep(settings.SEARCH_LIVE_DEBOUNCE_MS / 1000)
+        try:
+            query_embedding = await embedding_service.get_embeddings(query)
+        except Exception as e:
+            logger.error(f"Ошибка при создании эмбеддинга для запроса: {e}")
+            await websocket.send_json({"type": "error", "seq": seq, "detail": "Семантический поиск недоступен"})
+            return
+        search_cache.query_embeddings.set(embedding_key, query_embedding)
+    
+    dense_results, coverage = await asyncio.to_thread(
+        _live_dense_results, user_id, query_embedding, max_chunks, min_similarity, doc_ids, filters
+    )
+    
+    # Лексические совпадения дополняют плотные, как в обычном поиске
+    seen_chunks = {result["chunk_id"] for result in dense_results}
+    dense_results.extend(result for result in lexical_results if result["chunk_id"] not in seen_chunks)
+    
+    dense_ms = round((time.monotonic() - start_time) * 1000, 2)
+    metrics.observe("search.live.dense_ms", dense_ms)
+    await websocket.send_json({
+        "type": "dense",
+        "seq": seq,
+        "query": query,
+        "results": dense_results[:max_chunks],
+        "coverage": coverage,
+        "elapsed_ms": dense_ms
+    })
+
 @router.get("/{document_id}", response_model=DocumentRead)
 def read_document(
     document_id: int,
@@ -172,6 +483,25 @@ def read_document(
     
     return document
 
+@router.get("/{document_id}/coverage")
+def read_document_coverage(
+    document_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+) -> Any:
+    """
+    Получить процент чанков документа, для которых уже созданы эмбеддинги.
+    """
+    document = db.query(Document.id).filter(
+        Document.id == document_id,
+        Document.user_id == current_user.id
+    ).first()
+    
+    if not document:
+        raise HTTPException(status_code=404, detail="Документ не найден")
+    
+    return get_document_coverage(db, document_id)
+
 @router.delete("/{document_id}")
 def delete_document(
     document_id: int,
@@ -197,8 +527,12 @@ def delete_document(
         # Логгирование ошибки, но продолжаем удаление из БД
         print(f"Ошибка при удалении файла: {e}")
     
-    # Удаление связанных чанков
+    # Сбрасываем закэшированные результаты поиска по этому документу
+    invalidate_document(document, commit=False)
+    
+    # Удаление связанных чанков и секций
     db.query(DocumentChunk).filter(DocumentChunk.document_id == document.id).delete()
+    db.query(DocumentSection).filter(DocumentSection.document_id == document.id).delete()
     
     # Удаление документа
     db.delete(document)
@@ -206,205 +540,74 @@ def delete_document(
     
     return {"message": "Документ успешно удален"}
 
-@router.get("/search", response_model=List[DocumentSearchResult])
-async def search_documents(
-    query: str = Query(..., description="Поисковый запрос"),
-    document_ids: Optional[str] = Query(None, description="ID документов для поиска, разделенные запятыми"),
-    max_chunks: int = Query(5, description="Максимальное количество чанков для возврата"),
-    min_similarity: float = Query(0.0, description="Минимальное сходство для возврата результата", ge=0.0, le=1.0),
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
-):
-    """
-    Поиск по документам с использованием семантического поиска на основе векторных эмбеддингов.
-    Поиск производится либо по всем документам пользователя, либо по указанным ID документов.
-    """
-    logger.info(f"Поисковый запрос: '{query}' от пользователя ID={current_user.id}")
-    logger.info(f"Параметры поиска: document_ids={document_ids}, max_chunks={max_chunks}, min_similarity={min_similarity}")
-    
-    # Парсим document_ids из строки в список
-    doc_ids = None
-    if document_ids:
-        try:
-            doc_ids = [int(id.strip()) for id in document_ids.split(",") if id.strip()]
-            logger.info(f"Поиск будет выполнен по документам с ID: {doc_ids}")
-        except ValueError:
-            logger.error(f"Неверный формат document_ids: {document_ids}")
-            raise HTTPException(
-                status_code=400,
-                detail="document_ids должны быть числами, разделенными запятыми"
-            )
-    
-    # Получаем все документы текущего пользователя (или только запрошенные)
-    if doc_ids:
-        documents = db.query(Document).filter(
-            Document.user_id == current_user.id,
-            Document.id.in_(doc_ids),
-            Document.processing_status == ProcessingStatus.COMPLETED
-        ).all()
-    else:
-        documents = db.query(Document).filter(
-            Document.user_id == current_user.id,
-            Document.processing_status == ProcessingStatus.COMPLETED
-        ).all()
-    
-    if not documents:
-        logger.info("Документы не найдены для указанных параметров")
-        return []
-    
-    logger.info(f"Найдено {len(documents)} документов для поиска")
-    
-    # Создаем сервис для работы с эмбеддингами
-    # Используем локальную модель для семантического поиска
-    cache_folder = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "model_cache")
-    os.makedirs(cache_folder, exist_ok=True)
-    
-    embedding_service = LocalEmbeddingService(cache_dir=cache_folder)
-    
-    # Получаем эмбеддинг для запроса
-    try:
-        query_embedding = await embedding_service.get_embeddings(query)
-    except Exception as e:
-        logger.error(f"Ошибка при создании эмбеддинга для запроса: {e}")
-        # Если не удалось получить эмбеддинг, выполняем текстовый поиск
-        return await text_based_search(query, documents, max_chunks, db, min_similarity)
-    
-    # Получаем чанки документов
-    chunks = []
-    for document in documents:
-        doc_chunks = db.query(DocumentChunk).filter(
-            DocumentChunk.document_id == document.id
-        ).all()
-        chunks.extend(doc_chunks)
-    
-    logger.info(f"Всего найдено {len(chunks)} чанков для поиска")
-    
-    if not chunks:
-        logger.warning("Чанки документов не найдены")
-        return []
-    
-    # Выполняем векторный поиск
-    search_results = []
-    
-    # Получаем эмбеддинги чанков или используем существующие
-    for chunk in chunks:
-        if not chunk.embedding:
-            try:
-                # Если эмбеддинг отсутствует, создаем его
-                chunk_embedding = await embedding_service.get_embeddings(chunk.content)
-                chunk.embedding = chunk_embedding
-                db.add(chunk)
-                db.commit()
-            except Exception as e:
-                logger.error(f"Ошибка при создании эмбеддинга для чанка: {e}")
-                continue
-        
-        # Вычисляем косинусное сходство между эмбеддингами
-        similarity = cosine_similarity(query_embedding, chunk.embedding)
-        
-        if similarity >= min_similarity:
-            document = next((doc for doc in documents if doc.id == chunk.document_id), None)
-            if document:
-                search_results.append({
-                    "document_id": document.id,
-                    "document_name": document.filename,
-                    "chunk_id": chunk.id,
-                    "chunk_order": chunk.chunk_order,
-                    "page_number": chunk.page_number,
-                    "content": chunk.content,
-                    "similarity": float(similarity),
-                    "metadata": chunk.chunk_metadata
-                })
-    
-    # Сортируем результаты по убыванию релевантности
-    search_results.sort(key=lambda x: x["similarity"], reverse=True)
-    
-    # Ограничиваем количество результатов
-    search_results = search_results[:max_chunks]
-    
-    # Если результатов мало, дополняем текстовым поиском
-    if len(search_results) < max_chunks:
-        logger.info(f"Недостаточно результатов ({len(search_results)}), дополняем текстовым поиском")
-        text_results = await text_based_search(query, documents, max_chunks - len(search_results), db, min_similarity)
-        
-        # Объединяем результаты, исключая дубликаты по document_id и chunk_id
-        seen_chunks = {(r["document_id"], r["chunk_id"]) for r in search_results}
-        for result in text_results:
-            if (result["document_id"], result["chunk_id"]) not in seen_chunks:
-                search_results.append(result)
-                seen_chunks.add((result["document_id"], result["chunk_id"]))
-    
-    # Ограничиваем итоговое количество результатов
-    search_results = search_results[:max_chunks]
-    
-    logger.info(f"Возвращено {len(search_results)} результатов поиска")
-    return search_results
+def format_search_result(chunk, similarity: float) -> Dict[str, Any]:
+    """Форматирует строку чанка из fetch_chunk_details в элемент результата поиска"""
+    return {
+        "document_id": chunk.document_id,
+        "document_name": chunk.filename,
+        "document_title": chunk.title or chunk.filename,
+        "chunk_id": chunk.id,
+        "chunk_order": chunk.chunk_order,
+        "page_number": chunk.page_number,
+        "content": chunk.content,
+        "similarity": float(similarity),
+        "metadata": chunk.chunk_metadata
+    }
 
 async def text_based_search(
     query: str, 
-    documents: List[Document], 
-    max_chunks: int, 
     db: Session,
-    min_similarity: float = 0.0
+    user_id: int,
+    document_ids: Optional[List[int]],
+    max_chunks: int, 
+    min_similarity: float = 0.0,
+    exclude_chunk_ids: Optional[Set[int]] = None,
+    filters: Optional[SearchFilters] = None
 ) -> List[Dict[str, Any]]:
     """
     Выполняет текстовый поиск по документам, когда векторный поиск недоступен или дал мало результатов
     """
     logger.info(f"Выполняем текстовый поиск по запросу: '{query}'")
     
-    # Нормализуем запрос для лучшего поиска
-    normalized_query = query.lower()
-    words = [w for w in re.split(r'\W+', normalized_query) if w]
-    
-    # Исключаем стоп-слова (можно расширить список)
-    stop_words = {"and", "or", "the", "a", "an", "in", "on", "at", "to", "for", 
-                 "и", "или", "в", "на", "с", "по", "для", "от", "к", "у"}
-    keywords = [w for w in words if w not in stop_words and len(w) > 1]
+    # Ключевые слова без стоп-слов (или все слова, если остались только стоп-слова)
+    keywords = extract_keywords(query)
     
     if not keywords:
-        keywords = words  # Если все слова были стоп-словами, используем исходные слова
+        return []
     
     logger.info(f"Ключевые слова для поиска: {keywords}")
     
-    results = []
-    for document in documents:
-        # Получаем чанки документа
-        chunks = db.query(DocumentChunk).filter(
-            DocumentChunk.document_id == document.id
-        ).all()
+    # Чанки без единого ключевого слова отсеиваем еще в SQL
+    rows = scoped_chunk_query(
+        db,
+        (DocumentChunk.id, DocumentChunk.document_id, DocumentChunk.content),
+        user_id=user_id,
+        document_ids=document_ids,
+        only_completed=True,
+        filters=filters
+    ).filter(
+        or_(*[DocumentChunk.content.ilike(f"%{kw}%") for kw in keywords])
+    ).yield_per(STREAM_BATCH_SIZE)
+    
+    heap = TopKHeap(max_chunks)
+    for chunk_id, document_id, content in rows:
+        if exclude_chunk_ids and chunk_id in exclude_chunk_ids:
+            continue
         
-        for chunk in chunks:
-            content_lower = chunk.content.lower()
-            
-            # Считаем количество совпадений ключевых слов в содержимом чанка
-            matches = sum(1 for kw in keywords if kw in content_lower)
-            
-            # Если есть хотя бы одно совпадение
-            if matches > 0:
-                # Вычисляем релевантность на основе количества совпадений и длины содержимого
-                relevance = matches / (len(keywords) * (1 + math.log10(len(content_lower) / 100)))
-                
-                # Нормализуем значение релевантности в диапазоне от 0 до 1
-                # чем ближе к 1, тем более релевантный результат
-                normalized_relevance = min(0.7, relevance * 0.7)  # Максимум 0.7, чтобы векторные результаты имели приоритет
-                
-                if normalized_relevance >= min_similarity:
-                    results.append({
-                        "document_id": document.id,
-                        "document_name": document.filename,
-                        "chunk_id": chunk.id,
-                        "chunk_order": chunk.chunk_order,
-                        "page_number": chunk.page_number,
-                        "content": chunk.content,
-                        "similarity": normalized_relevance,
-                        "metadata": chunk.chunk_metadata
-                    })
-    
-    # Сортируем по релевантности
-    results.sort(key=lambda x: x["similarity"], reverse=True)
-    
-    # Возвращаем топ результаты
-    return results[:max_chunks]
+        # Релевантность по количеству совпавших ключевых слов и длине содержимого
+        relevance = lexical_relevance(keywords, (content or "").lower())
+        if relevance > 0 and relevance >= min_similarity:
+            heap.push(relevance, chunk_id, document_id)
+    
+    # Содержимое загружаем повторно только для лучших результатов
+    top_chunks = heap.results()
+    details = fetch_chunk_details(db, [chunk_id for _, chunk_id, _ in top_chunks])
+    
+    return [
+        format_search_result(details[chunk_id], relevance)
+        for relevance, chunk_id, _ in top_chunks
+        if chunk_id in details
+    ]
 
 def cosine_similarity(vec1, vec2):
     """
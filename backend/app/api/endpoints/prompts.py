@@ -1,5 +1,6 @@
 from typing import Any, List, Optional, Dict
 from fastapi import APIRouter, Depends, HTTPException, Query, Body, Path
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 
 from app.api.deps import get_db, get_current_active_user
@@ -9,7 +10,17 @@ from app.db.models.user import User
 from app.integrations.llm_clients import get_llm_client
 import time
 from app.api.endpoints.testing import format_prompt_for_provider
-from app.services.document import DocumentService
+from app.services.document_service import DocumentService
+from app.services.context_packer import (
+    build_adjacency_map,
+    context_token_budget,
+    estimate_tokens,
+    pack_context,
+    pieces_from_search_results
+)
+from app.services.llm_router import equivalent_routes, served_route
+from app.services.prompt_streaming import SSE_HEADERS, stream_completion, usage_token_counts
+from app.services.response_cache import CachedRequest, cached_completion
 from app.services.testing import TestingService
 from app.schemas import TestResult, RagTestCreate
 from app.utils import logger
@@ -484,15 +495,41 @@ async def test_prompt_with_rag(
                 max_chunks=rag_test_data.max_chunks,
                 min_similarity=rag_test_data.min_similarity,
                 provider=rag_test_data.embedding_provider,
-                model=rag_test_data.embedding_model
+                model=rag_test_data.embedding_model,
+                rerank=rag_test_data.rerank,
+                rerank_budget_ms=rag_test_data.rerank_budget_ms,
+                filters=rag_test_data.filters,
+                expand_parents=rag_test_data.expand_parents
             )
         
-        # Собираем тексты из релевантных фрагментов
-        context_texts = [chunk["content"] for chunk in relevant_chunks]
+        # Бюджет контекста: окно модели минус промпт без контекста и резерв под ответ
+        prompt_without_context = format_prompt_for_provider(
+            prompt.content, rag_test_data.provider, {**rag_test_data.prompt_variables, "context": ""}
+        )
+        prompt_tokens = sum(
+            estimate_tokens(message["content"])
+            for message in prompt_without_context
+            if isinstance(message.get("content"), str)
+        )
+        token_budget = context_token_budget(
+            rag_test_data.provider,
+            rag_test_data.model,
+            prompt_tokens,
+            rag_test_data.max_tokens,
+            rag_test_data.context_token_budget
+        )
+        
+        # Склеиваем соседние и перекрывающиеся фрагменты и набираем контекст в пределах бюджета
+        adjacency = None
+        if rag_test_data.expand_neighbours and relevant_chunks:
+            adjacency = build_adjacency_map(
+                db, pieces_from_search_results(relevant_chunks), rag_test_data.neighbour_radius
+            )
+        packed_context = pack_context(relevant_chunks, token_budget, adjacency, rag_test_data.neighbour_radius)
         
         # Обновляем переменные промпта, добавляя контекст из RAG
         rag_variables = rag_test_data.prompt_variables.copy()
-        rag_variables["context"] = "\n\n".join(context_texts)
+        rag_variables["context"] = packed_context["context"]
         
         # Логгируем информацию о тестировании
         logger.info(f"Testing prompt {prompt_id} with RAG. Found {len(relevant_chunks)} relevant chunks")
@@ -508,7 +545,8 @@ async def test_prompt_with_rag(
             top_p=rag_test_data.top_p,
             frequency_penalty=rag_test_data.frequency_penalty,
             presence_penalty=rag_test_data.presence_penalty,
-            llm_client=llm_client
+            llm_client=llm_client,
+            owner=current_user.id
         )
         
         # Добавляем информацию о RAG в результат
@@ -523,7 +561,11 @@ async def test_prompt_with_rag(
                     "content_preview": chunk["content"][:200] + "..." if len(chunk["content"]) > 200 else chunk["content"]
                 }
                 for chunk in relevant_chunks
-            ]
+            ],
+            "context": {
+                "spans": packed_context["spans"],
+                **packed_context["stats"]
+            }
         }
         
         return test_result
@@ -533,7 +575,7 @@ async def test_prompt_with_rag(
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/{prompt_id}/execute")
-def execute_prompt(
+async def execute_prompt(
     prompt_id: int,
     execution_request: PromptExecutionSchema,
     current_user: User = Depends(get_current_active_user),
@@ -541,32 +583,22 @@ def execute_prompt(
 ) -> Any:
     """
     Execute a prompt with a language model
+    
+    With stream=true the response is sent as Server-Sent Events while the model generates it.
     """
     # Получаем промпт из базы
-    prompt = db.query(Prompt).filter(Prompt.id == prompt_id, Prompt.user_id == current_user.id).first()
-    if not prompt:
+    prompt = PromptService.get(db=db, prompt_id=prompt_id)
+    if not prompt or prompt.user_id != current_user.id:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Prompt not found"
         )
     
-    # Получаем тело промпта и переменные
-    prompt_template = prompt.content
-    variables = prompt.variables
-    
-    # Предварительная обработка промпта
-    processed_prompt = prepare_prompt(prompt_template, variables, execution_request.variables)
-    
-    # Создаем сообщения в формате ChatGPT
-    messages = []
-    
-    # Если есть системное сообщение, добавляем его
-    if prompt.system_message:
-        system_message = prepare_prompt(prompt.system_message, variables, execution_request.variables)
-        messages.append({"role": "system", "content": system_message})
+    model = execution_request.model
+    provider = execution_request.provider
     
-    # Добавляем основное сообщение пользователя
-    messages.append({"role": "user", "content": processed_prompt})
+    # Подставляем переменные и приводим сообщения к формату провайдера
+    messages = format_prompt_for_provider(prompt.content, provider, execution_request.variables)
     
     # Определение параметров модели
     model_parameters = {
@@ -575,55 +607,75 @@ def execute_prompt(
         "top_p": execution_request.parameters.get("top_p", 0.95),
     }
     
-    model = execution_request.model
-    provider = execution_request.provider
+    # Получаем клиент для указанного провайдера, передавая пользователя и DB
+    client = get_llm_client(provider, user=current_user, db=db)
+    
+    if not client:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Provider {provider} not supported or API key not configured"
+        )
+    
+    # Детерминированные запросы могут быть отданы из кэша ответов
+    cache = CachedRequest(
+        provider, model, messages, model_parameters,
+        semantic_user_id=current_user.id if prompt.semantic_cache else None,
+        bypass_cache=execution_request.bypass_cache
+    )
+    
+    # Эквивалентные модели для хеджирования медленных и замены упавших запросов
+    alternatives = equivalent_routes(
+        provider, model,
+        lambda target: format_prompt_for_provider(prompt.content, target, execution_request.variables),
+        user=current_user, db=db
+    )
+    
+    if execution_request.stream:
+        return StreamingResponse(
+            stream_completion(
+                client,
+                messages,
+                model,
+                model_parameters,
+                prompt_id=prompt.id,
+                user_id=current_user.id,
+                provider=provider,
+                cache=cache,
+                alternatives=alternatives
+            ),
+            media_type="text/event-stream",
+            headers=SSE_HEADERS
+        )
     
     start_time = time.time()
     
     try:
-        # Получаем клиент для указанного провайдера, передавая пользователя и DB
-        client = get_llm_client(provider, user=current_user, db=db)
-        
-        if not client:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Provider {provider} not supported or API key not configured"
-            )
-        
         # Вызываем модель
-        result = client.process_prompt(messages, model, model_parameters)
-        
-        # Форматируем ответ
-        response = client.format_response(result)
+        response, cache_info = await cached_completion(client, cache, owner=current_user.id, alternatives=alternatives)
         
         # Сохраняем аналитику
         end_time = time.time()
         execution_time = end_time - start_time
         
+        # Аналитика относится к модели, которая ответила (после резерва - к резервной)
+        served_provider, served_model = served_route(cache_info.get("route"), provider, model)
         analytics = PromptAnalytics(
             prompt_id=prompt.id,
             user_id=current_user.id,
-            metrics={"usage": response.get("usage", {}), "execution_time": execution_time},
-            provider=provider,
+            metrics={"usage": response.get("usage", {}), "execution_time": execution_time, "model": served_model, **cache_info},
+            provider=served_provider,
+            usage_count=1,
             average_response_time=execution_time
         )
         
-        if "usage" in response:
-            usage = response["usage"]
-            
-            if "input_tokens" in usage and "output_tokens" in usage:
-                input_tokens = usage["input_tokens"]
-                output_tokens = usage["output_tokens"]
-                analytics.average_token_count = input_tokens + output_tokens
-            elif "prompt_tokens" in usage and "completion_tokens" in usage:
-                input_tokens = usage["prompt_tokens"]
-                output_tokens = usage["completion_tokens"]
-                analytics.average_token_count = input_tokens + output_tokens
+        input_tokens, output_tokens = usage_token_counts(response.get("usage", {}))
+        if input_tokens or output_tokens:
+            analytics.average_token_count = input_tokens + output_tokens
         
         db.add(analytics)
         db.commit()
         
-        return {"result": response.get("content", "")}
+        return {"result": response.get("content", ""), "metadata": cache_info}
     
     except Exception as e:
         # Логирование ошибки
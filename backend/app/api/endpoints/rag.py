@@ -8,8 +8,10 @@ from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
 
 from app.api import deps
+from app.core.config import settings
 from app.db.models.user import User
 from app.db.models.document import Document, DocumentCollection
+from app.schemas.document import SearchFilters
 from app.services.document_processor import DocumentProcessor
 from app.services.document_service import DocumentService
 from app.services.embedding_service import EmbeddingService
@@ -425,6 +427,12 @@ async def search_documents(
         provider = data.get("provider", "openai")
         model = data.get("model", "text-embedding-3-small")
         
+        # Структурные фильтры (тип файла, страницы, даты, ключи метаданных чанка)
+        try:
+            filters = SearchFilters(**data["filters"]) if data.get("filters") else None
+        except (TypeError, ValueError) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid search filters: {str(e)}")
+        
         # Проверяем, что указаны либо коллекции, либо документы
         if not collection_ids and not document_ids:
             raise HTTPException(
@@ -436,7 +444,7 @@ async def search_documents(
         document_service = DocumentService(db)
         
         # Выполняем поиск
-        results = await document_service.search_relevant_chunks(
+        search_result = await document_service.search_chunks(
             query=query,
             user_id=current_user.id,
             collection_ids=collection_ids,
@@ -444,16 +452,85 @@ async def search_documents(
             max_chunks=max_chunks,
             min_similarity=min_similarity,
             provider=provider,
-            model=model
+            model=model,
+            rerank=data.get("rerank"),
+            rerank_budget_ms=data.get("rerank_budget_ms"),
+            filters=filters,
+            expand_parents=data.get("expand_parents")
         )
+        results = search_result["results"]
         
         return {
             "success": True,
             "query": query,
             "results": results,
-            "count": len(results)
+            "count": len(results),
+            "metadata": search_result["metadata"]
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error during document search: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/search/batch", response_model=Dict[str, Any])
+async def search_documents_batch(
+    data: Dict[str, Any] = Body(...),
+    db: Session = Depends(deps.get_db),
+    current_user: User = Depends(deps.get_current_user)
+):
+    """
+    Выполняет семантический поиск сразу по многим запросам в одной области.
+    Основная точка входа для офлайн-оценки RAG: запросы кодируются одним пакетом,
+    а корпус читается один раз для всех запросов.
+    """
+    try:
+        queries = data.get("queries")
+        if not queries or not isinstance(queries, list) or not all(isinstance(q, str) and q.strip() for q in queries):
+            raise HTTPException(status_code=400, detail="A non-empty list of search queries is required")
+        if len(queries) > settings.SEARCH_BATCH_MAX_QUERIES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Too many queries: maximum is {settings.SEARCH_BATCH_MAX_QUERIES}"
+            )
+        
+        collection_ids = data.get("collection_ids", [])
+        document_ids = data.get("document_ids", [])
+        if not collection_ids and not document_ids:
+            raise HTTPException(
+                status_code=400, 
+                detail="At least one collection_id or document_id must be specified"
+            )
+        
+        try:
+            filters = SearchFilters(**data["filters"]) if data.get("filters") else None
+        except (TypeError, ValueError) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid search filters: {str(e)}")
+        
+        document_service = DocumentService(db)
+        search_result = await document_service.search_chunks_batch(
+            queries=queries,
+            user_id=current_user.id,
+            collection_ids=collection_ids,
+            document_ids=document_ids,
+            max_chunks=data.get("max_chunks", 5),
+            min_similarity=data.get("min_similarity", 0.5),
+            provider=data.get("provider", "openai"),
+            model=data.get("model", "text-embedding-3-small"),
+            filters=filters,
+            expand_parents=data.get("expand_parents")
+        )
+        
+        return {
+            "success": True,
+            "results": search_result["results"],
+            "count": len(search_result["results"]),
+            "metadata": search_result["metadata"]
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error during batch document search: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
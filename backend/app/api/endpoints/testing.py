@@ -1,15 +1,32 @@
 from typing import Any, Dict, List, Optional
 from fastapi import APIRouter, Depends, Path, Query, HTTPException, Body
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 from app.api.deps import get_current_active_user, get_db
 from app.db.models.user import User
 from app.db.models.prompt import Prompt
 from app.db.models.analytics import PromptAnalytics
+from app.db.models.test import Test, TestResult
+import re
 import time
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
 from app.core.config import settings
-from app.integrations.llm_clients import get_llm_client
+from app.integrations.llm_clients import get_llm_client, get_user_api_keys
+from app.integrations.openai_compatible import is_openai_compatible
+from app.schemas.test import BatchExecutionCreate
+from app.services.batch_execution import (
+    BatchRequest,
+    batch_custom_id,
+    get_batch_backend,
+    is_batch_test,
+    submit_batch_test
+)
+from app.services.circuit_breaker import provider_health
+from app.services.llm_router import equivalent_routes, served_route
+from app.services.model_catalog import model_catalog
+from app.services.prompt_streaming import SSE_HEADERS, stream_completion
+from app.services.rate_limiter import rate_limited_call
+from app.services.response_cache import CachedRequest, cached_completion
 from app.db.models.user_settings import UserSettings
 import traceback
 import logging
@@ -25,18 +42,24 @@ async def log_successful_test(
     provider: str,
     model: str,
     execution_time: float,
-    usage: Dict[str, Any]
+    usage: Dict[str, Any],
+    cache_info: Optional[Dict[str, Any]] = None
 ):
     """
     Логирует успешное тестирование промпта
+    
+    Провайдер и модель берутся из маршрута запроса: после резерва ответила
+    другая модель, и аналитика должна относиться к ней.
     """
+    provider, model = served_route((cache_info or {}).get("route"), provider, model)
     metrics = {
         "provider": provider,
         "model": model,
         "execution_time": execution_time,
         "timestamp": time.time(),
         "success": True,
-        "usage": usage
+        "usage": usage,
+        **(cache_info or {"cached": False})
     }
     
     analytics_entry = PromptAnalytics(
@@ -121,42 +144,41 @@ async def get_providers(
     db: Session = Depends(get_db)
 ) -> Any:
     """Get information about available LLM providers."""
-    # Get user settings
-    settings = db.query(UserSettings).filter(UserSettings.user_id == current_user.id).first()
-    
-    providers = []
+    # Get user API keys (cached; clients for them are reused across requests)
+    api_keys = get_user_api_keys(db, current_user.id)
     
-    # OpenAI
-    if settings and settings.openai_key:
-        providers.append({
-            "id": "openai",
-            "name": "OpenAI",
-            "models": get_llm_client("openai", settings.openai_key).get_available_models()
-        })
+    # (id, название, API ключ); локальный сервер и mock-провайдер ключа пользователя не требуют
+    available = [
+        (provider_id, name, api_keys.get(provider_id))
+        for provider_id, name in (
+            ("openai", "OpenAI"), ("anthropic", "Anthropic"), ("mistral", "Mistral"),
+            ("google", "Google AI"), ("groq", "Groq"), ("cohere", "Cohere")
+        )
+        if api_keys.get(provider_id)
+    ]
+    if settings.LOCAL_LLM_BASE_URL:
+        available.append(("local", "Local", None))
+    if settings.MOCK_LLM_ENABLED:
+        available.append(("mock", "Mock", None))
     
-    # Anthropic
-    if settings and settings.anthropic_key:
-        providers.append({
-            "id": "anthropic",
-            "name": "Anthropic",
-            "models": get_llm_client("anthropic", settings.anthropic_key).get_available_models()
-        })
-    
-    # Mistral
-    if settings and settings.mistral_key:
+    providers = []
+    for provider_id, name, api_key in available:
+        client = get_llm_client(provider_id, api_key)
+        if not client:
+            continue
+        # Списки моделей берутся из каталога в памяти; сеть - только при первом обращении
+        models = await model_catalog.get_models(provider_id, client)
         providers.append({
-            "id": "mistral",
-            "name": "Mistral",
-            "models": get_llm_client("mistral", settings.mistral_key).get_available_models()
+            "id": provider_id,
+            "name": name,
+            "models": models,
+            "model_details": model_catalog.describe(provider_id, models)
         })
     
-    # Google
-    if settings and settings.google_key:
-        providers.append({
-            "id": "google",
-            "name": "Google AI",
-            "models": get_llm_client("google", settings.google_key).get_available_models()
-        })
+    # Состояние выключателей: модели без запросов в списке не появляются
+    health = provider_health()
+    for provider in providers:
+        provider["health"] = health.get(provider["id"], {"status": "ok", "models": {}})
     
     return {
         "providers": providers
@@ -168,18 +190,57 @@ async def test_prompt(
     provider: str = Query(..., description="The LLM provider"),
     model: str = Query(..., description="The specific model"),
     parameters: Dict[str, Any] = Body({}, description="Model parameters"),
+    stream: bool = Query(False, description="Stream tokens as Server-Sent Events"),
+    bypass_cache: bool = Query(False, description="Skip the response cache lookup"),
     current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
+    if stream:
+        prompt = db.query(Prompt).filter(Prompt.id == prompt_id, Prompt.user_id == current_user.id).first()
+        if not prompt:
+            raise HTTPException(status_code=404, detail=f"Prompt {prompt_id} not found")
+        
+        client = get_llm_client(provider, user=current_user, db=db)
+        if not client:
+            raise HTTPException(status_code=400, detail=f"Provider {provider} not supported")
+        
+        formatted_content = format_prompt_for_provider(prompt.content, provider)
+        cache = CachedRequest(
+            provider, model, formatted_content, parameters,
+            semantic_user_id=current_user.id if prompt.semantic_cache else None,
+            bypass_cache=bypass_cache
+        )
+        alternatives = equivalent_routes(
+            provider, model,
+            lambda target: format_prompt_for_provider(prompt.content, target),
+            user=current_user, db=db
+        )
+        return StreamingResponse(
+            stream_completion(
+                client,
+                formatted_content,
+                model,
+                parameters,
+                prompt_id=prompt_id,
+                user_id=current_user.id,
+                provider=provider,
+                cache=cache,
+                alternatives=alternatives
+            ),
+            media_type="text/event-stream",
+            headers=SSE_HEADERS
+        )
+    
     start_time = time.time()
     response_content = None
     usage = {}
+    cache_info = {"cached": False}
     success = True
     error_message = None
     
     try:
         # Get the prompt
-        prompt = db.query(Prompt).filter(Prompt.id == prompt_id).first()
+        prompt = db.query(Prompt).filter(Prompt.id == prompt_id, Prompt.user_id == current_user.id).first()
         if not prompt:
             raise HTTPException(status_code=404, detail=f"Prompt {prompt_id} not found")
         
@@ -189,8 +250,19 @@ async def test_prompt(
         # Get the appropriate client and process prompt
         try:
             client = get_llm_client(provider, user=current_user, db=db)
-            raw_response = client.process_prompt(formatted_content, model, parameters)
-            response = client.format_response(raw_response)
+            cache = CachedRequest(
+                provider, model, formatted_content, parameters,
+                semantic_user_id=current_user.id if prompt.semantic_cache else None,
+                bypass_cache=bypass_cache
+            )
+            alternatives = equivalent_routes(
+                provider, model,
+                lambda target: format_prompt_for_provider(prompt.content, target),
+                user=current_user, db=db
+            )
+            response, cache_info = await cached_completion(
+                client, cache, owner=current_user.id, alternatives=alternatives
+            )
         except ValueError as e:
             raise HTTPException(status_code=400, detail=str(e))
             
@@ -217,7 +289,8 @@ async def test_prompt(
                 provider=provider,
                 model=model,
                 execution_time=execution_time,
-                usage=usage
+                usage=usage,
+                cache_info=cache_info
             )
         else:
             await log_failed_test(
@@ -239,7 +312,8 @@ async def test_prompt(
             "model": model,
             "execution_time": round(execution_time, 2),
             "success": success,
-            "usage": usage
+            "usage": usage,
+            **cache_info
         }
     }
 
@@ -290,7 +364,9 @@ async def compare_prompt(
         try:
             # Get the appropriate client and process prompt
             client = get_llm_client(provider)
-            raw_response = client.process_prompt(formatted_content, model, parameters)
+            raw_response = await rate_limited_call(
+                client, provider, formatted_content, model, parameters, owner=current_user.id
+            )
             response = client.format_response(raw_response)
             
             # Calculate execution time
@@ -393,50 +469,44 @@ async def compare_prompt_async(
         }
         
         try:
-            # We use a thread pool for CPU-bound tasks that might block
-            with ThreadPoolExecutor() as executor:
-                # Run the API call in a separate thread to avoid blocking the event loop
-                client = get_llm_client(provider)
-                
-                # Execute API call in thread pool
-                loop = asyncio.get_event_loop()
-                raw_response = await loop.run_in_executor(
-                    executor, 
-                    lambda: client.process_prompt(formatted_content, model, parameters)
-                )
-                
-                response = client.format_response(raw_response)
-                
-                # Calculate execution time
-                execution_time = time.time() - start_time
-                
-                # Update metrics with results
-                metrics.update({
-                    "execution_time": execution_time,
-                    "usage": response.get("usage", {}),
-                    "success": True
-                })
-                
-                # Create analytics entry
-                analytics_entry = PromptAnalytics(
-                    prompt_id=prompt.id,
-                    provider=provider,
-                    metrics=metrics,
-                    usage_count=1,
-                    average_response_time=execution_time,
-                    average_token_count=response.get("usage", {}).get("total_tokens", 0)
-                )
-                
-                # Note: We'll add this to the DB outside this function
-                
-                return {
-                    "provider": provider,
-                    "model": model,
-                    "response": response.get("content", "No content returned"),
-                    "metadata": metrics,
-                    "analytics_entry": analytics_entry
-                }
-        
+            # The async client call yields to the event loop, so models run concurrently
+            client = get_llm_client(provider)
+            raw_response = await rate_limited_call(
+                client, provider, formatted_content, model, parameters, owner=current_user.id
+            )
+            
+            response = client.format_response(raw_response)
+            
+            # Calculate execution time
+            execution_time = time.time() - start_time
+            
+            # Update metrics with results
+            metrics.update({
+                "execution_time": execution_time,
+                "usage": response.get("usage", {}),
+                "success": True
+            })
+            
+            # Create analytics entry
+            analytics_entry = PromptAnalytics(
+                prompt_id=prompt.id,
+                provider=provider,
+                metrics=metrics,
+                usage_count=1,
+                average_response_time=execution_time,
+                average_token_count=response.get("usage", {}).get("total_tokens", 0)
+            )
+            
+            # Note: We'll add this to the DB outside this function
+            
+            return {
+                "provider": provider,
+                "model": model,
+                "response": response.get("content", "No content returned"),
+                "metadata": metrics,
+                "analytics_entry": analytics_entry
+            }
+    
         except Exception as e:
             # Log error in metrics
             execution_time = time.time() - start_time
@@ -490,6 +560,157 @@ async def compare_prompt_async(
         "results": results
     }
 
+def batch_test_summary(test: Test, result_count: int) -> Dict[str, Any]:
+    config = test.test_config
+    return {
+        "id": test.id,
+        "name": test.name,
+        "prompt_id": test.prompt_id,
+        "status": test.status,
+        "provider": config.get("provider"),
+        "model": config.get("model"),
+        "total": config.get("total", 0),
+        "succeeded": config.get("succeeded"),
+        "results": result_count,
+        "batch_id": config.get("batch_id"),
+        "batch_status": config.get("batch_status"),
+        "error": config.get("error"),
+        "start_date": test.start_date,
+        "end_date": test.end_date
+    }
+
+def get_user_batch_test(db: Session, test_id: int, user_id: int) -> Test:
+    test = db.query(Test).filter(Test.id == test_id, Test.user_id == user_id).first()
+    if not test or not is_batch_test(test):
+        raise HTTPException(status_code=404, detail="Batch test not found")
+    return test
+
+@router.post("/{prompt_id}/batch")
+async def create_batch_execution(
+    prompt_id: int = Path(..., description="The ID of the prompt to execute"),
+    batch: BatchExecutionCreate = Body(...),
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+) -> Any:
+    """
+    Execute a prompt for many variable sets through the provider batch API.
+    
+    Requests are packaged into one provider batch job (half price, outside the
+    interactive rate limits). Results are written as test results in the
+    background; poll GET /batch/{test_id} for progress.
+    """
+    prompt = db.query(Prompt).filter(Prompt.id == prompt_id, Prompt.user_id == current_user.id).first()
+    if not prompt:
+        raise HTTPException(status_code=404, detail="Prompt not found")
+    
+    if not batch.variables:
+        raise HTTPException(status_code=400, detail="At least one variable set is required")
+    if len(batch.variables) > settings.BATCH_MAX_REQUESTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"A batch may contain at most {settings.BATCH_MAX_REQUESTS} requests"
+        )
+    
+    try:
+        backend = get_batch_backend(batch.provider, get_llm_client(batch.provider, user=current_user, db=db))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    requests = [
+        BatchRequest(
+            custom_id=batch_custom_id(index),
+            model=batch.model,
+            messages=format_prompt_for_provider(prompt.content, batch.provider, variables),
+            parameters=batch.parameters
+        )
+        for index, variables in enumerate(batch.variables)
+    ]
+    
+    try:
+        test = await submit_batch_test(
+            db,
+            backend,
+            user_id=current_user.id,
+            prompt=prompt,
+            provider=batch.provider,
+            model=batch.model,
+            parameters=batch.parameters,
+            requests=requests,
+            variables=batch.variables,
+            name=batch.name
+        )
+    except Exception as e:
+        logging.error(f"Error submitting batch for prompt {prompt_id}: {str(e)}")
+        raise HTTPException(status_code=502, detail=f"Failed to submit batch: {str(e)}")
+    
+    return batch_test_summary(test, 0)
+
+@router.get("/batch/{test_id}")
+async def get_batch_execution(
+    test_id: int = Path(..., description="The ID of the batch test"),
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+) -> Any:
+    """Get the status and progress of a batch execution."""
+    test = get_user_batch_test(db, test_id, current_user.id)
+    result_count = db.query(TestResult).filter(TestResult.test_id == test.id).count()
+    return batch_test_summary(test, result_count)
+
+@router.get("/batch/{test_id}/results")
+async def get_batch_execution_results(
+    test_id: int = Path(..., description="The ID of the batch test"),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+) -> Any:
+    """Get the results of a finished batch execution, in request order."""
+    test = get_user_batch_test(db, test_id, current_user.id)
+    results = db.query(TestResult).filter(
+        TestResult.test_id == test.id
+    ).order_by(TestResult.id).offset(skip).limit(limit).all()
+    
+    return {
+        "total": db.query(TestResult).filter(TestResult.test_id == test.id).count(),
+        "results": [
+            {
+                "id": result.id,
+                "metrics": result.metrics,
+                "response": result.response,
+                "created_at": result.created_at
+            }
+            for result in results
+        ]
+    }
+
+@router.post("/batch/{test_id}/cancel")
+async def cancel_batch_execution(
+    test_id: int = Path(..., description="The ID of the batch test"),
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+) -> Any:
+    """
+    Cancel a running batch execution.
+    
+    Requests the provider has already finished are still written as results
+    once the batch ends; the test then gets the "stopped" status.
+    """
+    test = get_user_batch_test(db, test_id, current_user.id)
+    if test.status != "running":
+        raise HTTPException(status_code=400, detail=f"Batch test is {test.status}")
+    
+    config = test.test_config
+    client = None if config["backend"] == "file" else get_llm_client(config["provider"], user=current_user, db=db)
+    try:
+        backend = get_batch_backend(config["provider"], client, kind=config["backend"])
+        await backend.cancel(config["batch_id"])
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Failed to cancel batch: {str(e)}")
+    
+    test.test_config = {**config, "cancel_requested": True}
+    db.commit()
+    return batch_test_summary(test, 0)
+
 @router.post("/ab-test")
 async def ab_test_prompts(
     prompt_a_id: int = Query(..., description="The ID of the first prompt to test"),
@@ -540,7 +761,9 @@ async def ab_test_prompts(
             
             try:
                 # Process prompt A
-                raw_response_a = client.process_prompt(prompt_a_formatted, model, parameters)
+                raw_response_a = await rate_limited_call(
+                    client, provider, prompt_a_formatted, model, parameters, owner=current_user.id
+                )
                 response_a = client.format_response(raw_response_a)
                 
                 # Calculate metrics for prompt A
@@ -606,7 +829,9 @@ async def ab_test_prompts(
             
             try:
                 # Process prompt B
-                raw_response_b = client.process_prompt(prompt_b_formatted, model, parameters)
+                raw_response_b = await rate_limited_call(
+                    client, provider, prompt_b_formatted, model, parameters, owner=current_user.id
+                )
                 response_b = client.format_response(raw_response_b)
                 
                 # Calculate metrics for prompt B
@@ -801,12 +1026,67 @@ def determine_winner(metrics):
     else:
         return {"winner": "tie", "explanation": "Both prompts performed similarly across all metrics"}
 
-def format_prompt_for_provider(content, provider):
+VARIABLE_PATTERN = re.compile(r"{{([a-zA-Z0-9_]+)}}")
+
+def substitute_variables(text: str, variables: Optional[Dict[str, Any]]) -> str:
+    """Replace {{name}} placeholders with variable values; unknown placeholders are kept as is."""
+    if not variables or not isinstance(text, str):
+        return text
+    return VARIABLE_PATTERN.sub(
+        lambda match: str(variables[match.group(1)]) if match.group(1) in variables else match.group(0),
+        text
+    )
+
+# Разметка кэширования префикса у провайдеров, которым она нужна явно (OpenAI кэширует префикс сам)
+PROVIDER_CACHE_CONTROL = {
+    "anthropic": {"type": "ephemeral"}
+}
+
+def cache_marker(item: Dict[str, Any], provider: str) -> Dict[str, Any]:
+    """Поле cache_control для сообщения, если элемент промпта отмечен cacheable"""
+    cache_control = PROVIDER_CACHE_CONTROL.get(provider)
+    if not item.get("cacheable") or cache_control is None:
+        return {}
+    return {"cache_control": dict(cache_control)}
+
+def mark_stable_prefix(messages: List[Dict[str, Any]], provider: str) -> List[Dict[str, Any]]:
+    """
+    Отмечает длинный системный префикс для кэширования на стороне провайдера
+    
+    Срабатывает, только если автор промпта не отметил ни одного элемента:
+    точкой кэширования становится последнее из начальных системных сообщений.
+    """
+    cache_control = PROVIDER_CACHE_CONTROL.get(provider)
+    if cache_control is None or not settings.PROMPT_CACHE_AUTO_SYSTEM:
+        return messages
+    if any("cache_control" in message for message in messages):
+        return messages
+    
+    prefix_chars = 0
+    last_system = None
+    for index, message in enumerate(messages):
+        if message.get("role") != "system" or not isinstance(message.get("content"), str):
+            break
+        prefix_chars += len(message["content"])
+        last_system = index
+    
+    if last_system is not None and prefix_chars >= settings.PROMPT_CACHE_MIN_CHARS:
+        messages[last_system] = {**messages[last_system], "cache_control": dict(cache_control)}
+    return messages
+
+def format_prompt_for_provider(content, provider, variables: Optional[Dict[str, Any]] = None):
     """Format prompt content based on the provider requirements."""
     formatted_content = []
     
-    if provider == "openai" or provider == "groq":
-        # OpenAI и Groq имеют одинаковый формат
+    if variables:
+        content = [
+            {**item, "content": substitute_variables(item.get("content", ""), variables)}
+            if item.get("type") == "text" else item
+            for item in content
+        ]
+    
+    if provider in ("openai", "groq", "mock") or (is_openai_compatible(provider) and provider != "cohere"):
+        # OpenAI, Groq, mock и локальные OpenAI-совместимые серверы имеют одинаковый формат
         for item in content:
             if item.get("type") == "text":
                 formatted_content.append({
@@ -857,7 +1137,8 @@ def format_prompt_for_provider(content, provider):
                 if item.get("type") == "text":
                     formatted_content.append({
                         "role": item.get("role", "user"),
-                        "content": item.get("content", "")
+                        "content": item.get("content", ""),
+                        **cache_marker(item, provider)
                     })
                 elif item.get("type") == "image":
                     image_url = item.get("url", "")
@@ -891,4 +1172,4 @@ def format_prompt_for_provider(content, provider):
                             "content": f"[Изображение: {item.get('alt_text', '')}]"
                         })
                 
-    return formatted_content
+    return mark_stable_prefix(formatted_content, provider)
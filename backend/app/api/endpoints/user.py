@@ -4,6 +4,7 @@ from sqlalchemy.orm import Session
 from app.api.deps import get_db, get_current_active_user
 from app.db.models.user import User
 from app.db.models.user_settings import UserSettings
+from app.integrations.llm_clients import PROVIDER_KEY_FIELDS, invalidate_user_api_keys
 from pydantic import BaseModel
 
 router = APIRouter()
@@ -60,6 +61,12 @@ def update_user_settings(
         db_settings = UserSettings(user_id=current_user.id)
         db.add(db_settings)
     
+    # Прежние ключи: закэшированные для них клиенты после замены больше не нужны
+    previous_keys = {
+        provider: getattr(db_settings, field)
+        for provider, field in PROVIDER_KEY_FIELDS.items()
+    }
+    
     # Обновить настройки
     db_settings.openai_key = settings_update.openai_key
     db_settings.anthropic_key = settings_update.anthropic_key
@@ -72,6 +79,12 @@ def update_user_settings(
     db.commit()
     db.refresh(db_settings)
     
+    invalidate_user_api_keys(current_user.id, {
+        provider: api_key
+        for provider, api_key in previous_keys.items()
+        if api_key != getattr(db_settings, PROVIDER_KEY_FIELDS[provider])
+    })
+    
     return UserSettingsSchema(
         openai_key=db_settings.openai_key or "",
         anthropic_key=db_settings.anthropic_key or "",
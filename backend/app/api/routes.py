@@ -7,6 +7,7 @@ from app.api.endpoints import (
     templates,
     analytics,
     documents,
+    rag,
     user
 )
 
@@ -17,4 +18,5 @@ api_router.include_router(testing.router, prefix="/tests", tags=["testing"])
 api_router.include_router(templates.router, prefix="/templates", tags=["templates"])
 api_router.include_router(analytics.router, prefix="/analytics", tags=["analytics"])
 api_router.include_router(documents.router, prefix="/documents", tags=["documents"])
+api_router.include_router(rag.router, prefix="/rag", tags=["rag"])
 api_router.include_router(user.router, prefix="/user", tags=["user"]) 
\ No newline at end of file
@@ -14,6 +14,10 @@ class Settings(BaseSettings):
     
     # JWT Settings
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60 * 24 * 8  # 8 days
+
+    # Shared secret for monitoring scrapers of /metrics and /health/providers (X-Metrics-Token header);
+    # without it these endpoints are available to superusers only
+    METRICS_TOKEN: Optional[str] = None
     
     # Database
     DATABASE_URL: str
@@ -25,7 +29,166 @@ class Settings(BaseSettings):
     GOOGLE_AI_API_KEY: Optional[str] = None
     COHERE_API_KEY: Optional[str] = None
     GROQ_API_KEY: Optional[str] = None
-    
+
+    # Provider clients are reused across requests to keep their connection pools warm
+    LLM_CLIENT_CACHE_SIZE: int = 256
+    LLM_CLIENT_CACHE_TTL: int = 60 * 60  # 1 hour
+    USER_SETTINGS_CACHE_SIZE: int = 4096
+    USER_SETTINGS_CACHE_TTL: int = 5 * 60  # 5 minutes; also how long other worker processes keep using a replaced key
+
+    # Model lists are cached per (provider, API key) and refreshed in the background
+    MODEL_CATALOG_REFRESH_ENABLED: bool = True
+    MODEL_CATALOG_REFRESH_INTERVAL: float = 6 * 60 * 60  # 6 hours
+    MODEL_CATALOG_MAX_ENTRIES: int = 256
+    # Lists nobody requested for this long are no longer refreshed and are dropped
+    MODEL_CATALOG_ENTRY_TTL: float = 24 * 60 * 60  # 24 hours
+    # Lists whose key was rejected (401/403) this many times in a row are dropped
+    MODEL_CATALOG_MAX_AUTH_FAILURES: int = 3
+
+    # OpenAI-compatible chat completion endpoints (provider -> base URL), called over pooled httpx clients
+    OPENAI_COMPATIBLE_PROVIDERS: Dict[str, str] = {
+        "groq": "https://api.groq.com/openai/v1",
+        "cohere": "https://api.cohere.ai/compatibility/v1"
+    }
+    # Local inference server (llama.cpp, vLLM, Ollama), e.g. http://localhost:8080/v1; enables provider "local"
+    LOCAL_LLM_BASE_URL: str = ""
+    LOCAL_LLM_API_KEY: Optional[str] = None
+    OPENAI_COMPATIBLE_TIMEOUT: float = 600  # seconds; local models can be slow on long outputs
+    OPENAI_COMPATIBLE_CONNECT_TIMEOUT: float = 10
+    OPENAI_COMPATIBLE_MAX_CONNECTIONS: int = 100
+    OPENAI_COMPATIBLE_MAX_KEEPALIVE: int = 20
+    OPENAI_COMPATIBLE_KEEPALIVE_EXPIRY: float = 30  # seconds an idle connection stays open
+
+    # Per (provider, API key) rate limits: requests and tokens per minute, adaptive concurrency
+    RATE_LIMIT_ENABLED: bool = True
+    RATE_LIMITS: Dict[str, Dict[str, float]] = {
+        "openai": {"rpm": 500, "tpm": 200000},
+        "anthropic": {"rpm": 50, "tpm": 40000},
+        "mistral": {"rpm": 300, "tpm": 500000},
+        "google": {"rpm": 60, "tpm": 1000000},
+        "gemini": {"rpm": 60, "tpm": 1000000},
+        "cohere": {"rpm": 100, "tpm": 100000},
+        "groq": {"rpm": 30, "tpm": 6000},
+        "local": {"rpm": 100000, "tpm": 100000000},
+        "mock": {"rpm": 1000000, "tpm": 1000000000},
+        "default": {"rpm": 60, "tpm": 100000}
+    }
+    RATE_LIMIT_INITIAL_CONCURRENCY: int = 4
+    RATE_LIMIT_MAX_CONCURRENCY: int = 32
+    RATE_LIMIT_MAX_RETRIES: int = 3  # retries after 429 before the error is returned
+    RATE_LIMIT_QUEUE_TIMEOUT: float = 120  # seconds a request may wait for its turn
+
+    # Circuit breaker per (provider, model): fail fast while a provider is failing or too slow
+    CIRCUIT_BREAKER_ENABLED: bool = True
+    CIRCUIT_WINDOW_SECONDS: float = 60  # rolling window of request outcomes
+    CIRCUIT_MIN_REQUESTS: int = 10  # outcomes in the window before the circuit may open
+    CIRCUIT_ERROR_THRESHOLD: float = 0.5  # provider error rate that opens the circuit
+    CIRCUIT_SLOW_CALL_SECONDS: float = 30  # slower responses (time to first event for streams) count as slow
+    CIRCUIT_SLOW_CALL_THRESHOLD: float = 0.8  # slow call rate that opens the circuit
+    CIRCUIT_OPEN_SECONDS: float = 30  # time before probe requests are let through
+    CIRCUIT_HALF_OPEN_PROBES: int = 1  # concurrent probe requests
+    CIRCUIT_PROBE_SUCCESSES: int = 2  # successful probes in a row that close the circuit
+
+    # Latency-aware routing: hedge slow requests past the observed percentile, fall back on errors.
+    # Hedging duplicates billed requests, so it is opt-in.
+    LLM_HEDGING_ENABLED: bool = False
+    LLM_HEDGE_PERCENTILE: float = 0.95
+    LLM_HEDGE_MIN_SAMPLES: int = 20  # no hedging until this many latencies are observed
+    LLM_HEDGE_MIN_DELAY_MS: float = 500
+    LLM_HEDGE_SAME_MODEL: bool = True  # hedge to the same model when it has no equivalents
+    LLM_FALLBACK_ENABLED: bool = True
+    LLM_LATENCY_WINDOW: int = 200  # latencies kept per (provider, model)
+    # "provider:model" -> equivalent "provider:model" targets for hedging and fallback
+    MODEL_EQUIVALENTS: Dict[str, List[str]] = {}
+
+    # Provider-side prompt caching: elements marked "cacheable" in the prompt content become cache
+    # breakpoints; without marks, a long leading system prompt is marked automatically
+    PROMPT_CACHE_AUTO_SYSTEM: bool = True
+    PROMPT_CACHE_MIN_CHARS: int = 4096  # roughly the 1024-token minimum cacheable prefix
+
+    # Built-in mock provider for offline load tests and benchmarks (see app/integrations/mock_llm.py);
+    # the model name selects a profile, unknown models use the defaults.
+    # Opt-in: set MOCK_LLM_ENABLED=true in the environment of load-test setups
+    MOCK_LLM_ENABLED: bool = False
+    MOCK_LLM_SEED: Optional[int] = None  # seed for latency and error sampling, for reproducible runs
+    MOCK_LLM_PROFILES: Dict[str, Dict[str, Any]] = {
+        "mock-instant": {"latency": {"distribution": "fixed", "ms": 0}, "chunk_interval_ms": 0},
+        "mock-fast": {"latency": {"distribution": "lognormal", "median_ms": 300, "sigma": 0.4}},
+        "mock-slow": {
+            "latency": {"distribution": "lognormal", "median_ms": 2000, "sigma": 0.6},
+            "output_tokens": [400, 800],
+            "chunk_interval_ms": 40
+        },
+        "mock-flaky": {
+            "latency": {"distribution": "lognormal", "median_ms": 500, "sigma": 0.8},
+            "error_rate": 0.05,
+            "rate_limit_rate": 0.05
+        }
+    }
+
+    # Offline bulk execution through provider batch APIs (OpenAI Batch, Anthropic Message Batches)
+    BATCH_EXECUTION_ENABLED: bool = True
+    BATCH_POLL_INTERVAL: float = 60  # seconds between status checks of running batches
+    BATCH_MAX_REQUESTS: int = 10000
+    BATCH_FILE_BACKEND_DIR: str = ""  # local file-based batch backend instead of providers (tests, development)
+
+    # Identical LLM requests of one user made while the first is still running wait for its response
+    REQUEST_COALESCING_ENABLED: bool = True
+
+    # Response cache for repeated LLM calls (opt-in): memory LRU + JSON files on disk
+    RESPONSE_CACHE_ENABLED: bool = False
+    RESPONSE_CACHE_SIZE: int = 1024  # responses kept in memory
+    RESPONSE_CACHE_TTL: int = 24 * 60 * 60  # 1 day
+    RESPONSE_CACHE_DIR: str = os.path.join("data", "response_cache")  # empty string disables the disk tier
+    RESPONSE_CACHE_DETERMINISTIC_ONLY: bool = True  # cache only temperature=0 calls
+
+    # Semantic response cache for prompts that opt in (Prompt.semantic_cache)
+    SEMANTIC_CACHE_ENABLED: bool = True
+    SEMANTIC_CACHE_THRESHOLD: float = 0.97  # minimum cosine similarity of normalized prompts
+    SEMANTIC_CACHE_TTL: int = 24 * 60 * 60  # 1 day
+    SEMANTIC_CACHE_BUCKET_SIZE: int = 1024  # entries per (user, provider, model, parameters)
+    SEMANTIC_CACHE_MEMORY_LIMIT_MB: int = 64
+    SEMANTIC_CACHE_LSH_RADIUS: int = 3  # differing SimHash bits allowed for a candidate
+
+    # RAG search caches
+    SEARCH_EMBEDDING_CACHE_SIZE: int = 2048
+    SEARCH_RESULT_CACHE_SIZE: int = 1024
+    SEARCH_RESULT_CACHE_TTL: int = 60 * 60  # 1 hour
+    SEARCH_DOCUMENT_SHORTLIST_SIZE: int = 20  # documents kept by the first retrieval stage, 0 disables it
+    SEARCH_BATCH_MAX_QUERIES: int = 1000
+
+    # Search-as-you-type over WebSocket
+    SEARCH_LIVE_DEBOUNCE_MS: int = 150  # pause before embedding the latest query
+    SEARCH_LIVE_MIN_QUERY_LENGTH: int = 2
+    SEARCH_LIVE_PREFIX_CACHE_SIZE: int = 128  # search scopes with cached lexical candidates
+    SEARCH_LIVE_CANDIDATE_LIMIT: int = 500
+
+    # Small-to-big chunking: small child chunks are embedded and matched,
+    # their parent sections are returned by search
+    CHUNK_HIERARCHY_ENABLED: bool = True
+    CHUNK_CHILD_SIZE: int = 400  # characters
+    CHUNK_PARENT_SIZE: int = 3000  # characters
+    SEARCH_EXPAND_PARENTS: bool = True
+
+    # Background embedding backfill
+    EMBEDDING_BACKFILL_ENABLED: bool = True
+    EMBEDDING_BACKFILL_BATCH_SIZE: int = 256
+    EMBEDDING_BACKFILL_INTERVAL: int = 30  # seconds
+
+    # Cross-encoder reranking of dense search candidates
+    RERANK_ENABLED: bool = False
+    RERANK_MODEL: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+    RERANK_CANDIDATES: int = 20
+    RERANK_BUDGET_MS: float = 300
+    RERANK_BATCH_SIZE: int = 16
+    RERANK_CACHE_SIZE: int = 10000
+
+    # Memory-mapped per-user vector index shards
+    VECTOR_INDEX_ENABLED: bool = True
+    VECTOR_INDEX_DIR: str = os.path.join("data", "vector_index")
+    VECTOR_INDEX_MEMORY_LIMIT_MB: int = 512
+    VECTOR_INDEX_BUILD_WORKERS: int = 1  # background threads rebuilding stale shards
+
     class Config:
         env_file = ".env"
         env_file_encoding = 'utf-8'
@@ -0,0 +1,76 @@
+"""
+In-process metrics registry.
+Counters, gauges and timing summaries are kept per worker process and
+exposed through the /metrics endpoint.
+"""
+import threading
+import logging
+from collections import defaultdict
+from typing import Any, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+class MetricsRegistry:
+    """Thread-safe registry of counters, gauges, timings and collectors"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = defaultdict(float)
+        self._gauges: Dict[str, float] = {}
+        self._timings: Dict[str, Dict[str, float]] = {}
+        self._collectors: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+    def increment(self, name: str, value: float = 1) -> None:
+        """Increase a counter"""
+        with self._lock:
+            self._counters[name] += value
+
+    def set_gauge(self, name: str, value: float) -> None:
+        """Set a gauge to the given value"""
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name: str, value: float) -> None:
+        """Record a timing/size observation"""
+        with self._lock:
+            summary = self._timings.get(name)
+            if summary is None:
+                self._timings[name] = {"count": 1, "sum": value, "min": value, "max": value}
+                return
+            summary["count"] += 1
+            summary["sum"] += value
+            summary["min"] = min(summary["min"], value)
+            summary["max"] = max(summary["max"], value)
+
+    def register_collector(self, name: str, collector: Callable[[], Dict[str, Any]]) -> None:
+        """Register a callable that reports its own stats on every snapshot"""
+        with self._lock:
+            self._collectors[name] = collector
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return all metrics as a JSON-serializable dict"""
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            timings = {
+                name: {**summary, "avg": summary["sum"] / summary["count"]}
+                for name, summary in self._timings.items()
+            }
+            collectors = dict(self._collectors)
+
+        collected = {}
+        for name, collector in collectors.items():
+            try:
+                collected[name] = collector()
+            except Exception as e:
+                logger.error(f"Error collecting metrics from {name}: {str(e)}")
+                collected[name] = {"error": str(e)}
+
+        return {
+            "counters": counters,
+            "gauges": gauges,
+            "timings": timings,
+            "collectors": collected
+        }
+
+metrics = MetricsRegistry()
@@ -1,5 +1,5 @@
 # Import all models to ensure they are registered with Base
-from app.db.models.document import Document, DocumentChunk, DocumentCollection
+from app.db.models.document import Document, DocumentChunk, DocumentCollection, DocumentSection
 from app.db.models.user import User
 from app.db.models.prompt import Prompt, PromptVersion
 from app.db.models.template import Template, TemplateCategory
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, ForeignKey, JSON, Table, Enum
+from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, ForeignKey, JSON, Table, Enum, Index
 from sqlalchemy.orm import relationship
 import enum
 from datetime import datetime
@@ -28,6 +28,7 @@ class DocumentCollection(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(255), index=True)
     description = Column(Text, nullable=True)
+    corpus_version = Column(Integer, default=0, server_default="0", nullable=False)  # Версия состава для ключей кэшей поиска
     
     # Даты создания и обновления
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -47,6 +48,11 @@ class Document(Base):
     """Модель документа для системы RAG"""
     
     __tablename__ = "documents"
+    __table_args__ = (
+        # Поддерживают фильтры поиска по типу файла и дате загрузки в пределах пользователя
+        Index("ix_documents_user_id_file_type", "user_id", "file_type"),
+        Index("ix_documents_user_id_created_at", "user_id", "created_at"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     filename = Column(String(255))
@@ -58,6 +64,9 @@ class Document(Base):
     author = Column(String)
     doc_metadata = Column(JSON, nullable=True)  # JSON-метаданные о документе
     processing_status = Column(Enum(ProcessingStatus), default=ProcessingStatus.PENDING)
+    summary_embedding = Column(Text, nullable=True)  # Сводный вектор документа (среднее чанков + заголовок) для отбора документов
+    summary_embedding_model = Column(String(255), nullable=True)  # Модель, использованная для сводного вектора
+    corpus_version = Column(Integer, default=0, server_default="0", nullable=False)  # Версия чанков и эмбеддингов для ключей кэшей поиска
     
     # Даты создания и обновления
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -67,12 +76,40 @@ class Document(Base):
     user_id = Column(Integer, ForeignKey("users.id"))
     user = relationship("User", back_populates="documents")
     chunks = relationship("DocumentChunk", back_populates="document", cascade="all, delete-orphan")
+    sections = relationship("DocumentSection", back_populates="document", cascade="all, delete-orphan")
     collections = relationship("DocumentCollection", secondary=document_collection_association, back_populates="documents")
 
+class DocumentSection(Base):
+    """Родительская секция документа: крупный связный фрагмент, возвращаемый вместо найденных дочерних чанков"""
+    
+    __tablename__ = "document_sections"
+    __table_args__ = (
+        Index("ix_document_sections_document_id_section_order", "document_id", "section_order"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    document_id = Column(Integer, ForeignKey("documents.id"))
+    content = Column(Text)
+    section_metadata = Column(JSON, nullable=True)  # JSON-метаданные о секции
+    page_number = Column(Integer, nullable=True)
+    section_order = Column(Integer)  # Порядок секции в документе
+    
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    # Связи
+    document = relationship("Document", back_populates="sections")
+    chunks = relationship("DocumentChunk", back_populates="section")
+
 class DocumentChunk(Base):
     """Фрагмент документа с эмбеддингом для векторного поиска"""
     
     __tablename__ = "document_chunks"
+    __table_args__ = (
+        # Выборка чанков документа и фильтр по диапазону страниц
+        Index("ix_document_chunks_document_id_page_number", "document_id", "page_number"),
+        # Карта соседей: выборка чанков документа по порядку при расширении контекста RAG
+        Index("ix_document_chunks_document_id_chunk_order", "document_id", "chunk_order"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     chunk_id = Column(String(255), default=lambda: str(uuid.uuid4()), unique=True)
@@ -83,10 +120,12 @@ class DocumentChunk(Base):
     embedding_model = Column(String(255), nullable=True)  # Модель, использованная для создания эмбеддинга
     page_number = Column(Integer, nullable=True)  # Для документов с постраничной структурой
     chunk_order = Column(Integer)  # Порядок чанка в документе
+    parent_id = Column(Integer, ForeignKey("document_sections.id"), nullable=True, index=True)  # Родительская секция (иерархическое разбиение)
     
     # Даты создания и обновления
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Связи
-    document = relationship("Document", back_populates="chunks") 
\ No newline at end of file
+    document = relationship("Document", back_populates="chunks")
+    section = relationship("DocumentSection", back_populates="chunks")
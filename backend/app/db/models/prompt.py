@@ -1,6 +1,6 @@
 from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, ForeignKey, JSON
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import func
+from sqlalchemy.sql import false, func
 
 from app.db.base_class import Base
 
@@ -13,6 +13,8 @@ class Prompt(Base):
     content = Column(JSON, nullable=False)  # Will store multimodal prompt structure
     version = Column(Integer, default=1)
     is_active = Column(Boolean, default=True)
+    # Opt-in: near-duplicate executions may reuse a cached response (semantic cache)
+    semantic_cache = Column(Boolean, default=False, nullable=False, server_default=false())
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     
@@ -10,7 +10,7 @@ class Test(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True, nullable=False)
     description = Column(Text, nullable=True)
-    status = Column(String, index=True, default="draft")  # draft, running, completed, stopped
+    status = Column(String, index=True, default="draft")  # draft, running, completed, stopped, failed
     start_date = Column(DateTime(timezone=True), nullable=True)
     end_date = Column(DateTime(timezone=True), nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
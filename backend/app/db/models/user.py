@@ -12,6 +12,8 @@ class User(Base):
     full_name = Column(String, index=True, nullable=True)
     is_active = Column(Boolean, default=True)
     is_superuser = Column(Boolean, default=False)
+    # Версия корпуса документов для ключей кэшей поиска и векторного индекса
+    corpus_version = Column(Integer, default=0, server_default="0", nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     
@@ -2,19 +2,66 @@
 Universal clients for various LLM providers.
 This module provides a unified interface for different language model providers.
 """
-from typing import Dict, List, Any, Optional, Union
+from typing import Callable, Dict, List, Any, Optional, Union
+import asyncio
+import hashlib
+import inspect
 import os
 import json
 import time
 import logging
 from app.core.config import settings
+from app.core.metrics import metrics
+from app.utils.cache import LRUCache
+
+# Anthropic accepts at most 4 cache_control breakpoints per request
+ANTHROPIC_MAX_CACHE_BREAKPOINTS = 4
+
+def cache_usage_fields(cache_read_tokens: Optional[int], cache_write_tokens: Optional[int]) -> Dict[str, int]:
+    """
+    Normalized provider prompt cache usage.
+    
+    cache_read_tokens are prompt tokens served from the provider cache,
+    cache_write_tokens are prompt tokens written to it. Both are already
+    included in the prompt/input token count.
+    """
+    return {
+        "cache_read_tokens": cache_read_tokens or 0,
+        "cache_write_tokens": cache_write_tokens or 0
+    }
+
+# Closes scheduled on the event loop; referenced until done so they are not garbage collected
+_pending_closes = set()
+
+def close_quietly(close: Callable[[], Any]) -> None:
+    """
+    Call a sync or async close method, logging instead of raising.
+    
+    Async closes run on the current event loop; outside a loop (e.g. eviction from
+    a worker thread) the coroutine is dropped and the pool is left to garbage collection.
+    """
+    try:
+        result = close()
+        if inspect.isawaitable(result):
+            try:
+                task = asyncio.get_running_loop().create_task(result)
+            except RuntimeError:
+                result.close()
+                return
+            _pending_closes.add(task)
+            task.add_done_callback(_pending_closes.discard)
+    except Exception as e:
+        logging.warning(f"Failed to close LLM client: {str(e)}")
 
 class LLMClientBase:
     """Base class for all LLM clients"""
     
     def __init__(self, api_key: Optional[str] = None):
         self.api_key = api_key
+        # Fingerprint of the key the client was requested with: its key in the client cache
+        self.key_fingerprint = api_key_fingerprint(api_key)
         self.client = None
+        self.async_client = None
         self._setup_client()
     
     def _setup_client(self):
@@ -25,6 +72,30 @@ class LLMClientBase:
         """Process a prompt - to be implemented by subclasses"""
         raise NotImplementedError("Subclasses must implement this method")
     
+    async def aprocess_prompt(self, prompt_data, model, parameters):
+        """
+        Process a prompt without blocking the event loop.
+        
+        Clients with an async SDK override this. The default runs the blocking
+        process_prompt in a worker thread, so async callers stay responsive even
+        for providers that only ship a sync SDK.
+        """
+        return await asyncio.to_thread(self.process_prompt, prompt_data, model, parameters)
+    
+    async def astream_prompt(self, prompt_data, model, parameters):
+        """
+        Stream a completion as it is generated.
+        
+        Yields {"delta": text} for each text fragment and, when the provider
+        reports it, a final {"usage": {...}} in the same format as format_response.
+        The default emits the whole aprocess_prompt result as a single fragment.
+        """
+        response = self.format_response(await self.aprocess_prompt(prompt_data, model, parameters))
+        if response.get("content"):
+            yield {"delta": response["content"]}
+        if response.get("usage"):
+            yield {"usage": response["usage"]}
+    
     def format_response(self, response):
         """Format the response - to be implemented by subclasses"""
         raise NotImplementedError("Subclasses must implement this method")
@@ -32,6 +103,15 @@ class LLMClientBase:
     def get_available_models(self):
         """Get available models - to be implemented by subclasses"""
         raise NotImplementedError("Subclasses must implement this method")
+    
+    def close(self):
+        """Release the connection pools of the SDK clients (called when the client leaves the cache)"""
+        for sdk_client in (self.client, self.async_client):
+            if sdk_client is None or sdk_client is self:
+                continue
+            close = getattr(sdk_client, "aclose", None) or getattr(sdk_client, "close", None)
+            if close is not None:
+                close_quietly(close)
 
 class OpenAIClient(LLMClientBase):
     """Client for OpenAI API"""
@@ -42,9 +122,11 @@ class OpenAIClient(LLMClientBase):
             import openai
             self.api_key = self.api_key or settings.OPENAI_API_KEY
             self.client = openai.Client(api_key=self.api_key)
+            self.async_client = openai.AsyncOpenAI(api_key=self.api_key)
         except Exception as e:
             logging.error(f"Failed to initialize OpenAI client: {str(e)}")
             self.client = None
+            self.async_client = None
     
     def process_prompt(self, prompt_data, model, parameters):
         """Process a prompt using OpenAI API"""
@@ -62,15 +144,58 @@ class OpenAIClient(LLMClientBase):
             logging.error(f"Error calling OpenAI API: {str(e)}")
             raise
     
+    async def aprocess_prompt(self, prompt_data, model, parameters):
+        """Process a prompt using the async OpenAI client"""
+        if not self.async_client:
+            raise ValueError("OpenAI client not initialized")
+        
+        try:
+            return await self.async_client.chat.completions.create(
+                model=model,
+                messages=prompt_data,
+                **parameters
+            )
+        except Exception as e:
+            logging.error(f"Error calling OpenAI API: {str(e)}")
+            raise
+    
+    async def astream_prompt(self, prompt_data, model, parameters):
+        """Stream a completion from OpenAI, requesting usage in the last chunk"""
+        if not self.async_client:
+            raise ValueError("OpenAI client not initialized")
+        
+        try:
+            stream = await self.async_client.chat.completions.create(
+                model=model,
+                messages=prompt_data,
+                stream=True,
+                stream_options={"include_usage": True},
+                **parameters
+            )
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield {"delta": chunk.choices[0].delta.content}
+                if chunk.usage:
+                    yield {"usage": self._format_usage(chunk.usage)}
+        except Exception as e:
+            logging.error(f"Error calling OpenAI API: {str(e)}")
+            raise
+    
+    def _format_usage(self, usage):
+        """Standardized usage; OpenAI caches long prompt prefixes automatically and reports the cached part"""
+        details = getattr(usage, "prompt_tokens_details", None)
+        return {
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "total_tokens": usage.total_tokens,
+            **cache_usage_fields(getattr(details, "cached_tokens", 0), 0)
+        }
+    
     def format_response(self, response):
         """Format OpenAI response to standardized format"""
         return {
             "content": response.choices[0].message.content,
-            "usage": {
-                "prompt_tokens": response.usage.prompt_tokens,
-                "completion_tokens": response.usage.completion_tokens,
-                "total_tokens": response.usage.total_tokens
-            }
+            "usage": self._format_usage(response.usage)
         }
     
     def get_available_models(self):
@@ -103,9 +228,89 @@ class AnthropicClient(LLMClientBase):
                 api_key=self.api_key,
                 default_headers={"anthropic-version": "2023-06-01"}
             )
+            self.async_client = anthropic.AsyncAnthropic(
+                api_key=self.api_key,
+                default_headers={"anthropic-version": "2023-06-01"}
+            )
         except Exception as e:
             logging.error(f"Failed to initialize Anthropic client: {str(e)}")
             self.client = None
+            self.async_client = None
+    
+    def _build_request(self, prompt_data, model, parameters):
+        """Build Messages API arguments, moving system messages to the system field"""
+        # Extract system message if present
+        system = ""
+        messages = []
+        
+        # Логирование входных данных
+        logging.info(f"Anthropic client received prompt_data: {prompt_data}")
+        
+        # Точки кэширования (cache_control из format_prompt_for_provider) сверх лимита
+        # отбрасываются с начала: последняя точка покрывает самый длинный префикс
+        breakpoints = [index for index, item in enumerate(prompt_data) if item.get("cache_control")]
+        kept_breakpoints = set(breakpoints[-ANTHROPIC_MAX_CACHE_BREAKPOINTS:])
+        
+        system_blocks = []
+        for index, item in enumerate(prompt_data):
+            cache_control = item.get("cache_control") if index in kept_breakpoints else None
+            if item.get("role") == "system":
+                system += item.get("content", "") + "\n"
+                block = {"type": "text", "text": item.get("content", "")}
+                if cache_control:
+                    block["cache_control"] = cache_control
+                system_blocks.append(block)
+            elif cache_control:
+                # Кэшируемое сообщение передается блоком с cache_control
+                messages.append({
+                    "role": item.get("role", "user"),
+                    "content": [{"type": "text", "text": item.get("content", ""), "cache_control": cache_control}]
+                })
+            else:
+                messages.append({
+                    "role": item.get("role", "user"),
+                    "content": item.get("content", "")
+                })
+        
+        # Удаляем последний символ новой строки, если он есть
+        if system and system.endswith("\n"):
+            system = system.rstrip()
+        
+        # cache_control задается только у блоков, поэтому кэшируемый system передается списком блоков
+        if any("cache_control" in block for block in system_blocks):
+            system = system_blocks
+        
+        # Логирование обработанных данных
+        logging.info(f"Anthropic system message: {system}")
+        logging.info(f"Anthropic messages: {messages}")
+        
+        # Создаем аргументы для запроса, добавляя system только если он не пустой
+        request_kwargs = {
+            "model": model,
+            "max_tokens": parameters.get("max_tokens", 1000),
+            "temperature": parameters.get("temperature", 0.7),
+            "messages": messages
+        }
+        
+        # Добавляем system только если он не пустой
+        if system:
+            request_kwargs["system"] = system
+        
+        # Логирование запроса
+        logging.info(f"Anthropic request_kwargs: {request_kwargs}")
+        return request_kwargs
+    
+    def _log_error(self, e):
+        # Более детальное логирование ошибок
+        error_type = type(e).__name__
+        error_msg = str(e)
+        
+        if 'authentication_error' in error_msg.lower() or '401' in error_msg:
+            logging.error(f"Anthropic API authentication error: {error_msg}. This may be due to invalid API key or API version.")
+            logging.error(f"API version being used: 2023-06-01")
+            logging.error(f"API key (first 4 chars): {self.api_key[:4]}..." if self.api_key else "No API key")
+        else:
+            logging.error(f"Error calling Anthropic API: {error_type} - {error_msg}")
     
     def process_prompt(self, prompt_data, model, parameters):
         """Process a prompt using Anthropic API"""
@@ -113,70 +318,60 @@ class AnthropicClient(LLMClientBase):
             raise ValueError("Anthropic client not initialized")
         
         try:
-            # Extract system message if present
-            system = ""
-            messages = []
-            
-            # Логирование входных данных
-            logging.info(f"Anthropic client received prompt_data: {prompt_data}")
-            
-            for item in prompt_data:
-                if item.get("role") == "system":
-                    system += item.get("content", "") + "\n"
-                else:
-                    messages.append({
-                        "role": item.get("role", "user"),
-                        "content": item.get("content", "")
-                    })
-            
-            # Удаляем последний символ новой строки, если он есть
-            if system and system.endswith("\n"):
-                system = system.rstrip()
-            
-            # Логирование обработанных данных
-            logging.info(f"Anthropic system message: {system}")
-            logging.info(f"Anthropic messages: {messages}")
-            
-            # Создаем аргументы для запроса, добавляя system только если он не пустой
-            request_kwargs = {
-                "model": model,
-                "max_tokens": parameters.get("max_tokens", 1000),
-                "temperature": parameters.get("temperature", 0.7),
-                "messages": messages
-            }
-            
-            # Добавляем system только если он не пустой
-            if system:
-                request_kwargs["system"] = system
-            
-            # Логирование запроса
-            logging.info(f"Anthropic request_kwargs: {request_kwargs}")
-            
-            response = self.client.messages.create(**request_kwargs)
-            return response
+            return self.client.messages.create(**self._build_request(prompt_data, model, parameters))
         except Exception as e:
-            # Более детальное логирование ошибок
-            error_type = type(e).__name__
-            error_msg = str(e)
-            
-            if 'authentication_error' in error_msg.lower() or '401' in error_msg:
-                logging.error(f"Anthropic API authentication error: {error_msg}. This may be due to invalid API key or API version.")
-                logging.error(f"API version being used: 2023-06-01")
-                logging.error(f"API key (first 4 chars): {self.api_key[:4]}..." if self.api_key else "No API key")
-            else:
-                logging.error(f"Error calling Anthropic API: {error_type} - {error_msg}")
-            
+            self._log_error(e)
             raise
     
+    async def aprocess_prompt(self, prompt_data, model, parameters):
+        """Process a prompt using the async Anthropic client"""
+        if not self.async_client:
+            raise ValueError("Anthropic client not initialized")
+        
+        try:
+            return await self.async_client.messages.create(**self._build_request(prompt_data, model, parameters))
+        except Exception as e:
+            self._log_error(e)
+            raise
+    
+    async def astream_prompt(self, prompt_data, model, parameters):
+        """Stream a completion using the Anthropic streaming helper"""
+        if not self.async_client:
+            raise ValueError("Anthropic client not initialized")
+        
+        try:
+            async with self.async_client.messages.stream(**self._build_request(prompt_data, model, parameters)) as stream:
+                async for text in stream.text_stream:
+                    if text:
+                        yield {"delta": text}
+                message = await stream.get_final_message()
+            yield {"usage": self._format_usage(message.usage)}
+        except Exception as e:
+            self._log_error(e)
+            raise
+    
+    def _format_usage(self, usage):
+        """
+        Standardized usage with prompt cache reads and writes.
+        
+        Anthropic reports cached prompt tokens separately from input_tokens;
+        they are added back so input_tokens is the full prompt size, as for other providers.
+        """
+        cache_read_tokens = getattr(usage, "cache_read_input_tokens", 0) or 0
+        cache_write_tokens = getattr(usage, "cache_creation_input_tokens", 0) or 0
+        input_tokens = usage.input_tokens + cache_read_tokens + cache_write_tokens
+        return {
+            "input_tokens": input_tokens,
+            "output_tokens": usage.output_tokens,
+            "total_tokens": input_tokens + usage.output_tokens,
+            **cache_usage_fields(cache_read_tokens, cache_write_tokens)
+        }
+    
     def format_response(self, response):
         """Format Anthropic response to standardized format"""
         return {
             "content": response.content[0].text,
-            "usage": {
-                "input_tokens": response.usage.input_tokens,
-                "output_tokens": response.usage.output_tokens,
-                "total_tokens": response.usage.input_tokens + response.usage.output_tokens
-            }
+            "usage": self._format_usage(response.usage)
         }
     
     def get_available_models(self):
@@ -197,11 +392,30 @@ class MistralClient(LLMClientBase):
         """Setup the Mistral client"""
         try:
             from mistralai.client import MistralClient
+            from mistralai.async_client import MistralAsyncClient
             self.api_key = self.api_key or settings.MISTRAL_API_KEY
             self.client = MistralClient(api_key=self.api_key)
+            self.async_client = MistralAsyncClient(api_key=self.api_key)
         except Exception as e:
             logging.error(f"Failed to initialize Mistral client: {str(e)}")
             self.client = None
+            self.async_client = None
+    
+    def _build_request(self, prompt_data, model, parameters):
+        """Build chat arguments with Mistral message objects"""
+        from mistralai.models.chat_completion import ChatMessage
+        
+        messages = [
+            ChatMessage(role=item.get("role", "user"), content=item.get("content", ""))
+            for item in prompt_data
+        ]
+        
+        return {
+            "model": model,
+            "messages": messages,
+            "temperature": parameters.get("temperature", 0.7),
+            "max_tokens": parameters.get("max_tokens", 1000)
+        }
     
     def process_prompt(self, prompt_data, model, parameters):
         """Process a prompt using Mistral API"""
@@ -209,20 +423,39 @@ class MistralClient(LLMClientBase):
             raise ValueError("Mistral client not initialized")
         
         try:
-            from mistralai.models.chat_completion import ChatMessage
-            
-            messages = [
-                ChatMessage(role=item.get("role", "user"), content=item.get("content", ""))
-                for item in prompt_data
-            ]
-            
-            response = self.client.chat(
-                model=model,
-                messages=messages,
-                temperature=parameters.get("temperature", 0.7),
-                max_tokens=parameters.get("max_tokens", 1000)
-            )
-            return response
+            return self.client.chat(**self._build_request(prompt_data, model, parameters))
+        except Exception as e:
+            logging.error(f"Error calling Mistral API: {str(e)}")
+            raise
+    
+    async def aprocess_prompt(self, prompt_data, model, parameters):
+        """Process a prompt using the async Mistral client"""
+        if not self.async_client:
+            raise ValueError("Mistral client not initialized")
+        
+        try:
+            return await self.async_client.chat(**self._build_request(prompt_data, model, parameters))
+        except Exception as e:
+            logging.error(f"Error calling Mistral API: {str(e)}")
+            raise
+    
+    async def astream_prompt(self, prompt_data, model, parameters):
+        """Stream a completion using the async Mistral client"""
+        if not self.async_client:
+            raise ValueError("Mistral client not initialized")
+        
+        try:
+            async for chunk in self.async_client.chat_stream(**self._build_request(prompt_data, model, parameters)):
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield {"delta": chunk.choices[0].delta.content}
+                # Usage приходит только в последнем чанке
+                usage = getattr(chunk, "usage", None)
+                if usage:
+                    yield {"usage": {
+                        "input_tokens": usage.prompt_tokens,
+                        "output_tokens": usage.completion_tokens,
+                        "total_tokens": usage.prompt_tokens + usage.completion_tokens
+                    }}
         except Exception as e:
             logging.error(f"Error calling Mistral API: {str(e)}")
             raise
@@ -252,69 +485,130 @@ class GoogleAIClient(LLMClientBase):
     def _setup_client(self):
         """Setup the Google AI client"""
         try:
-            import google.generativeai as genai
+            from google.ai import generativelanguage as glm
             self.api_key = self.api_key or settings.GOOGLE_AI_API_KEY
-            genai.configure(api_key=self.api_key)
-            self.client = genai
+            # genai.configure() is process-global, so cached clients for different users
+            # would share whichever key was configured last. Requests go through this
+            # client's own generative service clients, bound to its key.
+            self.glm = glm
+            self.client = glm.GenerativeServiceClient(client_options={"api_key": self.api_key})
         except Exception as e:
             logging.error(f"Failed to initialize Google AI client: {str(e)}")
             self.client = None
     
+    def _get_async_client(self):
+        """Async service client bound to this client's key, created inside the event loop"""
+        if self.async_client is None:
+            self.async_client = self.glm.GenerativeServiceAsyncClient(client_options={"api_key": self.api_key})
+        return self.async_client
+    
+    def _build_request(self, prompt_data, model, parameters):
+        """Build a GenerateContentRequest for Google AI"""
+        # Extract content for Google AI format
+        prompt = ""
+        system_message = ""
+        
+        for item in prompt_data:
+            if item.get("role") == "system":
+                system_message += item.get("content", "") + "\n"
+            elif item.get("role") == "user":
+                prompt += item.get("content", "") + "\n"
+        
+        # Configure model parameters
+        generation_config = self.glm.GenerationConfig(
+            temperature=parameters.get("temperature", 0.7),
+            max_output_tokens=parameters.get("max_tokens", 1000),
+            top_p=parameters.get("top_p", 0.95)
+        )
+        
+        request = self.glm.GenerateContentRequest(
+            model=model if model.startswith("models/") else f"models/{model}",
+            contents=[self.glm.Content(role="user", parts=[self.glm.Part(text=prompt)])],
+            generation_config=generation_config
+        )
+        if system_message:
+            request.system_instruction = self.glm.Content(parts=[self.glm.Part(text=system_message)])
+        return request
+    
     def process_prompt(self, prompt_data, model, parameters):
         """Process a prompt using Google AI API"""
         if not self.client:
             raise ValueError("Google AI client not initialized")
         
         try:
-            # Extract content for Google AI format
-            prompt = ""
-            system_message = ""
-            
-            for item in prompt_data:
-                if item.get("role") == "system":
-                    system_message += item.get("content", "") + "\n"
-                elif item.get("role") == "user":
-                    prompt += item.get("content", "") + "\n"
-            
-            # Configure model parameters
-            model_config = {
-                "temperature": parameters.get("temperature", 0.7),
-                "max_output_tokens": parameters.get("max_tokens", 1000),
-                "top_p": parameters.get("top_p", 0.95),
-            }
+            return self.client.generate_content(request=self._build_request(prompt_data, model, parameters))
+        except Exception as e:
+            logging.error(f"Error calling Google AI API: {str(e)}")
+            raise
+    
+    async def aprocess_prompt(self, prompt_data, model, parameters):
+        """Process a prompt using the async Google AI service client"""
+        if not self.client:
+            raise ValueError("Google AI client not initialized")
+        
+        try:
+            return await self._get_async_client().generate_content(
+                request=self._build_request(prompt_data, model, parameters)
+            )
+        except Exception as e:
+            logging.error(f"Error calling Google AI API: {str(e)}")
+            raise
+    
+    async def astream_prompt(self, prompt_data, model, parameters):
+        """Stream a completion using the async Google AI service client"""
+        if not self.client:
+            raise ValueError("Google AI client not initialized")
+        
+        try:
+            stream = await self._get_async_client().stream_generate_content(
+                request=self._build_request(prompt_data, model, parameters)
+            )
             
-            # Create model and generate response
-            generation_config = self.client.types.GenerationConfig(**model_config)
-            model_instance = self.client.GenerativeModel(model_name=model, generation_config=generation_config)
+            usage_metadata = None
+            async for chunk in stream:
+                text = self._response_text(chunk)
+                if text:
+                    yield {"delta": text}
+                if chunk.usage_metadata and chunk.usage_metadata.total_token_count:
+                    usage_metadata = chunk.usage_metadata
             
-            if system_message:
-                chat = model_instance.start_chat(system_instruction=system_message)
-                response = chat.send_message(prompt)
-            else:
-                response = model_instance.generate_content(prompt)
-            
-            return response
+            if usage_metadata:
+                yield {"usage": self._format_usage(usage_metadata)}
         except Exception as e:
             logging.error(f"Error calling Google AI API: {str(e)}")
             raise
     
+    @staticmethod
+    def _response_text(response):
+        """Text of the first candidate"""
+        if not response.candidates:
+            return ""
+        return "".join(part.text for part in response.candidates[0].content.parts if part.text)
+    
+    @staticmethod
+    def _format_usage(usage_metadata):
+        input_tokens = usage_metadata.prompt_token_count or 0
+        output_tokens = usage_metadata.candidates_token_count or 0
+        return {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": usage_metadata.total_token_count or input_tokens + output_tokens,
+            **cache_usage_fields(usage_metadata.cached_content_token_count, 0)
+        }
+    
     def format_response(self, response):
         """Format Google AI response to standardized format"""
-        # Handle different response formats from Google AI
-        content = response.text if hasattr(response, 'text') else str(response)
-        
-        # Extract usage information if available
-        usage = {
-            "input_tokens": getattr(response, 'usage', {}).get('prompt_tokens', 0) or 0,
-            "output_tokens": getattr(response, 'usage', {}).get('completion_tokens', 0) or 0,
-            "total_tokens": getattr(response, 'usage', {}).get('total_tokens', 0) or 0
-        }
-        
         return {
-            "content": content,
-            "usage": usage
+            "content": self._response_text(response),
+            "usage": self._format_usage(response.usage_metadata)
         }
     
+    def close(self):
+        """Close the gRPC channels of the service clients"""
+        for service_client in (self.client, self.async_client):
+            if service_client is not None:
+                close_quietly(service_client.transport.close)
+    
     def get_available_models(self):
         """Get available Google AI models"""
         return [
@@ -324,6 +618,112 @@ class GoogleAIClient(LLMClientBase):
             "gemini-1.0-pro-vision"
         ]
 
+# Поле UserSettings с API ключом для каждого провайдера
+PROVIDER_KEY_FIELDS = {
+    "openai": "openai_key",
+    "anthropic": "anthropic_key",
+    "mistral": "mistral_key",
+    "google": "google_key",
+    "gemini": "google_key",
+    "cohere": "cohere_key",
+    "groq": "groq_key"
+}
+
+# Клиенты держат собственные пулы HTTP-соединений, поэтому переиспользуются
+# между запросами: ключ кэша - (провайдер, отпечаток API ключа), сам ключ в нем не хранится.
+# Вытесненные клиенты закрываются; это давно не использованные клиенты, так что
+# незавершенных запросов через них почти не бывает
+_client_cache = LRUCache(
+    max_size=settings.LLM_CLIENT_CACHE_SIZE,
+    ttl=settings.LLM_CLIENT_CACHE_TTL,
+    on_evict=lambda key, client: client.close()
+)
+
+# API ключи из настроек пользователя: {user_id: {провайдер: ключ}}
+_user_keys_cache = LRUCache(max_size=settings.USER_SETTINGS_CACHE_SIZE, ttl=settings.USER_SETTINGS_CACHE_TTL)
+
+def api_key_fingerprint(api_key: Optional[str]) -> str:
+    """Отпечаток API ключа для ключа кэша (None - ключ из глобальных настроек)"""
+    if not api_key:
+        return "default"
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+def get_user_api_keys(db, user_id: int) -> Dict[str, Optional[str]]:
+    """Возвращает API ключи из настроек пользователя (с кэшированием)"""
+    keys = _user_keys_cache.get(user_id)
+    if keys is None:
+        from app.db.models.user_settings import UserSettings
+        
+        user_settings = db.query(UserSettings).filter(UserSettings.user_id == user_id).first()
+        keys = {
+            provider: getattr(user_settings, field, None) if user_settings else None
+            for provider, field in PROVIDER_KEY_FIELDS.items()
+        }
+        _user_keys_cache.set(user_id, keys)
+    return keys
+
+def invalidate_user_api_keys(user_id: int, stale_keys: Optional[Dict[str, Optional[str]]] = None) -> None:
+    """
+    Сбрасывает закэшированные настройки пользователя и клиентов для замененных ключей
+    
+    Кэши живут в памяти процесса, поэтому сбрасываются только в текущем процессе:
+    остальные воркеры продолжают использовать прежний ключ, пока не истечет
+    USER_SETTINGS_CACHE_TTL (после этого они читают новый ключ из БД и создают
+    новый клиент, а старый вытесняется по LLM_CLIENT_CACHE_TTL).
+    
+    Args:
+        user_id: ID пользователя
+        stale_keys: Прежние ключи {провайдер: ключ}, клиенты для которых больше не нужны
+    """
+    _user_keys_cache.pop(user_id)
+    for provider, api_key in (stale_keys or {}).items():
+        if api_key:
+            client = _client_cache.pop((provider, api_key_fingerprint(api_key)))
+            if client is not None:
+                client.close()
+
+def _create_client(provider: str, api_key: Optional[str]):
+    if provider == "openai":
+        return OpenAIClient(api_key=api_key)
+    elif provider == "anthropic":
+        return AnthropicClient(api_key=api_key)
+    elif provider == "mistral":
+        return MistralClient(api_key=api_key)
+    elif provider == "google" or provider == "gemini":
+        return GoogleAIClient(api_key=api_key)
+    elif provider == "mock" and settings.MOCK_LLM_ENABLED:
+        from app.integrations.mock_llm import MockLLMClient
+        return MockLLMClient(api_key=api_key)
+    
+    # Groq, Cohere, локальный сервер инференса и другие OpenAI-совместимые API
+    from app.integrations.openai_compatible import OpenAICompatibleClient, openai_compatible_base_urls
+    base_url = openai_compatible_base_urls().get(provider)
+    if base_url:
+        return OpenAICompatibleClient(provider, base_url, api_key=api_key)
+    
+    logging.warning(f"Неизвестный провайдер LLM: {provider}")
+    return None
+
+def get_cached_llm_client(provider: str, fingerprint: str):
+    """
+    Клиент из кэша по отпечатку ключа, без обращения к настройкам пользователя
+    
+    Клиент с глобальным ключом создается заново, если его вытеснили; клиента
+    с ключом пользователя нет, если ключ заменен или давно не использовался.
+    """
+    provider = provider.lower()
+    if fingerprint == api_key_fingerprint(None):
+        return get_llm_client(provider)
+    return _client_cache.get((provider, fingerprint))
+
+def client_cache_stats() -> Dict[str, Any]:
+    return {
+        "clients": _client_cache.stats(),
+        "user_keys": _user_keys_cache.stats()
+    }
+
+metrics.register_collector("llm_clients", client_cache_stats)
+
 # Factory to create appropriate client instance
 def get_llm_client(provider, api_key=None, user=None, db=None):
     """
@@ -333,45 +733,28 @@ def get_llm_client(provider, api_key=None, user=None, db=None):
     1. Явно переданный ключ
     2. Ключ из настроек пользователя
     3. Ключ из глобальных настроек приложения
+    
+    Клиенты кэшируются по (провайдер, отпечаток ключа), поэтому соединения
+    с провайдером переиспользуются между запросами.
     """
     if not provider:
         return None
     
+    provider = provider.lower()
+    
     # Попытка получить API ключ из настроек пользователя, если передан пользователь и db
     user_api_key = None
-    if user and db:
-        from app.db.models.user_settings import UserSettings
-        
-        user_settings = db.query(UserSettings).filter(UserSettings.user_id == user.id).first()
-        if user_settings:
-            if provider == "openai":
-                user_api_key = user_settings.openai_key
-            elif provider == "anthropic":
-                user_api_key = user_settings.anthropic_key
-            elif provider == "mistral":
-                user_api_key = user_settings.mistral_key
-            elif provider == "google":
-                user_api_key = user_settings.google_key
-            elif provider == "cohere":
-                user_api_key = user_settings.cohere_key
+    if user and db and not api_key:
+        user_api_key = get_user_api_keys(db, user.id).get(provider)
     
     # Используем ключ в следующем порядке: явно переданный -> настройки пользователя -> глобальные настройки
     actual_api_key = api_key or user_api_key
     
-    provider = provider.lower()
-    
-    if provider == "openai":
-        return OpenAIClient(api_key=actual_api_key)
-    elif provider == "anthropic":
-        return AnthropicClient(api_key=actual_api_key)
-    elif provider == "mistral":
-        return MistralClient(api_key=actual_api_key)
-    elif provider == "google" or provider == "gemini":
-        return GoogleAIClient(api_key=actual_api_key)
-    elif provider == "cohere":
-        return CohereClient(api_key=actual_api_key)
-    elif provider == "groq":
-        return GroqClient(api_key=actual_api_key)
-    else:
-        logging.warning(f"Неизвестный провайдер LLM: {provider}")
-        return None 
\ No newline at end of file
+    cache_key = (provider, api_key_fingerprint(actual_api_key))
+    client = _client_cache.get(cache_key)
+    if client is None:
+        client = _create_client(provider, actual_api_key)
+        # Клиент, который не удалось инициализировать, не кэшируем: ошибка может быть временной
+        if client is not None and client.client is not None:
+            _client_cache.set(cache_key, client)
+    return client
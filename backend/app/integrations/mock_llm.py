@@ -0,0 +1,208 @@
+"""
+Mock LLM provider for offline load tests and benchmarks.
+
+The model name selects a profile from settings.MOCK_LLM_PROFILES (unknown
+models use the defaults); a "mock" dict in the request parameters overrides
+profile fields for a single call. A profile controls:
+
+- response: template with {prompt} (last user message) and {model},
+  padded with filler words up to output_tokens (int or [min, max]);
+  with deterministic=True the same request always gets the same text;
+- latency: {"distribution": "fixed", "ms": 200},
+  {"distribution": "lognormal", "median_ms": 300, "sigma": 0.5} or
+  {"distribution": "histogram", "bounds_ms": [...], "counts": [...]}
+  (inline or recorded in a JSON file given as "file");
+  for streams it is the time to first token;
+- chunk_words, chunk_interval_ms: streaming chunk size and cadence;
+- error_rate, rate_limit_rate, retry_after_ms: injected failures
+  (rate limit errors look like provider 429 responses).
+"""
+import asyncio
+import bisect
+import hashlib
+import json
+import math
+import random
+import time
+from itertools import accumulate
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.integrations.llm_clients import LLMClientBase
+from app.services.context_packer import estimate_tokens
+
+DEFAULT_PROFILE: Dict[str, Any] = {
+    "response": "Mock response from {model} to: {prompt}",
+    "deterministic": True,
+    "output_tokens": 64,
+    "latency": {"distribution": "fixed", "ms": 200},
+    "chunk_words": 3,
+    "chunk_interval_ms": 20,
+    "error_rate": 0.0,
+    "rate_limit_rate": 0.0,
+    "retry_after_ms": 1000
+}
+
+FILLER_WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+    "incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud"
+).split()
+
+class MockLLMError(Exception):
+    """Injected provider error; status_code and headers mimic provider SDK errors"""
+
+    def __init__(self, message: str, status_code: int = 500, headers: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.headers = headers or {}
+
+class LatencySampler:
+    """Draws latencies in seconds from a profile's latency distribution"""
+
+    _histograms: Dict[str, Tuple[List[float], List[float]]] = {}
+
+    @classmethod
+    def _histogram(cls, spec: Dict[str, Any]) -> Tuple[List[float], List[float]]:
+        if spec.get("file"):
+            cached = cls._histograms.get(spec["file"])
+            if cached is None:
+                with open(spec["file"], "r", encoding="utf-8") as f:
+                    recorded = json.load(f)
+                cached = cls._histograms.setdefault(spec["file"], cls._histogram(recorded))
+            return cached
+        bounds = [float(bound) for bound in spec["bounds_ms"]]
+        counts = [float(count) for count in spec["counts"]]
+        if len(bounds) != len(counts) or not bounds or sum(counts) <= 0:
+            raise ValueError("Mock latency histogram needs matching non-empty bounds_ms and counts")
+        return bounds, list(accumulate(counts))
+
+    @classmethod
+    def sample(cls, spec: Dict[str, Any], rng: random.Random) -> float:
+        distribution = spec.get("distribution", "fixed")
+        if distribution == "fixed":
+            ms = float(spec.get("ms", 0))
+        elif distribution == "lognormal":
+            ms = float(spec["median_ms"]) * math.exp(rng.gauss(0.0, float(spec.get("sigma", 0.5))))
+        elif distribution == "histogram":
+            # Бакет выбирается по частоте, значение - равномерно между его границами
+            bounds, cumulative = cls._histogram(spec)
+            index = bisect.bisect_right(cumulative, rng.random() * cumulative[-1])
+            index = min(index, len(bounds) - 1)
+            lower = bounds[index - 1] if index > 0 else 0.0
+            ms = rng.uniform(lower, bounds[index])
+        else:
+            raise ValueError(f"Unknown mock latency distribution: {distribution}")
+        return max(ms, 0.0) / 1000
+
+class MockLLMClient(LLMClientBase):
+    """Client for the built-in mock provider"""
+
+    def _setup_client(self):
+        """The mock provider needs no SDK or API key"""
+        self.client = self
+        self.async_client = self
+        self._rng = random.Random(settings.MOCK_LLM_SEED)
+
+    def _profile(self, model, parameters) -> Dict[str, Any]:
+        return {
+            **DEFAULT_PROFILE,
+            **settings.MOCK_LLM_PROFILES.get(model, {}),
+            **(parameters.get("mock") or {})
+        }
+
+    def _plan(self, prompt_data, model, parameters) -> Tuple[Dict[str, Any], float, Optional[MockLLMError]]:
+        """Response, latency and injected error for one request"""
+        profile = self._profile(model, parameters)
+        latency = LatencySampler.sample(profile["latency"], self._rng)
+
+        roll = self._rng.random()
+        error = None
+        if roll < profile["rate_limit_rate"]:
+            error = MockLLMError(
+                "Mock rate limit exceeded",
+                status_code=429,
+                headers={"retry-after-ms": str(profile["retry_after_ms"])}
+            )
+        elif roll < profile["rate_limit_rate"] + profile["error_rate"]:
+            error = MockLLMError("Mock provider error", status_code=500)
+
+        return self._build_response(prompt_data, model, parameters, profile), latency, error
+
+    def _build_response(self, prompt_data, model, parameters, profile) -> Dict[str, Any]:
+        texts = [item.get("content") for item in prompt_data if isinstance(item.get("content"), str)]
+        prompt = next(
+            (item["content"] for item in reversed(prompt_data)
+             if item.get("role", "user") == "user" and isinstance(item.get("content"), str)),
+            ""
+        )
+
+        if profile["deterministic"]:
+            # Текст и длина ответа зависят только от запроса
+            digest = hashlib.sha256(json.dumps([model, prompt_data], sort_keys=True, default=str).encode("utf-8")).digest()
+            rng = random.Random(digest)
+        else:
+            rng = self._rng
+
+        output_tokens = profile["output_tokens"]
+        if isinstance(output_tokens, (list, tuple)):
+            output_tokens = rng.randint(int(output_tokens[0]), int(output_tokens[1]))
+        if parameters.get("max_tokens"):
+            output_tokens = min(output_tokens, int(parameters["max_tokens"]))
+
+        words = profile["response"].replace("{model}", model).replace("{prompt}", prompt).split()
+        # estimate_tokens считает ~1.3 токена на слово
+        target_words = max(1, math.ceil((output_tokens - 1) / 1.3))
+        words = words[:target_words] + [rng.choice(FILLER_WORDS) for _ in range(target_words - len(words))]
+        content = " ".join(words)
+
+        input_tokens = sum(estimate_tokens(text) for text in texts)
+        output_tokens = estimate_tokens(content)
+        return {
+            "content": content,
+            "usage": {
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens
+            }
+        }
+
+    def process_prompt(self, prompt_data, model, parameters):
+        """Return a mock completion after the sampled latency"""
+        response, latency, error = self._plan(prompt_data, model, parameters)
+        time.sleep(latency)
+        if error:
+            raise error
+        return response
+
+    async def aprocess_prompt(self, prompt_data, model, parameters):
+        """Return a mock completion after the sampled latency without blocking the event loop"""
+        response, latency, error = self._plan(prompt_data, model, parameters)
+        await asyncio.sleep(latency)
+        if error:
+            raise error
+        return response
+
+    async def astream_prompt(self, prompt_data, model, parameters):
+        """Stream a mock completion: first chunk after the sampled latency, then at the profile cadence"""
+        response, latency, error = self._plan(prompt_data, model, parameters)
+        profile = self._profile(model, parameters)
+        await asyncio.sleep(latency)
+        if error:
+            raise error
+
+        words = response["content"].split(" ")
+        size = max(1, int(profile["chunk_words"]))
+        for start in range(0, len(words), size):
+            if start:
+                await asyncio.sleep(profile["chunk_interval_ms"] / 1000)
+            chunk = " ".join(words[start:start + size])
+            yield {"delta": chunk if start == 0 else " " + chunk}
+        yield {"usage": response["usage"]}
+
+    def format_response(self, response):
+        """Mock responses are already in the standardized format"""
+        return response
+
+    def get_available_models(self):
+        """Configured mock profiles"""
+        return list(settings.MOCK_LLM_PROFILES) or ["mock"]
@@ -0,0 +1,162 @@
+"""
+Client for OpenAI-compatible chat completion endpoints.
+
+Covers hosted providers that expose the OpenAI wire format (Groq, Cohere's
+compatibility API) and local inference servers (llama.cpp, vLLM, Ollama,
+LM Studio) at settings.LOCAL_LLM_BASE_URL. Requests go straight to
+{base_url}/chat/completions over pooled httpx clients, so connections stay
+alive between requests; no provider SDK is needed.
+"""
+import json
+import logging
+from typing import Any, Dict, Optional
+
+import httpx
+
+from app.core.config import settings
+from app.integrations.llm_clients import LLMClientBase, cache_usage_fields
+
+# Provider -> setting with its global API key
+PROVIDER_API_KEY_SETTINGS = {
+    "groq": "GROQ_API_KEY",
+    "cohere": "COHERE_API_KEY",
+    "local": "LOCAL_LLM_API_KEY"
+}
+
+def openai_compatible_base_urls() -> Dict[str, str]:
+    """Configured OpenAI-compatible providers and their base URLs"""
+    base_urls = dict(settings.OPENAI_COMPATIBLE_PROVIDERS)
+    if settings.LOCAL_LLM_BASE_URL:
+        base_urls["local"] = settings.LOCAL_LLM_BASE_URL
+    return base_urls
+
+def is_openai_compatible(provider: str) -> bool:
+    return provider in openai_compatible_base_urls()
+
+class OpenAICompatibleError(Exception):
+    """Error response from an OpenAI-compatible endpoint; status_code and headers mimic provider SDK errors"""
+
+    def __init__(self, message: str, status_code: int, headers: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.headers = headers or {}
+
+class OpenAICompatibleClient(LLMClientBase):
+    """Client for any OpenAI-compatible /chat/completions endpoint"""
+
+    def __init__(self, provider: str, base_url: str, api_key: Optional[str] = None):
+        self.provider = provider
+        self.base_url = base_url.rstrip("/")
+        super().__init__(api_key=api_key)
+
+    def _setup_client(self):
+        """Setup pooled sync and async HTTP clients with keep-alive"""
+        key_setting = PROVIDER_API_KEY_SETTINGS.get(self.provider)
+        self.api_key = self.api_key or (getattr(settings, key_setting, None) if key_setting else None)
+
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        options = {
+            "base_url": self.base_url,
+            "headers": headers,
+            "timeout": httpx.Timeout(settings.OPENAI_COMPATIBLE_TIMEOUT, connect=settings.OPENAI_COMPATIBLE_CONNECT_TIMEOUT),
+            "limits": httpx.Limits(
+                max_connections=settings.OPENAI_COMPATIBLE_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.OPENAI_COMPATIBLE_MAX_KEEPALIVE,
+                keepalive_expiry=settings.OPENAI_COMPATIBLE_KEEPALIVE_EXPIRY
+            )
+        }
+        self.client = httpx.Client(**options)
+        self.async_client = httpx.AsyncClient(**options)
+
+    def _payload(self, prompt_data, model, parameters, stream: bool = False) -> Dict[str, Any]:
+        payload = {"model": model, "messages": prompt_data, **parameters}
+        if stream:
+            payload["stream"] = True
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+
+    def _error(self, response: httpx.Response) -> OpenAICompatibleError:
+        try:
+            detail = response.json().get("error", response.text)
+            if isinstance(detail, dict):
+                detail = detail.get("message", detail)
+        except ValueError:
+            detail = response.text
+        return OpenAICompatibleError(
+            f"{self.provider} returned {response.status_code}: {str(detail)[:500]}",
+            status_code=response.status_code,
+            headers=dict(response.headers)
+        )
+
+    def process_prompt(self, prompt_data, model, parameters):
+        """Process a prompt with a blocking request"""
+        try:
+            response = self.client.post("/chat/completions", json=self._payload(prompt_data, model, parameters))
+        except httpx.HTTPError as e:
+            logging.error(f"Error calling {self.provider} API at {self.base_url}: {str(e)}")
+            raise
+        if response.is_error:
+            raise self._error(response)
+        return response.json()
+
+    async def aprocess_prompt(self, prompt_data, model, parameters):
+        """Process a prompt with the async client"""
+        try:
+            response = await self.async_client.post("/chat/completions", json=self._payload(prompt_data, model, parameters))
+        except httpx.HTTPError as e:
+            logging.error(f"Error calling {self.provider} API at {self.base_url}: {str(e)}")
+            raise
+        if response.is_error:
+            raise self._error(response)
+        return response.json()
+
+    async def astream_prompt(self, prompt_data, model, parameters):
+        """Stream a completion from server-sent events, requesting usage in the last chunk"""
+        payload = self._payload(prompt_data, model, parameters, stream=True)
+        async with self.async_client.stream("POST", "/chat/completions", json=payload) as response:
+            if response.is_error:
+                await response.aread()
+                raise self._error(response)
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                choices = chunk.get("choices") or []
+                if choices and (choices[0].get("delta") or {}).get("content"):
+                    yield {"delta": choices[0]["delta"]["content"]}
+                if chunk.get("usage"):
+                    yield {"usage": self._format_usage(chunk["usage"])}
+
+    def _format_usage(self, usage):
+        """Standardized usage; servers that cache prompt prefixes report the cached part like OpenAI"""
+        details = usage.get("prompt_tokens_details") or {}
+        return {
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0),
+            "total_tokens": usage.get("total_tokens", 0),
+            **cache_usage_fields(details.get("cached_tokens", 0), 0)
+        }
+
+    def format_response(self, response):
+        """Format an OpenAI-compatible response to standardized format"""
+        return {
+            "content": response["choices"][0]["message"]["content"],
+            "usage": self._format_usage(response.get("usage") or {})
+        }
+
+    def get_available_models(self):
+        """
+        Models served by the endpoint (GET /models)
+
+        Errors propagate: the model catalog keeps the previous list and drops
+        entries whose key is repeatedly rejected.
+        """
+        response = self.client.get("/models")
+        if response.is_error:
+            raise self._error(response)
+        return [model["id"] for model in response.json().get("data", [])]
@@ -75,12 +75,23 @@ class DocumentCollectionRead(DocumentCollectionBase):
 
 # Схемы для поиска в документах
 
+class SearchFilters(BaseModel):
+    """Структурные фильтры поиска, применяемые на этапе отбора кандидатов"""
+    file_types: Optional[List[str]] = None
+    page_from: Optional[int] = Field(None, ge=0)
+    page_to: Optional[int] = Field(None, ge=0)
+    created_after: Optional[datetime] = None
+    created_before: Optional[datetime] = None
+    # Ключ chunk_metadata -> значение или список допустимых значений
+    metadata: Optional[Dict[str, Any]] = None
+
 class DocumentSearchParams(BaseModel):
     query: str
     document_ids: Optional[List[int]] = None
     collection_ids: Optional[List[int]] = None
     max_chunks: Optional[int] = 5
     min_similarity: Optional[float] = 0.7
+    filters: Optional[SearchFilters] = None
 
 class SearchResultItem(BaseModel):
     document_id: int
@@ -88,8 +99,13 @@ class SearchResultItem(BaseModel):
     content: str
     similarity: float
     metadata: Optional[Dict[str, Any]] = None
+    document_name: Optional[str] = None
+    chunk_id: Optional[int] = None
+    chunk_order: Optional[int] = None
+    page_number: Optional[int] = None
 
 class DocumentSearchResult(BaseModel):
     query: str
     results: List[SearchResultItem]
-    count: int 
\ No newline at end of file
+    count: int
+    coverage: Optional[Dict[str, Any]] = None 
\ No newline at end of file
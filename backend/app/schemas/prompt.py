@@ -8,6 +8,8 @@ class TextModalityBase(BaseModel):
     content: str
     role: Optional[str] = None
     variables: Optional[List[str]] = None
+    # Prompt prefix up to and including this element is stable and may be cached by the provider
+    cacheable: Optional[bool] = None
 
 class ImageModalityBase(BaseModel):
     type: str = "image"
@@ -30,6 +32,7 @@ class PromptBase(BaseModel):
     description: Optional[str] = None
     content: List[Dict[str, Any]]
     template_id: Optional[int] = None
+    semantic_cache: bool = False
 
 # Schema for creating a prompt
 class PromptCreate(PromptBase):
@@ -41,6 +44,7 @@ class PromptUpdate(BaseModel):
     description: Optional[str] = None
     content: Optional[List[Dict[str, Any]]] = None
     template_id: Optional[int] = None
+    semantic_cache: Optional[bool] = None
     create_version: Optional[bool] = False
     version_commit_message: Optional[str] = None
 
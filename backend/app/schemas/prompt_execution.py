@@ -14,4 +14,6 @@ class PromptExecutionSchema(BaseModel):
             "top_p": 0.95
         },
         description="Параметры модели"
-    ) 
\ No newline at end of file
+    )
+    stream: bool = Field(False, description="Передавать ответ по мере генерации (Server-Sent Events)")
+    bypass_cache: bool = Field(False, description="Не брать ответ из кэша ответов (свежий ответ сохраняется в кэш)")
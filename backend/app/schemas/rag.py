@@ -2,6 +2,8 @@ from typing import List, Dict, Optional, Any
 from datetime import datetime
 from pydantic import BaseModel, Field, validator
 
+from app.schemas.document import SearchFilters
+
 # Схемы для чанков документов
 class DocumentChunkBase(BaseModel):
     chunk_index: int
@@ -99,6 +101,15 @@ class RagTestCreate(BaseModel):
     min_similarity: Optional[float] = Field(0.5, ge=0, le=1.0)
     embedding_provider: Optional[str] = "openai"
     embedding_model: Optional[str] = "text-embedding-3-small"
+    rerank: Optional[bool] = None
+    rerank_budget_ms: Optional[float] = Field(None, gt=0)
+    filters: Optional[SearchFilters] = None
+    # Возвращать родительские секции вместо найденных дочерних чанков (по умолчанию - из настроек)
+    expand_parents: Optional[bool] = None
+    # Сборка контекста: ограничение бюджета токенов и расширение соседними чанками
+    context_token_budget: Optional[int] = Field(None, ge=1)
+    expand_neighbours: bool = False
+    neighbour_radius: int = Field(1, ge=1, le=3)
     temperature: Optional[float] = Field(0.7, ge=0, le=2.0)
     max_tokens: Optional[int] = Field(2048, ge=1, le=16000)
     top_p: Optional[float] = Field(1.0, ge=0, le=1.0)
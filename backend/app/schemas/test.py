@@ -58,6 +58,14 @@ class TestResult(TestResultBase):
     class Config:
         from_attributes = True
 
+# Схема для массового выполнения через пакетный API провайдера
+class BatchExecutionCreate(BaseModel):
+    provider: str
+    model: str
+    parameters: Dict[str, Any] = {}
+    variables: List[Dict[str, Any]]  # один запрос на каждый набор переменных
+    name: Optional[str] = None
+
 # Информация о токенах
 class TokenInfo(BaseModel):
     input_tokens: int = 0
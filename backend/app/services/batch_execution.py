@@ -0,0 +1,589 @@
+"""
+Массовое выполнение промптов через пакетные API провайдеров.
+
+Большие прогоны оценки не требуют интерактивной задержки: запросы
+упаковываются в пакетное задание провайдера (OpenAI Batch, Anthropic
+Message Batches), которое стоит вдвое дешевле и не расходует обычные
+лимиты запросов. Прогон хранится как Test в режиме "batch"; фоновый
+воркер опрашивает задания и записывает ответы строками TestResult.
+
+Провайдеры скрыты за BatchBackend. FileBatchBackend реализует тот же
+интерфейс на локальных файлах и заменяет провайдера в тестах и при
+разработке (BATCH_FILE_BACKEND_DIR).
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.db.models.analytics import PromptAnalytics
+from app.db.models.test import Test, TestResult, TestVariant
+from app.db.models.user import User
+from app.db.session import SessionLocal
+from app.integrations.llm_clients import get_llm_client
+
+logger = logging.getLogger(__name__)
+
+# Статусы задания, которые возвращает BatchBackend.poll
+BATCH_IN_PROGRESS = "in_progress"
+BATCH_ENDED = "ended"  # все запросы обработаны, отменены или истекли - результаты можно читать
+BATCH_FAILED = "failed"  # задание отклонено целиком, результатов нет
+
+@dataclass
+class BatchRequest:
+    """Один запрос пакета; custom_id связывает его с результатом"""
+    custom_id: str
+    model: str
+    messages: List[Dict[str, Any]]
+    parameters: Dict[str, Any]
+
+class BatchBackend:
+    """Пакетный API: отправка запросов, опрос статуса, чтение результатов"""
+
+    name = "base"
+
+    async def submit(self, requests: List[BatchRequest]) -> str:
+        """Создает задание и возвращает его ID у провайдера"""
+        raise NotImplementedError("Subclasses must implement this method")
+
+    async def poll(self, batch_id: str) -> Dict[str, Any]:
+        """
+        Returns:
+            {"status": BATCH_IN_PROGRESS | BATCH_ENDED | BATCH_FAILED,
+             "provider_status": статус провайдера, "counts": счетчики запросов}
+        """
+        raise NotImplementedError("Subclasses must implement this method")
+
+    async def results(self, batch_id: str) -> List[Dict[str, Any]]:
+        """
+        Returns:
+            Список {"custom_id", "response": ответ в формате format_response или None, "error": текст или None}
+        """
+        raise NotImplementedError("Subclasses must implement this method")
+
+    async def cancel(self, batch_id: str) -> None:
+        """Просит провайдера отменить необработанные запросы"""
+        raise NotImplementedError("Subclasses must implement this method")
+
+class OpenAIBatchBackend(BatchBackend):
+    """OpenAI Batch API: JSONL-файл запросов к /v1/chat/completions"""
+
+    name = "openai"
+    endpoint = "/v1/chat/completions"
+
+    def __init__(self, client):
+        self.client = client
+
+    async def submit(self, requests: List[BatchRequest]) -> str:
+        lines = "\n".join(
+            json.dumps({
+                "custom_id": request.custom_id,
+                "method": "POST",
+                "url": self.endpoint,
+                "body": {"model": request.model, "messages": request.messages, **request.parameters}
+            }, ensure_ascii=False)
+            for request in requests
+        )
+        sdk = self.client.client
+        input_file = await asyncio.to_thread(
+            sdk.files.create, file=("batch.jsonl", lines.encode("utf-8")), purpose="batch"
+        )
+        batch = await asyncio.to_thread(
+            sdk.batches.create,
+            input_file_id=input_file.id,
+            endpoint=self.endpoint,
+            completion_window="24h"
+        )
+        return batch.id
+
+    async def poll(self, batch_id: str) -> Dict[str, Any]:
+        batch = await asyncio.to_thread(self.client.client.batches.retrieve, batch_id)
+        if batch.status == "failed":
+            status = BATCH_FAILED
+        elif batch.status in ("completed", "expired", "cancelled"):
+            status = BATCH_ENDED
+        else:
+            status = BATCH_IN_PROGRESS
+        counts = batch.request_counts
+        return {
+            "status": status,
+            "provider_status": batch.status,
+            "counts": {
+                "total": counts.total,
+                "succeeded": counts.completed,
+                "errored": counts.failed
+            } if counts else {}
+        }
+
+    def _parse_line(self, line: Dict[str, Any]) -> Dict[str, Any]:
+        from openai.types.chat import ChatCompletion
+
+        response = line.get("response") or {}
+        if response.get("status_code") == 200:
+            return {
+                "custom_id": line["custom_id"],
+                "response": self.client.format_response(ChatCompletion.model_validate(response["body"])),
+                "error": None
+            }
+        error = line.get("error") or (response.get("body") or {}).get("error") or "Request failed"
+        return {
+            "custom_id": line["custom_id"],
+            "response": None,
+            "error": error.get("message", str(error)) if isinstance(error, dict) else str(error)
+        }
+
+    async def results(self, batch_id: str) -> List[Dict[str, Any]]:
+        sdk = self.client.client
+        batch = await asyncio.to_thread(sdk.batches.retrieve, batch_id)
+        results = []
+        # Успешные ответы и ошибки отдельных запросов лежат в разных файлах
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            content = await asyncio.to_thread(sdk.files.content, file_id)
+            for line in content.text.splitlines():
+                if line.strip():
+                    results.append(self._parse_line(json.loads(line)))
+        return results
+
+    async def cancel(self, batch_id: str) -> None:
+        await asyncio.to_thread(self.client.client.batches.cancel, batch_id)
+
+class AnthropicBatchBackend(BatchBackend):
+    """Anthropic Message Batches API"""
+
+    name = "anthropic"
+
+    def __init__(self, client):
+        self.client = client
+
+    async def submit(self, requests: List[BatchRequest]) -> str:
+        batch = await asyncio.to_thread(
+            self.client.client.messages.batches.create,
+            requests=[
+                {
+                    "custom_id": request.custom_id,
+                    "params": self.client._build_request(request.messages, request.model, request.parameters)
+                }
+                for request in requests
+            ]
+        )
+        return batch.id
+
+    async def poll(self, batch_id: str) -> Dict[str, Any]:
+        batch = await asyncio.to_thread(self.client.client.messages.batches.retrieve, batch_id)
+        counts = batch.request_counts
+        return {
+            "status": BATCH_ENDED if batch.processing_status == "ended" else BATCH_IN_PROGRESS,
+            "provider_status": batch.processing_status,
+            "counts": {
+                "processing": counts.processing,
+                "succeeded": counts.succeeded,
+                "errored": counts.errored + counts.canceled + counts.expired
+            }
+        }
+
+    def _read_results(self, batch_id: str) -> List[Dict[str, Any]]:
+        results = []
+        for entry in self.client.client.messages.batches.results(batch_id):
+            if entry.result.type == "succeeded":
+                results.append({
+                    "custom_id": entry.custom_id,
+                    "response": self.client.format_response(entry.result.message),
+                    "error": None
+                })
+            else:
+                # errored, canceled или expired
+                error = getattr(entry.result, "error", None)
+                results.append({
+                    "custom_id": entry.custom_id,
+                    "response": None,
+                    "error": str(getattr(error, "error", error) or entry.result.type)
+                })
+        return results
+
+    async def results(self, batch_id: str) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self._read_results, batch_id)
+
+    async def cancel(self, batch_id: str) -> None:
+        await asyncio.to_thread(self.client.client.messages.batches.cancel, batch_id)
+
+class FileBatchBackend(BatchBackend):
+    """
+    Пакетный API на локальных файлах вместо провайдера
+
+    Задание - каталог {directory}/{batch_id}: отправка пишет requests.jsonl
+    ({"custom_id", "model", "messages", "parameters"}). Внешний обработчик
+    (тестовый фейковый сервер) атомарно создает results.jsonl со строками
+    {"custom_id", "response": {"content", "usage"}} или {"custom_id", "error"};
+    с этого момента задание завершено. Отмена создает файл cancelled.
+    """
+
+    name = "file"
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _path(self, batch_id: str, filename: str) -> str:
+        return os.path.join(self.directory, batch_id, filename)
+
+    def _write_requests(self, batch_id: str, requests: List[BatchRequest]) -> None:
+        os.makedirs(os.path.join(self.directory, batch_id), exist_ok=True)
+        with open(self._path(batch_id, "requests.jsonl"), "w", encoding="utf-8") as f:
+            for request in requests:
+                f.write(json.dumps({
+                    "custom_id": request.custom_id,
+                    "model": request.model,
+                    "messages": request.messages,
+                    "parameters": request.parameters
+                }, ensure_ascii=False) + "\n")
+
+    async def submit(self, requests: List[BatchRequest]) -> str:
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        await asyncio.to_thread(self._write_requests, batch_id, requests)
+        return batch_id
+
+    def _status(self, batch_id: str) -> Dict[str, Any]:
+        if os.path.exists(self._path(batch_id, "results.jsonl")):
+            return {"status": BATCH_ENDED, "provider_status": "ended", "counts": {}}
+        if not os.path.exists(self._path(batch_id, "requests.jsonl")):
+            return {"status": BATCH_FAILED, "provider_status": "missing", "counts": {}}
+        if os.path.exists(self._path(batch_id, "cancelled")):
+            # Фейковый сервер так и не ответил: отмененное задание завершается без результатов
+            return {"status": BATCH_ENDED, "provider_status": "cancelled", "counts": {}}
+        return {"status": BATCH_IN_PROGRESS, "provider_status": "in_progress", "counts": {}}
+
+    async def poll(self, batch_id: str) -> Dict[str, Any]:
+        return await asyncio.to_thread(self._status, batch_id)
+
+    def _read_results(self, batch_id: str) -> List[Dict[str, Any]]:
+        path = self._path(batch_id, "results.jsonl")
+        if not os.path.exists(path):
+            return []
+        results = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    results.append({
+                        "custom_id": entry["custom_id"],
+                        "response": entry.get("response"),
+                        "error": entry.get("error")
+                    })
+        return results
+
+    async def results(self, batch_id: str) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self._read_results, batch_id)
+
+    def _mark_cancelled(self, batch_id: str) -> None:
+        if not os.path.isdir(os.path.join(self.directory, batch_id)):
+            raise ValueError(f"Batch {batch_id} not found")
+        open(self._path(batch_id, "cancelled"), "w").close()
+
+    async def cancel(self, batch_id: str) -> None:
+        await asyncio.to_thread(self._mark_cancelled, batch_id)
+
+def get_batch_backend(provider: str, client=None, kind: Optional[str] = None) -> BatchBackend:
+    """
+    Пакетный API для провайдера
+
+    Args:
+        provider: Провайдер LLM
+        client: Клиент провайдера (get_llm_client); для файлового бэкенда не нужен
+        kind: Тип бэкенда из конфигурации теста; None - по настройкам и провайдеру
+
+    Raises:
+        ValueError: Провайдер не поддерживает пакетное выполнение или клиент не настроен
+    """
+    if kind is None:
+        kind = "file" if settings.BATCH_FILE_BACKEND_DIR else provider.lower()
+
+    if kind == "file":
+        return FileBatchBackend(settings.BATCH_FILE_BACKEND_DIR or os.path.join("data", "batches"))
+    if kind not in ("openai", "anthropic"):
+        raise ValueError(f"Provider {provider} does not support batch execution")
+    if client is None or client.client is None:
+        raise ValueError(f"Provider {provider} not supported or API key not configured")
+    if kind == "openai":
+        return OpenAIBatchBackend(client)
+    return AnthropicBatchBackend(client)
+
+def batch_custom_id(index: int) -> str:
+    """custom_id запроса; Anthropic допускает только [a-zA-Z0-9_-]"""
+    return f"item-{index}"
+
+async def submit_batch_test(
+    db: Session,
+    backend: BatchBackend,
+    user_id: int,
+    prompt,
+    provider: str,
+    model: str,
+    parameters: Dict[str, Any],
+    requests: List[BatchRequest],
+    variables: List[Dict[str, Any]],
+    name: Optional[str] = None
+) -> Test:
+    """
+    Создает тест в режиме "batch" и отправляет его запросы в пакетный API
+
+    Args:
+        db: Сессия БД
+        backend: Пакетный API (get_batch_backend)
+        user_id: ID владельца
+        prompt: Промпт (модель БД)
+        provider: Провайдер LLM
+        model: Модель
+        parameters: Параметры модели
+        requests: Запросы пакета, custom_id - batch_custom_id(i)
+        variables: Переменные i-го запроса
+        name: Название теста
+
+    Returns:
+        Тест со статусом running
+    """
+    test = Test(
+        name=name or f"Batch: {prompt.name}",
+        prompt_id=prompt.id,
+        user_id=user_id,
+        status="draft",
+        test_config={
+            "mode": "batch",
+            "backend": backend.name,
+            "provider": provider,
+            "model": model,
+            "parameters": parameters,
+            "total": len(requests),
+            "variables": variables
+        }
+    )
+    test.variants.append(TestVariant(
+        name="default",
+        content={"content": prompt.content, "provider": provider, "model": model}
+    ))
+    db.add(test)
+    db.commit()
+
+    # Тест создается до отправки: задание провайдера не останется без записи в БД
+    try:
+        batch_id = await backend.submit(requests)
+    except Exception as e:
+        test.status = "failed"
+        test.test_config = {**test.test_config, "error": str(e)}
+        db.commit()
+        raise
+
+    test.status = "running"
+    test.start_date = datetime.now(timezone.utc)
+    test.test_config = {**test.test_config, "batch_id": batch_id, "batch_status": {"status": BATCH_IN_PROGRESS}}
+    db.commit()
+    db.refresh(test)
+
+    metrics.increment("llm.batch.submitted")
+    metrics.increment("llm.batch.requests", len(requests))
+    batch_poll_worker.notify()
+    return test
+
+def is_batch_test(test: Test) -> bool:
+    return (test.test_config or {}).get("mode") == "batch"
+
+class BatchPollWorker:
+    """
+    Фоновый воркер, опрашивающий пакетные задания запущенных batch-тестов.
+    Когда задание завершено, его результаты одним коммитом записываются
+    строками TestResult (и PromptAnalytics для учета токенов), а тест
+    получает статус completed, stopped (отменен) или failed.
+
+    Воркеры разных процессов (и проход, совпавший с notify) могут опрашивать
+    один тест одновременно: результаты записывает только тот, кто атомарно
+    перевел тест из running в finalizing.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session] = SessionLocal,
+        poll_interval: float = 60.0
+    ):
+        """
+        Args:
+            session_factory: Фабрика сессий БД
+            poll_interval: Пауза между проходами (в секундах)
+        """
+        self.session_factory = session_factory
+        self.poll_interval = poll_interval
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def start(self) -> None:
+        """Запускает воркер в текущем event loop"""
+        if self._task and not self._task.done():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info("Batch poll worker started")
+
+    async def stop(self) -> None:
+        """Останавливает воркер"""
+        if not self._task:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        logger.info("Batch poll worker stopped")
+
+    def notify(self) -> None:
+        """Будит воркер, например после отправки нового задания"""
+        if self._loop and self._wakeup:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Error in batch poll worker: {str(e)}")
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run_once(self) -> int:
+        """
+        Опрашивает все запущенные batch-тесты
+
+        Returns:
+            Количество тестов, завершенных в этом проходе
+        """
+        db = self.session_factory()
+        try:
+            tests = [test for test in db.query(Test).filter(Test.status == "running").all() if is_batch_test(test)]
+            finished = 0
+            for test in tests:
+                try:
+                    finished += await self.poll_test(db, test)
+                except Exception as e:
+                    # Ошибка опроса одного задания не мешает остальным; повтор - в следующем проходе
+                    db.rollback()
+                    logger.warning(f"Failed to poll batch for test {test.id}: {str(e)}")
+            metrics.set_gauge("llm.batch.running", len(tests) - finished)
+            return finished
+        finally:
+            db.close()
+
+    async def poll_test(self, db: Session, test: Test) -> bool:
+        """Обновляет статус задания теста; возвращает True, если тест завершен"""
+        config = test.test_config
+        user = db.query(User).filter(User.id == test.user_id).first()
+        client = None if config["backend"] == "file" else get_llm_client(config["provider"], user=user, db=db)
+        backend = get_batch_backend(config["provider"], client, kind=config["backend"])
+
+        batch_status = await backend.poll(config["batch_id"])
+        test.test_config = {**config, "batch_status": batch_status}
+
+        if batch_status["status"] == BATCH_IN_PROGRESS:
+            db.commit()
+            return False
+
+        # Результаты читаются до захвата, чтобы не держать блокировку строки во время сетевого запроса
+        results = None
+        if batch_status["status"] == BATCH_ENDED:
+            results = await backend.results(config["batch_id"])
+
+        if not self._claim(db, test):
+            # Тест уже завершает другой воркер
+            db.rollback()
+            return False
+
+        if batch_status["status"] == BATCH_FAILED:
+            test.status = "failed"
+        else:
+            succeeded = self._store_results(db, test, results)
+            test.test_config = {**test.test_config, "succeeded": succeeded}
+            test.status = "stopped" if config.get("cancel_requested") else "completed"
+        test.end_date = datetime.now(timezone.utc)
+        db.commit()
+
+        metrics.increment(f"llm.batch.{test.status}")
+        logger.info(f"Batch test {test.id} finished with status {test.status}")
+        return True
+
+    @staticmethod
+    def _claim(db: Session, test: Test) -> bool:
+        """
+        Атомарно забирает тест на завершение (running -> finalizing)
+
+        Строка остается заблокированной до коммита, поэтому конкурирующий
+        воркер получит 0 строк и не запишет результаты повторно.
+        """
+        claimed = db.query(Test).filter(
+            Test.id == test.id,
+            Test.status == "running"
+        ).update({Test.status: "finalizing"}, synchronize_session=False)
+        return claimed == 1
+
+    def _store_results(self, db: Session, test: Test, results: List[Dict[str, Any]]) -> int:
+        config = test.test_config
+        variant = test.variants[0]
+        by_id = {result["custom_id"]: result for result in results}
+        now = time.time()
+        succeeded = 0
+
+        for index, variables in enumerate(config["variables"]):
+            custom_id = batch_custom_id(index)
+            result = by_id.get(custom_id) or {"response": None, "error": "No result returned by the batch"}
+            response = result["response"]
+            usage = (response or {}).get("usage", {})
+            result_metrics = {
+                "provider": config["provider"],
+                "model": config["model"],
+                "timestamp": now,
+                "batch": True,
+                "custom_id": custom_id,
+                "variables": variables,
+                "success": response is not None,
+                "usage": usage
+            }
+            if response is None:
+                result_metrics["error"] = result["error"]
+
+            db.add(TestResult(
+                test_id=test.id,
+                variant_id=variant.id,
+                metrics=result_metrics,
+                response={"content": response.get("content", "")} if response is not None else None
+            ))
+
+            if response is not None:
+                succeeded += 1
+                # Токены пакетных запусков учитываются в аналитике использования
+                db.add(PromptAnalytics(
+                    prompt_id=test.prompt_id,
+                    user_id=test.user_id,
+                    provider=config["provider"],
+                    metrics=result_metrics,
+                    usage_count=1,
+                    average_token_count=usage.get("total_tokens", 0)
+                ))
+
+        metrics.increment("llm.batch.results", len(config["variables"]))
+        return succeeded
+
+batch_poll_worker = BatchPollWorker(poll_interval=settings.BATCH_POLL_INTERVAL)
@@ -0,0 +1,228 @@
+"""
+Автоматический выключатель (circuit breaker) для пар (провайдер, модель).
+
+В скользящем окне CIRCUIT_WINDOW_SECONDS учитываются исходы запросов:
+ошибки провайдера и медленные ответы (дольше CIRCUIT_SLOW_CALL_SECONDS;
+для потоков - время до первого события). 429 и ошибки самого запроса (4xx)
+о здоровье провайдера не говорят и не учитываются.
+
+- closed: запросы проходят; при доле ошибок или медленных ответов
+  выше порога (и не меньше CIRCUIT_MIN_REQUESTS запросов) - open;
+- open: запросы сразу завершаются CircuitOpenError, не дожидаясь
+  таймаута SDK; маршрутизатор переходит к эквивалентной модели;
+- half_open: через CIRCUIT_OPEN_SECONDS пропускаются пробные запросы;
+  CIRCUIT_PROBE_SUCCESSES успешных подряд - closed, любая неудача - open.
+"""
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+import numpy as np
+
+from app.core.config import settings
+from app.core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Исходов в окне не больше этого числа, даже при очень частых запросах
+MAX_WINDOW_OUTCOMES = 1000
+
+class CircuitOpenError(Exception):
+    """Запрос отклонен без обращения к провайдеру: выключатель разомкнут"""
+
+def is_provider_failure(error: Exception) -> bool:
+    """Ошибка говорит о проблеме провайдера, а не о лимите или некорректном запросе"""
+    from app.services.rate_limiter import is_rate_limit_error
+
+    if isinstance(error, CircuitOpenError) or is_rate_limit_error(error):
+        return False
+    for attribute in ("status_code", "http_status", "status"):
+        status_code = getattr(error, attribute, None)
+        if isinstance(status_code, int):
+            # 408 - таймаут на стороне провайдера; остальные 4xx - ошибка запроса
+            return status_code >= 500 or status_code == 408
+    return True
+
+class CircuitBreaker:
+    """Состояние выключателя одной пары (провайдер, модель)"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.open_until = 0.0
+        self.probes_in_flight = 0
+        self.probe_successes = 0
+        # (время, ошибка, медленный ответ, задержка или None)
+        self._outcomes: Deque[Tuple[float, bool, bool, Optional[float]]] = deque(maxlen=MAX_WINDOW_OUTCOMES)
+        self.rejected = 0
+        self.times_opened = 0
+
+    def _prune(self, now: float) -> None:
+        horizon = now - settings.CIRCUIT_WINDOW_SECONDS
+        while self._outcomes and self._outcomes[0][0] < horizon:
+            self._outcomes.popleft()
+
+    def _rates(self) -> Tuple[int, float, float]:
+        count = len(self._outcomes)
+        if not count:
+            return 0, 0.0, 0.0
+        failures = sum(1 for _, failed, _, _ in self._outcomes if failed)
+        slow = sum(1 for _, _, is_slow, _ in self._outcomes if is_slow)
+        return count, failures / count, slow / count
+
+    def _open(self, now: float, reason: str) -> None:
+        self.state = OPEN
+        self.opened_at = now
+        self.open_until = now + settings.CIRCUIT_OPEN_SECONDS
+        self.probe_successes = 0
+        self.times_opened += 1
+        metrics.increment("llm.circuit.opened")
+        logger.warning(f"Circuit for {self.name} opened: {reason}")
+
+    def _close(self) -> None:
+        self.state = CLOSED
+        self.probe_successes = 0
+        self._outcomes.clear()
+        metrics.increment("llm.circuit.closed")
+        logger.info(f"Circuit for {self.name} closed")
+
+    def before_call(self) -> bool:
+        """
+        Проверяет, можно ли отправить запрос
+
+        Returns:
+            True, если запрос пробный (его слот нужно вернуть через release)
+
+        Raises:
+            CircuitOpenError: Выключатель разомкнут или все пробные слоты заняты
+        """
+        if not settings.CIRCUIT_BREAKER_ENABLED:
+            return False
+        now = time.monotonic()
+        if self.state == OPEN and now >= self.open_until:
+            self.state = HALF_OPEN
+            self.probe_successes = 0
+        if self.state == CLOSED:
+            return False
+        if self.state == HALF_OPEN and self.probes_in_flight < settings.CIRCUIT_HALF_OPEN_PROBES:
+            self.probes_in_flight += 1
+            metrics.increment("llm.circuit.probes")
+            return True
+
+        self.rejected += 1
+        metrics.increment("llm.circuit.rejected")
+        retry_in = max(self.open_until - now, 0.0)
+        raise CircuitOpenError(f"Circuit open for {self.name}, provider is failing; retry in {retry_in:.1f}s")
+
+    def release(self, probe: bool) -> None:
+        """Возвращает слот пробного запроса (в том числе отмененного)"""
+        if probe:
+            self.probes_in_flight = max(self.probes_in_flight - 1, 0)
+
+    def on_success(self, latency: float) -> None:
+        now = time.monotonic()
+        slow = latency > settings.CIRCUIT_SLOW_CALL_SECONDS
+        if self.state == HALF_OPEN:
+            if slow:
+                self._open(now, f"slow probe ({latency:.1f}s)")
+                return
+            self.probe_successes += 1
+            if self.probe_successes >= settings.CIRCUIT_PROBE_SUCCESSES:
+                self._close()
+            return
+        if self.state == OPEN:
+            # Ответ на запрос, начатый до размыкания, состояние не меняет
+            return
+        self._record(now, False, slow, latency)
+
+    def on_failure(self, error: Exception) -> None:
+        if not is_provider_failure(error):
+            return
+        now = time.monotonic()
+        if self.state == HALF_OPEN:
+            self._open(now, f"probe failed: {error}")
+            return
+        if self.state == OPEN:
+            return
+        self._record(now, True, False, None)
+
+    def _record(self, now: float, failed: bool, slow: bool, latency: Optional[float]) -> None:
+        self._outcomes.append((now, failed, slow, latency))
+        self._prune(now)
+        count, error_rate, slow_rate = self._rates()
+        if count < settings.CIRCUIT_MIN_REQUESTS:
+            return
+        if error_rate >= settings.CIRCUIT_ERROR_THRESHOLD:
+            self._open(now, f"error rate {error_rate:.0%} over {count} requests")
+        elif slow_rate >= settings.CIRCUIT_SLOW_CALL_THRESHOLD:
+            self._open(now, f"slow call rate {slow_rate:.0%} over {count} requests")
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        self._prune(now)
+        state = self.state
+        if state == OPEN and now >= self.open_until:
+            # Следующий запрос станет пробным
+            state = HALF_OPEN
+        count, error_rate, slow_rate = self._rates()
+        latencies = [latency for _, _, _, latency in self._outcomes if latency is not None]
+        return {
+            "state": state,
+            "requests": count,
+            "error_rate": round(error_rate, 3),
+            "slow_call_rate": round(slow_rate, 3),
+            "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 1) if latencies else None,
+            "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 1) if latencies else None,
+            "retry_in_seconds": round(self.open_until - now, 1) if state == OPEN else None,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected
+        }
+
+_breakers: Dict[Tuple[str, str], CircuitBreaker] = {}
+
+def get_circuit_breaker(provider: str, model: str) -> CircuitBreaker:
+    """Выключатель для (провайдер, модель)"""
+    key = (provider.lower(), model)
+    breaker = _breakers.get(key)
+    if breaker is None:
+        breaker = _breakers.setdefault(key, CircuitBreaker(f"{key[0]}:{model}"))
+    return breaker
+
+def is_circuit_open(provider: str, model: str) -> bool:
+    """Выключатель разомкнут и запрос к модели будет отклонен"""
+    breaker = _breakers.get((provider.lower(), model))
+    return breaker is not None and breaker.stats()["state"] == OPEN
+
+def provider_health(provider: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Состояние выключателей по провайдерам
+
+    Args:
+        provider: Только этот провайдер; None - все
+
+    Returns:
+        {провайдер: {"status": "ok" | "degraded" | "down", "models": {модель: stats}}}
+    """
+    result: Dict[str, Any] = {}
+    for (name, model), breaker in list(_breakers.items()):
+        if provider is not None and name != provider.lower():
+            continue
+        result.setdefault(name, {"models": {}})["models"][model] = breaker.stats()
+
+    for entry in result.values():
+        states = [model_stats["state"] for model_stats in entry["models"].values()]
+        if all(state == OPEN for state in states):
+            entry["status"] = "down"
+        elif any(state != CLOSED for state in states):
+            entry["status"] = "degraded"
+        else:
+            entry["status"] = "ok"
+    return result
+
+metrics.register_collector("circuit_breaker", provider_health)
@@ -0,0 +1,301 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import or_, and_
+from sqlalchemy.orm import Session
+
+from app.db.models.document import DocumentChunk
+from app.services.model_catalog import model_metadata
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина перекрытия, которую ищем между соседними чанками (в символах).
+# С запасом относительно chunk_overlap по умолчанию (200), т.к. перекрытие собирается
+# из целых параграфов вместе с разделителями.
+MAX_OVERLAP_CHARS = 400
+
+# Короткие совпадения на стыке считаем случайными
+MIN_OVERLAP_CHARS = 20
+
+# Во сколько раз оценка соседнего чанка ниже оценки найденного
+NEIGHBOUR_SCORE_DECAY = 0.5
+
+SPAN_SEPARATOR = "\n\n"
+
+def get_context_window(provider: str, model: str) -> int:
+    """Возвращает размер контекстного окна модели (или консервативное значение по умолчанию)"""
+    return model_metadata(provider, model)["context_window"]
+
+def context_token_budget(
+    provider: str,
+    model: str,
+    prompt_tokens: int,
+    max_output_tokens: int,
+    limit: Optional[int] = None
+) -> int:
+    """
+    Считает, сколько токенов можно отдать под контекст RAG
+
+    Из окна модели вычитаются промпт без контекста и резерв под ответ;
+    limit дополнительно ограничивает бюджет сверху.
+    """
+    budget = get_context_window(provider, model) - prompt_tokens - max_output_tokens
+    if limit is not None:
+        budget = min(budget, limit)
+    return max(budget, 0)
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка количества токенов: ~1.3 токена на слово (как в оценке стоимости)"""
+    if not text:
+        return 0
+    return int(len(text.split()) * 1.3) + 1
+
+def merge_overlapping_text(left: str, right: str, max_overlap: int = MAX_OVERLAP_CHARS) -> str:
+    """
+    Склеивает два соседних фрагмента, убирая общий суффикс/префикс
+
+    Returns:
+        Склеенный текст без дублирования перекрытия
+    """
+    if right in left:
+        return left
+    if left in right:
+        return right
+
+    limit = min(len(left), len(right), max_overlap)
+    for size in range(limit, MIN_OVERLAP_CHARS - 1, -1):
+        if left.endswith(right[:size]):
+            return left + right[size:]
+
+    return left + SPAN_SEPARATOR + right
+
+@dataclass
+class ContextPiece:
+    """Чанк-кандидат для контекста"""
+    document_id: int
+    chunk_order: int
+    content: str
+    score: float
+    chunk_id: Optional[int] = None
+    document_title: Optional[str] = None
+    is_neighbour: bool = False
+
+@dataclass
+class ContextSpan:
+    """Непрерывный фрагмент документа из одного или нескольких соседних чанков"""
+    document_id: int
+    pieces: List[ContextPiece] = field(default_factory=list)
+    content: str = ""
+
+    @property
+    def score(self) -> float:
+        return sum(piece.score for piece in self.pieces)
+
+    @property
+    def best_score(self) -> float:
+        return max(piece.score for piece in self.pieces)
+
+    @property
+    def tokens(self) -> int:
+        return estimate_tokens(self.content)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "document_id": self.document_id,
+            "document_title": self.pieces[0].document_title,
+            "chunk_ids": [piece.chunk_id for piece in self.pieces],
+            "chunk_orders": [piece.chunk_order for piece in self.pieces],
+            "neighbour_chunk_ids": [piece.chunk_id for piece in self.pieces if piece.is_neighbour],
+            "similarity": self.best_score,
+            "tokens": self.tokens
+        }
+
+def merge_into_spans(pieces: Iterable[ContextPiece]) -> List[ContextSpan]:
+    """
+    Объединяет чанки одного документа с соседними chunk_order в непрерывные фрагменты
+
+    Дубликаты (тот же документ и порядок) отбрасываются, перекрытие текста на стыке
+    соседних чанков удаляется.
+    """
+    unique: Dict[Tuple[int, int], ContextPiece] = {}
+    for piece in pieces:
+        key = (piece.document_id, piece.chunk_order)
+        if key not in unique or unique[key].score < piece.score:
+            unique[key] = piece
+
+    spans: List[ContextSpan] = []
+    current: Optional[ContextSpan] = None
+    for key in sorted(unique):
+        piece = unique[key]
+        if (
+            current is not None
+            and current.document_id == piece.document_id
+            and current.pieces[-1].chunk_order + 1 == piece.chunk_order
+        ):
+            current.pieces.append(piece)
+            current.content = merge_overlapping_text(current.content, piece.content)
+        else:
+            current = ContextSpan(document_id=piece.document_id, pieces=[piece], content=piece.content)
+            spans.append(current)
+
+    return spans
+
+def pieces_from_search_results(results: List[Dict[str, Any]]) -> List[ContextPiece]:
+    """Преобразует результаты DocumentService.search_chunks в кандидатов для контекста"""
+    pieces = []
+    for result in results:
+        metadata = result.get("metadata") or {}
+        chunk_order = metadata.get("chunk_index", result.get("chunk_order"))
+        pieces.append(ContextPiece(
+            document_id=result["document_id"],
+            # Чанки без порядка не склеиваются ни с чем
+            chunk_order=chunk_order if chunk_order is not None else -result.get("chunk_id", 0) - 1,
+            content=result.get("content") or "",
+            score=float(result.get("rerank_score", result.get("similarity", 0.0))),
+            chunk_id=result.get("chunk_id"),
+            document_title=result.get("document_title")
+        ))
+    return pieces
+
+def build_adjacency_map(
+    db: Session,
+    pieces: List[ContextPiece],
+    radius: int = 1
+) -> Dict[Tuple[int, int], ContextPiece]:
+    """
+    Загружает соседние чанки (chunk_order ± radius) для найденных чанков одним запросом
+
+    Выборка идет по индексу (document_id, chunk_order).
+
+    Returns:
+        Словарь {(document_id, chunk_order): соседний чанк}
+    """
+    wanted: Dict[int, set] = {}
+    for piece in pieces:
+        if piece.chunk_order < 0:
+            continue
+        orders = wanted.setdefault(piece.document_id, set())
+        for offset in range(1, radius + 1):
+            orders.update((piece.chunk_order - offset, piece.chunk_order + offset))
+
+    if not wanted:
+        return {}
+
+    rows = db.query(
+        DocumentChunk.id,
+        DocumentChunk.document_id,
+        DocumentChunk.chunk_order,
+        DocumentChunk.content
+    ).filter(or_(*[
+        and_(DocumentChunk.document_id == document_id, DocumentChunk.chunk_order.in_(orders))
+        for document_id, orders in wanted.items()
+    ])).all()
+
+    return {
+        (row.document_id, row.chunk_order): ContextPiece(
+            document_id=row.document_id,
+            chunk_order=row.chunk_order,
+            content=row.content or "",
+            score=0.0,
+            chunk_id=row.id,
+            is_neighbour=True
+        )
+        for row in rows
+    }
+
+def _greedy_fill(pieces: List[ContextPiece], budget: int) -> Tuple[List[ContextPiece], int]:
+    """
+    Жадно набирает чанки по убыванию оценки на токен, пока хватает бюджета
+
+    Бюджет считается по склеенным фрагментам, но решение принимается для каждого
+    чанка отдельно: длинная цепочка соседних чанков, не влезающая целиком,
+    попадает в контекст той частью, что помещается.
+    """
+    selected: List[ContextPiece] = []
+    seen = set()
+    used = 0
+    for piece in sorted(pieces, key=lambda piece: piece.score / max(estimate_tokens(piece.content), 1), reverse=True):
+        # Дубликат уже выбранного чанка (с оценкой не выше) ничего не добавляет
+        key = (piece.document_id, piece.chunk_order)
+        if key in seen:
+            continue
+        trial_tokens = sum(span.tokens for span in merge_into_spans(selected + [piece]))
+        if trial_tokens <= budget:
+            selected.append(piece)
+            seen.add(key)
+            used = trial_tokens
+    return selected, used
+
+def pack_context(
+    results: List[Dict[str, Any]],
+    token_budget: int,
+    adjacency: Optional[Dict[Tuple[int, int], ContextPiece]] = None,
+    radius: int = 1
+) -> Dict[str, Any]:
+    """
+    Собирает контекст RAG в пределах бюджета токенов
+
+    1. Чанки набираются жадно по убыванию оценки на токен.
+    2. Выбранные соседние и перекрывающиеся чанки одного документа склеиваются без дублирования.
+    3. Если передана карта соседей, оставшийся бюджет заполняется соседними чанками
+       (с пониженной оценкой), которые приклеиваются к уже выбранным фрагментам.
+
+    Args:
+        results: Результаты поиска (с document_id, content, similarity и chunk_index в metadata)
+        token_budget: Бюджет токенов на контекст
+        adjacency: Карта соседних чанков из build_adjacency_map
+        radius: Насколько далеко (в чанках) расширять найденные фрагменты
+
+    Returns:
+        Словарь с ключами context (текст), spans (выбранные фрагменты) и stats
+    """
+    pieces = pieces_from_search_results(results)
+    raw_tokens = sum(estimate_tokens(piece.content) for piece in pieces)
+
+    spans = merge_into_spans(pieces)
+    selected_pieces, _ = _greedy_fill(pieces, token_budget)
+    selected = merge_into_spans(selected_pieces)
+    dropped_chunks = len({(piece.document_id, piece.chunk_order) for piece in pieces}) - len(selected_pieces)
+
+    neighbours_added = 0
+    if adjacency and selected:
+        present = {(piece.document_id, piece.chunk_order) for piece in pieces}
+        candidates: Dict[Tuple[int, int], ContextPiece] = {}
+        for piece in selected_pieces:
+            for offset in range(1, radius + 1):
+                for key in ((piece.document_id, piece.chunk_order - offset), (piece.document_id, piece.chunk_order + offset)):
+                    neighbour = adjacency.get(key)
+                    if neighbour is None or key in present:
+                        continue
+                    score = piece.score * NEIGHBOUR_SCORE_DECAY ** offset
+                    if key not in candidates or candidates[key].score < score:
+                        candidates[key] = ContextPiece(**{**neighbour.__dict__, "score": score})
+
+        # Добавляем соседей по одному, пока пересобранный контекст помещается в бюджет
+        for neighbour in sorted(candidates.values(), key=lambda piece: piece.score, reverse=True):
+            trial = merge_into_spans(selected_pieces + [neighbour])
+            trial_tokens = sum(span.tokens for span in trial)
+            if trial_tokens <= token_budget:
+                selected_pieces.append(neighbour)
+                neighbours_added += 1
+        selected = merge_into_spans(selected_pieces)
+
+    # Самые релевантные фрагменты идут первыми
+    selected.sort(key=lambda span: span.best_score, reverse=True)
+    context = SPAN_SEPARATOR.join(span.content for span in selected)
+
+    return {
+        "context": context,
+        "spans": [span.to_dict() for span in selected],
+        "stats": {
+            "token_budget": token_budget,
+            "context_tokens": estimate_tokens(context),
+            "raw_tokens": raw_tokens,
+            "input_chunks": len(pieces),
+            "merged_spans": len(spans),
+            "selected_spans": len(selected),
+            "dropped_chunks": dropped_chunks,
+            "neighbours_added": neighbours_added
+        }
+    }
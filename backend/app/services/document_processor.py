@@ -16,9 +16,11 @@ from pathlib import Path
 from pypdf import PdfReader
 import pandas as pd
 from sqlalchemy.orm import Session
-from app.db.models.document import Document, DocumentChunk, ProcessingStatus
+from app.core.config import settings
+from app.db.models.document import Document, DocumentChunk, DocumentSection, ProcessingStatus
 import asyncio
 from app.services.local_embedding_service import LocalEmbeddingService
+from app.services.search_cache import invalidate_document
 import textwrap
 
 logger = logging.getLogger(__name__)
@@ -45,7 +47,10 @@ class DocumentProcessor:
         chunk_overlap: int = 200,
         uploads_dir: Optional[str] = None,
         document_id: int = None,
-        db: Session = None
+        db: Session = None,
+        hierarchical: Optional[bool] = None,
+        child_chunk_size: Optional[int] = None,
+        parent_chunk_size: Optional[int] = None
     ):
         """
         Инициализация процессора документов
@@ -56,9 +61,15 @@ class DocumentProcessor:
             uploads_dir: Директория для временного хранения файлов
             document_id: ID документа
             db: Сессия базы данных
+            hierarchical: Разбивать документ на родительские секции и дочерние чанки
+            child_chunk_size: Максимальный размер дочернего чанка (в символах)
+            parent_chunk_size: Максимальный размер родительской секции (в символах)
         """
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        self.hierarchical = settings.CHUNK_HIERARCHY_ENABLED if hierarchical is None else hierarchical
+        self.child_chunk_size = child_chunk_size or settings.CHUNK_CHILD_SIZE
+        self.parent_chunk_size = parent_chunk_size or settings.CHUNK_PARENT_SIZE
         self.uploads_dir = uploads_dir or os.path.join(tempfile.gettempdir(), "document_uploads")
         
         # Создаем директорию для загрузок, если ее нет
@@ -802,6 +813,105 @@ class DocumentProcessor:
             # Фильтруем пустые секции
             return [s.strip() for s in sections if s.strip()]
     
+    def split_hierarchical(self, text: str, metadata: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Иерархическое разбиение (small-to-big): текст делится на родительские секции
+        по структуре документа, а каждая секция - на мелкие дочерние чанки.
+        
+        Эмбеддинги строятся только для дочерних чанков, поэтому индекс остается
+        компактным, а поиск по ним точнее; в результаты поиска попадают секции.
+        
+        Returns:
+            Список секций с ключами content, section_index, page_number, metadata
+            и children (дочерние чанки в формате split_text)
+        """
+        logger.info(f"Начинаем иерархическое разбиение текста. Размер текста: {len(text)} символов")
+        
+        # Переносы строк сохраняем: по ним _split_by_sections находит заголовки
+        text = re.sub(r'[ \t]+', ' ', text.replace('\r\n', '\n'))
+        text = re.sub(r'\n{3,}', '\n\n', text).strip()
+        
+        # Секции не пересекают границы страниц
+        page_pattern = r'(?:\[Page\s+(\d+)\]|--- Page (\d+) ---|Page (\d+):)'
+        page_markers = list(re.finditer(page_pattern, text))
+        pages = []
+        if page_markers:
+            if page_markers[0].start() > 0:
+                pages.append((None, text[:page_markers[0].start()]))
+            for i, marker in enumerate(page_markers):
+                page_num = next(int(pg) for pg in marker.groups() if pg)
+                end_pos = page_markers[i+1].start() if i+1 < len(page_markers) else len(text)
+                pages.append((page_num, text[marker.end():end_pos]))
+        else:
+            pages.append((None, text))
+        
+        sections = []
+        chunk_order = 0
+        for page_num, page_text in pages:
+            for parent_text in self._group_parent_sections(page_text):
+                section_index = len(sections)
+                children = []
+                chunk_order += self._process_text_segment(
+                    parent_text, children, chunk_order, page_num,
+                    self.child_chunk_size, 1, metadata
+                )
+                for child in children:
+                    child["section_index"] = section_index
+                    child["metadata"]["section_index"] = section_index
+                
+                sections.append({
+                    "content": parent_text,
+                    "section_index": section_index,
+                    "page_number": page_num,
+                    "metadata": {**metadata, "page": page_num, "child_count": len(children)},
+                    "children": children
+                })
+        
+        logger.info(f"Создано {len(sections)} секций и {chunk_order} дочерних чанков документа")
+        return sections
+    
+    def _group_parent_sections(self, text: str) -> List[str]:
+        """
+        Собирает логические секции из _split_by_sections в родительские фрагменты
+        размером не больше parent_chunk_size; заголовок остается вместе со своим текстом.
+        """
+        # Короткие секции (как правило, заголовки) не отрываем от следующего за ними текста
+        header_max_size = 100
+        
+        parents = []
+        current_parts: List[str] = []
+        current_size = 0
+        for section in self._split_by_sections(text):
+            section = section.strip()
+            if not section:
+                continue
+            
+            if current_parts and current_size + len(section) + 2 > self.parent_chunk_size:
+                carried = []
+                if len(current_parts) > 1 and len(current_parts[-1]) < header_max_size:
+                    carried = [current_parts.pop()]
+                parents.append("\n\n".join(current_parts))
+                current_parts = carried
+                current_size = sum(len(part) + 2 for part in carried)
+            
+            if len(section) > self.parent_chunk_size:
+                # Слишком длинную секцию режем по параграфам и предложениям
+                parts = []
+                self._process_text_segment(section, parts, 0, None, self.parent_chunk_size, 1, {})
+                if current_parts:
+                    parts[0]["content"] = "\n\n".join(current_parts + [parts[0]["content"]])
+                    current_parts, current_size = [], 0
+                parents.extend(part["content"] for part in parts)
+                continue
+            
+            current_parts.append(section)
+            current_size += len(section) + 2
+        
+        if current_parts:
+            parents.append("\n\n".join(current_parts))
+        
+        return parents
+    
     def process(self) -> bool:
         """
         Обрабатывает документ: извлекает текст, разбивает на чанки и сохраняет в БД
@@ -845,9 +955,14 @@ class DocumentProcessor:
                 self.db.commit()
                 return False
             
-            # Разбиваем текст на чанки
+            # Разбиваем текст на чанки (или на секции с дочерними чанками)
             logger.info(f"Разбиваем текст на чанки, размер текста: {len(text)}")
-            chunks = self.split_text(text, metadata)
+            sections = None
+            if self.hierarchical:
+                sections = self.split_hierarchical(text, metadata)
+                chunks = [child for section in sections for child in section["children"]]
+            else:
+                chunks = self.split_text(text, metadata)
             logger.info(f"Извлечено {len(chunks)} чанков из документа")
             
             # Создаем эмбеддинги с локальной моделью
@@ -874,13 +989,13 @@ class DocumentProcessor:
                 logger.info(f"Созданы эмбеддинги для {len(chunks_with_embeddings)} чанков")
                 
                 # Сохраняем чанки с эмбеддингами в БД
-                self.save_chunks(chunks_with_embeddings)
+                self.save_chunks(chunks_with_embeddings, sections)
                 
             except Exception as e:
                 logger.exception(f"Ошибка при создании эмбеддингов: {str(e)}")
                 # Если произошла ошибка, сохраняем чанки без эмбеддингов
                 logger.info("Сохраняем чанки без эмбеддингов (будут работать только точные совпадения)")
-                self.save_chunks(chunks)
+                self.save_chunks(chunks, sections)
             
             # Обновляем информацию о документе
             self.document.chunks_count = len(chunks)
@@ -934,13 +1049,34 @@ class DocumentProcessor:
         
         return text, metadata
     
-    def save_chunks(self, chunks: List[Dict[str, Any]]) -> None:
+    def save_chunks(self, chunks: List[Dict[str, Any]], sections: Optional[List[Dict[str, Any]]] = None) -> None:
         """
-        Сохраняет чанки в базу данных.
+        Сохраняет чанки (и родительские секции при иерархическом разбиении) в базу данных.
         """
         try:
-            # Удаляем существующие чанки для этого документа, если они есть
+            # Удаляем существующие чанки и секции для этого документа, если они есть
             self.db.query(DocumentChunk).filter(DocumentChunk.document_id == self.document_id).delete()
+            self.db.query(DocumentSection).filter(DocumentSection.document_id == self.document_id).delete()
+            
+            # Секции сохраняем первыми, чтобы дочерние чанки получили ссылки на них
+            section_rows = {
+                section_data["section_index"]: DocumentSection(
+                    document_id=self.document_id,
+                    content=section_data["content"],
+                    section_order=section_data["section_index"],
+                    page_number=section_data.get("page_number"),
+                    section_metadata=section_data.get("metadata", {})
+                )
+                for section_data in sections or []
+            }
+            self.db.add_all(section_rows.values())
+            self.db.flush()
+            section_ids = {index: section.id for index, section in section_rows.items()}
+            
+            # Сводный вектор пересчитает фоновый воркер, когда у новых чанков появятся эмбеддинги
+            if self.document:
+                self.document.summary_embedding = None
+                self.document.summary_embedding_model = None
             
             # Сохраняем новые чанки
             for chunk_data in chunks:
@@ -952,12 +1088,17 @@ class DocumentProcessor:
                     content=chunk_data["content"],
                     chunk_order=chunk_order,  # Используем правильное имя поля
                     page_number=chunk_data.get("page_number"),
-                    chunk_metadata=chunk_data.get("metadata", {})
+                    chunk_metadata=chunk_data.get("metadata", {}),
+                    parent_id=section_ids.get(chunk_data.get("section_index"))
                 )
                 self.db.add(chunk)
             
             self.db.commit()
             logger.info(f"Сохранено {len(chunks)} чанков в БД для документа ID: {self.document_id}")
+            
+            # Документ разбит заново - результаты поиска по нему устарели
+            if self.document:
+                invalidate_document(self.document)
         except Exception as e:
             logger.exception(f"Ошибка при сохранении чанков: {str(e)}")
             self.db.rollback()
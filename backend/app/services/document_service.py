@@ -1,13 +1,33 @@
+import copy
 import json
 import logging
 from typing import List, Dict, Any, Optional, Tuple
 from sqlalchemy.orm import Session
-from sqlalchemy import desc, or_, func
+from sqlalchemy import desc, or_, func, select
 import numpy as np
 
 from app.db.models.document import Document, DocumentChunk, DocumentCollection
 from app.db.models.user import User
+from app.schemas.document import SearchFilters
 from app.services.embedding_service import EmbeddingService
+from app.services.reranker import reranker
+from app.services.search_cache import search_cache, corpus_versions, invalidate_document
+from app.services.vector_index import scoped_top_k, scoped_top_k_batch
+from app.services.vector_search import (
+    STREAM_BATCH_SIZE,
+    apply_chunk_filters,
+    has_chunk_filters,
+    scoped_document_query,
+    top_k_documents,
+    PARENT_EXPANSION_FACTOR,
+    collapse_to_parents,
+    fetch_chunk_details,
+    fetch_parent_sections,
+    mean_embedding,
+    summary_embedding
+)
+from app.core.config import settings
+from app.core.metrics import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -85,6 +105,9 @@ class DocumentService:
                 self.db.add(chunk)
                 document_chunks.append(chunk)
             
+            # Сводный эмбеддинг документа для двухэтапного поиска
+            await self._set_summary_embedding(document, chunks_with_embeddings)
+            
             # Если указан ID коллекции, добавляем документ в коллекцию
             if collection_id:
                 collection = self.db.query(DocumentCollection).filter(
@@ -102,6 +125,8 @@ class DocumentService:
             self.db.commit()
             self.db.refresh(document)
             
+            invalidate_document(document)
+            
             return document
             
         except Exception as e:
@@ -109,6 +134,28 @@ class DocumentService:
             logger.error(f"Error creating document: {str(e)}")
             raise
     
+    async def _set_summary_embedding(self, document: Document, chunks: List[Dict[str, Any]]) -> None:
+        """
+        Считает сводный эмбеддинг документа: среднее векторов чанков с добавкой эмбеддинга заголовка
+        
+        Если у чанков еще нет эмбеддингов, сводный вектор позже посчитает фоновый воркер.
+        """
+        chunks_mean = mean_embedding(chunk.get("embedding") for chunk in chunks)
+        if chunks_mean is None or not self.embedding_service:
+            return
+        
+        title = (document.title or document.filename or "").strip()
+        title_embedding = None
+        if title:
+            try:
+                title_embeddings = await self.embedding_service.generate_embeddings([title])
+                title_embedding = title_embeddings[0] if title_embeddings else None
+            except Exception as e:
+                logger.warning(f"Error generating title embedding for document {document.id}: {str(e)}")
+        
+        document.summary_embedding = json.dumps(summary_embedding(chunks_mean, title_embedding))
+        document.summary_embedding_model = chunks[0].get("embedding_model") if chunks else None
+    
     def get_document(self, document_id: int, user_id: int) -> Optional[Document]:
         """
         Получает документ по ID
@@ -188,6 +235,10 @@ class DocumentService:
         if not document:
             return False
         
+        # Версию корпуса увеличиваем до удаления, пока доступны коллекции документа;
+        # она фиксируется вместе с удалением
+        invalidate_document(document, commit=False)
+        
         # Удаляем документ (чанки удалятся каскадно)
         self.db.delete(document)
         self.db.commit()
@@ -281,6 +332,8 @@ class DocumentService:
         if not collection:
             return False
         
+        corpus_versions.bump_collection(self.db, user_id, collection_id)
+        
         # Удаляем коллекцию (связи с документами удалятся автоматически)
         self.db.delete(collection)
         self.db.commit()
@@ -323,6 +376,7 @@ class DocumentService:
         
         # Добавляем документ в коллекцию
         document.collections.append(collection)
+        corpus_versions.bump_collection(self.db, user_id, collection_id)
         self.db.commit()
         
         return True
@@ -363,13 +417,88 @@ class DocumentService:
         
         # Удаляем документ из коллекции
         document.collections.remove(collection)
+        corpus_versions.bump_collection(self.db, user_id, collection_id)
         self.db.commit()
         
         return True
     
     # --- Поиск ---
     
-    async def search_relevant_chunks(
+    async def get_query_embedding(
+        self,
+        query: str,
+        provider: str,
+        model: str
+    ) -> Tuple[Optional[List[float]], bool]:
+        """
+        Возвращает эмбеддинг запроса, используя LRU-кэш эмбеддингов
+        
+        Args:
+            query: Текст запроса (эмбеддинг строится по нему, ключ кэша - по нормализованному)
+            provider: Провайдер для генерации эмбеддингов
+            model: Модель для генерации эмбеддингов
+            
+        Returns:
+            Кортеж (эмбеддинг или None, был ли эмбеддинг взят из кэша)
+        """
+        cache_key = search_cache.embedding_key(provider, model, search_cache.normalize_query(query))
+        query_embedding = search_cache.query_embeddings.get(cache_key)
+        if query_embedding is not None:
+            return query_embedding, True
+        
+        embedding_service = EmbeddingService(provider=provider, model=model)
+        query_embeddings = await embedding_service.generate_embeddings([query])
+        
+        if not query_embeddings or len(query_embeddings) == 0:
+            return None, False
+        
+        query_embedding = query_embeddings[0]
+        search_cache.query_embeddings.set(cache_key, query_embedding)
+        return query_embedding, False
+    
+    async def get_query_embeddings(
+        self,
+        queries: List[str],
+        provider: str,
+        model: str
+    ) -> Tuple[List[Optional[List[float]]], int]:
+        """
+        Возвращает эмбеддинги многих запросов: недостающие в кэше создаются одним пакетным вызовом
+        
+        Returns:
+            Кортеж (эмбеддинги в порядке запросов, None для неудавшихся; количество взятых из кэша)
+        """
+        embeddings: List[Optional[List[float]]] = []
+        # Нормализованный запрос -> (исходный текст для эмбеддинга, индексы запросов)
+        missing: Dict[str, Tuple[str, List[int]]] = {}
+        for index, query in enumerate(queries):
+            normalized_query = search_cache.normalize_query(query)
+            embedding = search_cache.query_embeddings.get(
+                search_cache.embedding_key(provider, model, normalized_query)
+            )
+            embeddings.append(embedding)
+            if embedding is None:
+                missing.setdefault(normalized_query, (query, []))[1].append(index)
+        
+        cached_count = len(queries) - sum(len(indices) for _, indices in missing.values())
+        if not missing:
+            return embeddings, cached_count
+        
+        embedding_service = EmbeddingService(provider=provider, model=model)
+        try:
+            new_embeddings = await embedding_service.generate_embeddings([text for text, _ in missing.values()])
+        except Exception as e:
+            logger.error(f"Error generating query embeddings: {str(e)}")
+            return embeddings, cached_count
+        
+        for (normalized_query, (_, indices)), embedding in zip(missing.items(), new_embeddings):
+            search_cache.query_embeddings.set(search_cache.embedding_key(provider, model, normalized_query), embedding)
+            for index in indices:
+                embeddings[index] = embedding
+        
+        return embeddings, cached_count
+    
+    async def search_chunks(
         self,
         query: str,
         user_id: int,
@@ -378,10 +507,29 @@ class DocumentService:
         max_chunks: int = 5,
         min_similarity: float = 0.5,
         provider: str = "openai",
-        model: str = "text-embedding-3-small"
-    ) -> List[Dict[str, Any]]:
+        model: str = "text-embedding-3-small",
+        document_shortlist: Optional[int] = None,
+        rerank: Optional[bool] = None,
+        rerank_budget_ms: Optional[float] = None,
+        filters: Optional[SearchFilters] = None,
+        expand_parents: Optional[bool] = None
+    ) -> Dict[str, Any]:
         """
-        Ищет релевантные чанки документов на основе векторного поиска
+        Ищет релевантные чанки документов и возвращает результаты вместе с метаданными поиска
+        
+        Результаты кэшируются по ключу (пользователь, нормализованный запрос, область,
+        параметры, версия корпуса), поэтому повторный запрос не пересчитывает эмбеддинг
+        и не сканирует чанки, пока документы в области поиска не изменились.
+        
+        Поиск без явного списка документов выполняется в два этапа: сначала по сводным
+        эмбеддингам отбираются document_shortlist документов, затем сравниваются только
+        их чанки. Размер списка задает баланс между скоростью и полнотой поиска.
+        
+        При включенном переранжировании плотный поиск отбирает RERANK_CANDIDATES
+        кандидатов, которые затем упорядочивает cross-encoder в пределах бюджета времени.
+        
+        Для документов с иерархическим разбиением сравниваются мелкие дочерние чанки,
+        а возвращаются их родительские секции без повторов.
         
         Args:
             query: Текстовый запрос
@@ -392,75 +540,344 @@ class DocumentService:
             min_similarity: Минимальное сходство для включения чанка в результаты
             provider: Провайдер для генерации эмбеддингов
             model: Модель для генерации эмбеддингов
+            document_shortlist: Сколько документов отбирать на первом этапе (0 - без отбора)
+            rerank: Переранжировать кандидатов cross-encoder'ом
+            rerank_budget_ms: Бюджет времени на переранжирование в миллисекундах
+            filters: Структурные фильтры (тип файла, страницы, даты, ключи chunk_metadata)
+            expand_parents: Заменять найденные чанки их родительскими секциями
             
         Returns:
-            Список словарей с информацией о релевантных чанках
+            Словарь с ключами results (список чанков) и metadata (сведения о поиске)
         """
-        # Создаем эмбеддинг для запроса
-        embedding_service = EmbeddingService(provider=provider, model=model)
-        query_embeddings = await embedding_service.generate_embeddings([query])
-        
-        if not query_embeddings or len(query_embeddings) == 0:
-            return []
+        if expand_parents is None:
+            expand_parents = settings.SEARCH_EXPAND_PARENTS
+        if document_shortlist is None:
+            document_shortlist = settings.SEARCH_DOCUMENT_SHORTLIST_SIZE
+        if rerank is None:
+            rerank = settings.RERANK_ENABLED
+        if rerank_budget_ms is None:
+            rerank_budget_ms = settings.RERANK_BUDGET_MS
+        
+        normalized_query = search_cache.normalize_query(query)
+        corpus_version = corpus_versions.scope_version(self.db, user_id, collection_ids, document_ids)
+        result_key = search_cache.result_key(
+            user_id,
+            normalized_query,
+            collection_ids,
+            document_ids,
+            {
+                "max_chunks": max_chunks,
+                "min_similarity": min_similarity,
+                "provider": provider,
+                "model": model,
+                "document_shortlist": document_shortlist,
+                "rerank": rerank,
+                "filters": search_cache.filters_key(filters),
+                "expand_parents": expand_parents
+            },
+            corpus_version
+        )
         
-        query_embedding = query_embeddings[0]
+        metadata = {
+            "cache_hit": False,
+            "query_embedding_cached": False,
+            "corpus_version": list(corpus_version)
+        }
+        
+        cached = search_cache.results.get(result_key)
+        if cached is not None:
+            metrics.increment("search.result_cache.hit")
+            metadata["cache_hit"] = True
+            metadata["coverage"] = copy.deepcopy(cached["coverage"])
+            if cached.get("rerank"):
+                metadata["rerank"] = copy.deepcopy(cached["rerank"])
+            return {"results": copy.deepcopy(cached["results"]), "metadata": metadata}
+        metrics.increment("search.result_cache.miss")
+        
+        # Создаем эмбеддинг для запроса (или берем его из кэша)
+        query_embedding, embedding_cached = await self.get_query_embedding(
+            query, provider, model
+        )
+        metadata["query_embedding_cached"] = embedding_cached
+        metrics.increment(
+            "search.embedding_cache.hit" if embedding_cached else "search.embedding_cache.miss"
+        )
         
-        # Получаем чанки документов пользователя
-        chunks_query = self.db.query(DocumentChunk).join(Document).filter(Document.user_id == user_id)
+        if query_embedding is None:
+            return {"results": [], "metadata": metadata}
         
-        # Фильтрация по коллекциям
-        if collection_ids:
-            chunks_query = chunks_query.join(Document.collections).filter(
-                DocumentCollection.id.in_(collection_ids)
-            ).group_by(DocumentChunk.id)
+        # Первый этап: для поиска по коллекциям отбираем документы по сводным эмбеддингам
+        scope_document_ids, scope_collection_ids = document_ids, collection_ids
+        if not document_ids and document_shortlist > 0:
+            candidate_ids, shortlist_info = self.shortlist_documents(
+                user_id, collection_ids, query_embedding, document_shortlist, filters
+            )
+            metadata["document_shortlist"] = shortlist_info
+            if candidate_ids is not None:
+                if not candidate_ids:
+                    return {"results": [], "metadata": metadata}
+                scope_document_ids, scope_collection_ids = candidate_ids, None
+        
+        # Для переранжирования и схлопывания в секции плотный поиск отбирает больше кандидатов
+        dense_k = max_chunks * PARENT_EXPANSION_FACTOR if expand_parents else max_chunks
+        if rerank:
+            dense_k = max(dense_k, settings.RERANK_CANDIDATES)
+        
+        # Поиск по шарду индекса пользователя (или потоковое сканирование БД);
+        # чанки без эмбеддингов пропускаются, покрытие возвращаем в метаданных
+        top_chunks, coverage = scoped_top_k(
+            self.db,
+            user_id,
+            query_embedding,
+            dense_k,
+            min_similarity,
+            document_ids=scope_document_ids,
+            collection_ids=scope_collection_ids,
+            filters=filters
+        )
+        metadata["coverage"] = coverage
         
-        # Фильтрация по документам
-        if document_ids:
-            chunks_query = chunks_query.filter(Document.id.in_(document_ids))
+        # Содержимое и метаданные загружаем только для победителей
+        details = fetch_chunk_details(self.db, [chunk_id for _, chunk_id, _ in top_chunks])
+        results = self._format_search_results(top_chunks, details)
         
-        # Получаем все чанки
-        chunks = chunks_query.all()
+        rerank_info = None
+        if rerank and results:
+            results, rerank_info = await reranker.rerank(query, results, rerank_budget_ms)
+            metadata["rerank"] = rerank_info
         
-        # Вычисляем сходство с запросом для каждого чанка
-        chunk_similarities = []
-        for chunk in chunks:
-            if not chunk.embedding:
-                continue
-            
-            # Десериализуем эмбеддинг из JSON-строки
-            chunk_embedding = json.loads(chunk.embedding)
-            
-            # Вычисляем косинусное сходство
-            similarity = embedding_service.similarity(query_embedding, chunk_embedding)
-            
-            if similarity >= min_similarity:
-                chunk_similarities.append({
-                    "chunk": chunk,
-                    "similarity": similarity
-                })
-        
-        # Сортируем по убыванию сходства и берем top-N результатов
-        chunk_similarities.sort(key=lambda x: x["similarity"], reverse=True)
-        top_chunks = chunk_similarities[:max_chunks]
+        # Переранжируются мелкие чанки, а в ответ попадают их секции
+        if expand_parents:
+            results = collapse_to_parents(
+                self.db, results, {chunk_id: chunk.parent_id for chunk_id, chunk in details.items()}
+            )
+        results = results[:max_chunks]
+        
+        # Откат к плотному порядку из-за бюджета не кэшируем, чтобы следующий запрос
+        # мог получить переранжированный результат (оценки к тому времени уже в кэше)
+        if not rerank_info or rerank_info["applied"]:
+            search_cache.results.set(
+                result_key,
+                copy.deepcopy({"results": results, "coverage": coverage, "rerank": rerank_info})
+            )
         
-        # Форматируем результаты
+        return {"results": results, "metadata": metadata}
+    
+    @staticmethod
+    def _format_search_results(
+        top_chunks: List[Tuple[float, int, int]],
+        details: Dict[int, Any]
+    ) -> List[Dict[str, Any]]:
+        """Форматирует top-k чанков с загруженными деталями в результаты поиска"""
         results = []
-        for item in top_chunks:
-            chunk = item["chunk"]
-            document = chunk.document
+        for similarity, chunk_id, _ in top_chunks:
+            chunk = details.get(chunk_id)
+            if chunk is None:
+                continue
             
             results.append({
                 "chunk_id": chunk.id,
-                "document_id": document.id,
-                "document_filename": document.filename,
-                "document_title": document.title or document.filename,
+                "document_id": chunk.document_id,
+                "document_filename": chunk.filename,
+                "document_title": chunk.title or chunk.filename,
                 "content": chunk.content,
-                "similarity": item["similarity"],
+                "similarity": similarity,
                 "metadata": {
-                    "chunk_index": chunk.chunk_index,
+                    "chunk_index": chunk.chunk_order,
                     "page_number": chunk.page_number,
-                    "document_type": document.file_type,
+                    "document_type": chunk.file_type,
                 }
             })
+        return results
+    
+    async def search_chunks_batch(
+        self,
+        queries: List[str],
+        user_id: int,
+        collection_ids: Optional[List[int]] = None,
+        document_ids: Optional[List[int]] = None,
+        max_chunks: int = 5,
+        min_similarity: float = 0.5,
+        provider: str = "openai",
+        model: str = "text-embedding-3-small",
+        filters: Optional[SearchFilters] = None,
+        expand_parents: Optional[bool] = None
+    ) -> Dict[str, Any]:
+        """
+        Выполняет поиск сразу по многим запросам в одной области
+        
+        Эмбеддинги всех запросов создаются одним пакетным вызовом (с учетом кэша),
+        корпус читается один раз, и каждая пачка чанков сравнивается со всеми
+        запросами одним матричным произведением. Отбор документов и переранжирование
+        не применяются, чтобы оценки офлайн-прогонов отражали чистый плотный поиск.
+        
+        Args:
+            queries: Текстовые запросы
+            user_id: ID пользователя
+            collection_ids: IDs коллекций для поиска
+            document_ids: IDs документов для поиска
+            max_chunks: Максимальное количество чанков на запрос
+            min_similarity: Минимальное сходство для включения чанка в результаты
+            provider: Провайдер для генерации эмбеддингов
+            model: Модель для генерации эмбеддингов
+            filters: Структурные фильтры (тип файла, страницы, даты, ключи chunk_metadata)
+            expand_parents: Заменять найденные чанки их родительскими секциями
+            
+        Returns:
+            Словарь с ключами results (по одному элементу {query, results} на запрос) и metadata
+        """
+        if expand_parents is None:
+            expand_parents = settings.SEARCH_EXPAND_PARENTS
+        
+        query_embeddings, cached_count = await self.get_query_embeddings(queries, provider, model)
+        metrics.increment("search.embedding_cache.hit", cached_count)
+        metrics.increment("search.embedding_cache.miss", len(queries) - cached_count)
+        metrics.increment("search.batch.queries", len(queries))
+        
+        metadata = {
+            "queries": len(queries),
+            "query_embeddings_cached": cached_count
+        }
+        
+        # Запросы, для которых не удалось получить эмбеддинг, сравниваются как нулевые векторы
+        dimension = next((len(embedding) for embedding in query_embeddings if embedding), 0)
+        query_matrix = [embedding or [0.0] * dimension for embedding in query_embeddings]
+        top_chunks_per_query, coverage = scoped_top_k_batch(
+            self.db,
+            user_id,
+            query_matrix,
+            max_chunks * PARENT_EXPANSION_FACTOR if expand_parents else max_chunks,
+            min_similarity,
+            document_ids=document_ids,
+            collection_ids=collection_ids,
+            filters=filters
+        )
+        metadata["coverage"] = coverage
+        
+        # Детали чанков загружаем одним запросом для объединения победителей всех запросов
+        winner_ids = {chunk_id for top_chunks in top_chunks_per_query for _, chunk_id, _ in top_chunks}
+        details = fetch_chunk_details(self.db, list(winner_ids))
+        parent_ids = {chunk_id: chunk.parent_id for chunk_id, chunk in details.items()}
+        sections = fetch_parent_sections(self.db, parent_ids.values()) if expand_parents else {}
+        
+        batch_results = []
+        for query, top_chunks in zip(queries, top_chunks_per_query):
+            results = self._format_search_results(top_chunks, details)
+            if expand_parents:
+                results = collapse_to_parents(self.db, results, parent_ids, sections)
+            batch_results.append({"query": query, "results": results[:max_chunks]})
+        
+        return {"results": batch_results, "metadata": metadata}
+    
+    def shortlist_documents(
+        self,
+        user_id: int,
+        collection_ids: Optional[List[int]],
+        query_embedding: List[float],
+        size: int,
+        filters: Optional[SearchFilters] = None
+    ) -> Tuple[Optional[List[int]], Dict[str, Any]]:
+        """
+        Отбирает документы, наиболее близкие к запросу по сводным эмбеддингам
+        
+        Документы без сводного эмбеддинга (еще не обработанные воркером) всегда
+        попадают в список кандидатов, чтобы не терять полноту поиска. При фильтрах
+        уровня чанка отбираются только документы, в которых есть подходящие чанки:
+        иначе отбор мог бы оставить одни документы без совпадений.
+        
+        Args:
+            user_id: ID пользователя
+            collection_ids: IDs коллекций для поиска
+            query_embedding: Эмбеддинг запроса
+            size: Количество отбираемых документов
+            filters: Структурные фильтры
+            
+        Returns:
+            Кортеж (IDs документов-кандидатов или None, если отбор не нужен; сведения об отборе)
+        """
+        query = scoped_document_query(
+            self.db,
+            (Document.id, Document.summary_embedding),
+            user_id=user_id,
+            collection_ids=collection_ids,
+            filters=filters
+        )
+        if has_chunk_filters(filters):
+            query = query.filter(Document.id.in_(
+                apply_chunk_filters(select(DocumentChunk.document_id), filters)
+            ))
+        
+        top_documents, pending_ids, documents_in_scope = top_k_documents(
+            query.yield_per(STREAM_BATCH_SIZE), query_embedding, size
+        )
+        
+        info = {
+            "size": size,
+            "documents_in_scope": documents_in_scope,
+            "candidates": documents_in_scope
+        }
+        
+        # Документов в области не больше размера списка - отбор ничего не дает
+        if documents_in_scope <= size:
+            return None, info
+        
+        candidate_ids = [document_id for _, document_id in top_documents]
+        candidate_ids.extend(pending_ids)
+        info["candidates"] = len(candidate_ids)
+        metrics.observe("search.document_shortlist.candidates", len(candidate_ids))
+        
+        return candidate_ids, info
+    
+    async def search_relevant_chunks(
+        self,
+        query: str,
+        user_id: int,
+        collection_ids: Optional[List[int]] = None,
+        document_ids: Optional[List[int]] = None,
+        max_chunks: int = 5,
+        min_similarity: float = 0.5,
+        provider: str = "openai",
+        model: str = "text-embedding-3-small",
+        document_shortlist: Optional[int] = None,
+        rerank: Optional[bool] = None,
+        rerank_budget_ms: Optional[float] = None,
+        filters: Optional[SearchFilters] = None,
+        expand_parents: Optional[bool] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Ищет релевантные чанки документов на основе векторного поиска
         
-        return results 
\ No newline at end of file
+        Args:
+            query: Текстовый запрос
+            user_id: ID пользователя
+            collection_ids: IDs коллекций для поиска
+            document_ids: IDs документов для поиска
+            max_chunks: Максимальное количество возвращаемых чанков
+            min_similarity: Минимальное сходство для включения чанка в результаты
+            provider: Провайдер для генерации эмбеддингов
+            model: Модель для генерации эмбеддингов
+            document_shortlist: Сколько документов отбирать на первом этапе (0 - без отбора)
+            rerank: Переранжировать кандидатов cross-encoder'ом
+            rerank_budget_ms: Бюджет времени на переранжирование в миллисекундах
+            filters: Структурные фильтры (тип файла, страницы, даты, ключи chunk_metadata)
+            expand_parents: Заменять найденные чанки их родительскими секциями
+            
+        Returns:
+            Список словарей с информацией о релевантных чанках
+        """
+        search_result = await self.search_chunks(
+            query=query,
+            user_id=user_id,
+            collection_ids=collection_ids,
+            document_ids=document_ids,
+            max_chunks=max_chunks,
+            min_similarity=min_similarity,
+            provider=provider,
+            model=model,
+            document_shortlist=document_shortlist,
+            rerank=rerank,
+            rerank_budget_ms=rerank_budget_ms,
+            filters=filters,
+            expand_parents=expand_parents
+        )
+        return search_result["results"]
@@ -0,0 +1,307 @@
+import asyncio
+import json
+import logging
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from sqlalchemy import and_, func
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.db.models.document import Document, DocumentChunk
+from app.db.session import SessionLocal
+from app.services.local_embedding_service import LocalEmbeddingService, get_local_embedding_service
+from app.services.search_cache import invalidate_document
+from app.services.vector_search import (
+    EMPTY_CHUNK_MODEL,
+    STREAM_BATCH_SIZE,
+    build_coverage,
+    embeddable_chunk,
+    mean_embedding,
+    summary_embedding
+)
+
+logger = logging.getLogger(__name__)
+
+# Наибольшая пауза между попытками загрузить недоступную модель (в секундах)
+MAX_MODEL_RETRY_DELAY = 60 * 60
+
+class EmbeddingModelUnavailable(Exception):
+    """Локальную модель эмбеддингов не удалось загрузить"""
+
+class EmbeddingBackfillWorker:
+    """
+    Фоновый воркер, дозаполняющий эмбеддинги чанков с embedding IS NULL.
+    Чанки обрабатываются большими пачками через общую локальную модель,
+    результаты сохраняются одним bulk-обновлением и одним коммитом на пачку.
+    Чанки без текста помечаются EMPTY_CHUNK_MODEL и больше не выбираются.
+    Когда все чанки документа получают векторы, воркер считает сводный эмбеддинг
+    документа (среднее векторов чанков с добавкой эмбеддинга заголовка).
+
+    Воркер запущен в каждом процессе приложения. Строки пачки выбираются
+    с FOR UPDATE SKIP LOCKED и остаются заблокированными до коммита пачки,
+    поэтому воркеры разных процессов делят работу, а не повторяют ее.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session] = SessionLocal,
+        embedding_service: Optional[LocalEmbeddingService] = None,
+        batch_size: int = 256,
+        idle_interval: float = 30.0
+    ):
+        """
+        Args:
+            session_factory: Фабрика сессий БД
+            embedding_service: Сервис эмбеддингов (по умолчанию - общий для процесса)
+            batch_size: Количество чанков в одной пачке
+            idle_interval: Пауза между проходами, если работы нет (в секундах)
+        """
+        self.session_factory = session_factory
+        self.embedding_service = embedding_service
+        self.batch_size = batch_size
+        self.idle_interval = idle_interval
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._last_id = 0
+        self._last_document_id = 0
+        self._model_failures = 0
+
+    def start(self) -> None:
+        """Запускает воркер в текущем event loop"""
+        if self._task and not self._task.done():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info("Embedding backfill worker started")
+
+    async def stop(self) -> None:
+        """Останавливает воркер"""
+        if not self._task:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        logger.info("Embedding backfill worker stopped")
+
+    def notify(self) -> None:
+        """Будит воркер, например после загрузки нового документа"""
+        if self._loop and self._wakeup:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                processed = await self.run_once()
+                self._model_failures = 0
+            except asyncio.CancelledError:
+                raise
+            except EmbeddingModelUnavailable as e:
+                # Модель не загружается (нет пакета, нет сети для скачивания) - повторяем
+                # с растущей паузой, не реагируя на notify, а не на каждом проходе
+                self._model_failures += 1
+                delay = min(self.idle_interval * 2 ** self._model_failures, MAX_MODEL_RETRY_DELAY)
+                metrics.increment("embedding_backfill.model_unavailable")
+                logger.warning(f"Embedding model unavailable, backfill paused for {delay:.0f}s: {str(e)}")
+                await asyncio.sleep(delay)
+                continue
+            except Exception as e:
+                logger.exception(f"Error in embedding backfill worker: {str(e)}")
+                processed = 0
+
+            if processed:
+                continue
+
+            # Работы нет - ждем сигнала или следующего планового прохода
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.idle_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run_once(self) -> int:
+        """
+        Обрабатывает одну пачку: сначала чанки без эмбеддингов,
+        а когда их не осталось - документы без сводного эмбеддинга
+
+        Запросы к БД, кодирование моделью и разбор векторов синхронны, поэтому
+        пачка целиком выполняется в рабочем потоке со своей сессией и не
+        задерживает обработку API-запросов в event loop.
+
+        Returns:
+            Количество просмотренных записей (0, если работы больше нет)
+
+        Raises:
+            EmbeddingModelUnavailable: Не удалось загрузить локальную модель
+        """
+        embedding_service = self.embedding_service or get_local_embedding_service()
+        try:
+            await embedding_service.ensure_loaded()
+        except Exception as e:
+            raise EmbeddingModelUnavailable(str(e)) from e
+        return await asyncio.to_thread(self._process_batch, embedding_service)
+
+    def _process_batch(self, embedding_service: LocalEmbeddingService) -> int:
+        db = self.session_factory()
+        try:
+            processed = self._embed_chunks(db, embedding_service)
+            if not processed:
+                processed = self._summarize_pending_documents(db, embedding_service)
+            return processed
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _embed_chunks(self, db: Session, embedding_service: LocalEmbeddingService) -> int:
+        # Курсор по id гарантирует, что чанки, которые не удалось обработать,
+        # не будут выбираться снова до следующего полного прохода. Чанки, которые
+        # сейчас обрабатывает воркер другого процесса, пропускаются
+        rows = db.query(DocumentChunk.id, DocumentChunk.document_id, DocumentChunk.content).filter(
+            DocumentChunk.embedding.is_(None),
+            embeddable_chunk(),
+            DocumentChunk.id > self._last_id
+        ).order_by(DocumentChunk.id).limit(self.batch_size).with_for_update(
+            of=DocumentChunk, skip_locked=True
+        ).all()
+
+        if not rows:
+            self._last_id = 0
+            return 0
+
+        self._last_id = rows[-1].id
+        start_time = time.time()
+
+        # Пустые чанки только помечаем: модели кодировать нечего
+        texts = [row for row in rows if row.content and row.content.strip()]
+        empty = [row for row in rows if not (row.content and row.content.strip())]
+        updates = [{"id": row.id, "embedding_model": EMPTY_CHUNK_MODEL} for row in empty]
+        document_ids = {row.document_id for row in empty}
+
+        embedded = 0
+        embeddings = embedding_service.encode([row.content for row in texts]) if texts else []
+        for row, embedding in zip(texts, embeddings):
+            # Нулевые векторы модели не сохраняем
+            if not any(embedding):
+                continue
+            embedded += 1
+            updates.append({
+                "id": row.id,
+                "embedding": json.dumps(embedding),
+                "embedding_model": embedding_service.model_name
+            })
+            document_ids.add(row.document_id)
+
+        if updates:
+            db.bulk_update_mappings(DocumentChunk, updates)
+
+            # Документы, у которых теперь есть все эмбеддинги чанков, получают сводный вектор
+            self._summarize_documents(db, embedding_service, document_ids)
+
+            # Новые векторы меняют результаты поиска по этим документам;
+            # версии фиксируются одним коммитом вместе с векторами
+            for document in db.query(Document).filter(Document.id.in_(document_ids)).all():
+                invalidate_document(document, commit=False)
+            db.commit()
+
+        metrics.increment("embedding_backfill.chunks_embedded", embedded)
+        metrics.increment("embedding_backfill.empty_chunks", len(empty))
+        metrics.observe("embedding_backfill.batch_seconds", time.time() - start_time)
+        logger.info(f"Backfilled embeddings for {embedded} chunks in {len(document_ids)} documents")
+
+        return len(rows)
+
+    def _summarize_pending_documents(self, db: Session, embedding_service: LocalEmbeddingService) -> int:
+        # Документы, загруженные до появления сводных векторов, обрабатываем тем же курсором
+        document_ids = [row.id for row in db.query(Document.id).filter(
+            Document.summary_embedding.is_(None),
+            Document.id > self._last_document_id,
+            Document.chunks.any(DocumentChunk.embedding.isnot(None))
+        ).order_by(Document.id).limit(self.batch_size).with_for_update(
+            of=Document, skip_locked=True
+        ).all()]
+
+        if not document_ids:
+            self._last_document_id = 0
+            return 0
+
+        self._last_document_id = document_ids[-1]
+        self._summarize_documents(db, embedding_service, document_ids)
+        db.commit()
+        return len(document_ids)
+
+    def _summarize_documents(
+        self,
+        db: Session,
+        embedding_service: LocalEmbeddingService,
+        document_ids: Iterable[int]
+    ) -> None:
+        """Считает сводные эмбеддинги для документов, у которых все непустые чанки уже с векторами (без коммита)"""
+        db.flush()
+        documents = db.query(Document.id, Document.title, Document.filename).filter(
+            Document.id.in_(list(document_ids)),
+            ~Document.chunks.any(and_(DocumentChunk.embedding.is_(None), embeddable_chunk()))
+        ).all()
+        if not documents:
+            return
+
+        titles = [(document.title or document.filename or "").strip() or "untitled" for document in documents]
+        title_embeddings = embedding_service.encode(titles)
+
+        updates = []
+        for document, title_embedding in zip(documents, title_embeddings):
+            chunks_mean = mean_embedding(
+                embedding for embedding, in db.query(DocumentChunk.embedding).filter(
+                    DocumentChunk.document_id == document.id
+                ).yield_per(STREAM_BATCH_SIZE)
+            )
+            if chunks_mean is None:
+                continue
+            updates.append({
+                "id": document.id,
+                "summary_embedding": json.dumps(summary_embedding(chunks_mean, title_embedding)),
+                "summary_embedding_model": embedding_service.model_name
+            })
+
+        if updates:
+            db.bulk_update_mappings(Document, updates)
+            metrics.increment("embedding_backfill.documents_summarized", len(updates))
+
+def get_document_coverage(db: Session, document_id: int) -> Dict[str, Any]:
+    """
+    Возвращает процент чанков документа, для которых уже есть эмбеддинги
+
+    Чанки без текста (EMPTY_CHUNK_MODEL) эмбеддинга не получают и не учитываются.
+
+    Args:
+        db: Сессия базы данных
+        document_id: ID документа
+
+    Returns:
+        Сводка покрытия: total_chunks, embedded_chunks, coverage_percent
+    """
+    total_chunks, embedded_chunks = db.query(
+        func.count(DocumentChunk.id),
+        func.count(DocumentChunk.embedding)
+    ).filter(DocumentChunk.document_id == document_id, embeddable_chunk()).one()
+
+    coverage = build_coverage(
+        Counter({document_id: total_chunks}),
+        Counter({document_id: embedded_chunks})
+    )
+    coverage.pop("partial_documents")
+    coverage["document_id"] = document_id
+    return coverage
+
+embedding_backfill_worker = EmbeddingBackfillWorker(
+    batch_size=settings.EMBEDDING_BACKFILL_BATCH_SIZE,
+    idle_interval=settings.EMBEDDING_BACKFILL_INTERVAL
+)
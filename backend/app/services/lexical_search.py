@@ -0,0 +1,165 @@
+"""
+Лексический поиск по чанкам: выделение ключевых слов, оценка совпадений
+и кэш префиксов для поиска по мере ввода.
+
+При наборе запроса каждое следующее значение, как правило, продолжает
+предыдущее. Кандидаты для запроса "mach" (чанки, содержащие все его слова)
+включают всех кандидатов для "machine lea", поэтому уточненный запрос
+фильтрует закэшированный набор в памяти, не обращаясь к БД.
+"""
+import logging
+import math
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import and_
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.db.models.document import DocumentChunk
+from app.schemas.document import SearchFilters
+from app.services.search_cache import SearchCache, corpus_versions
+from app.services.vector_search import STREAM_BATCH_SIZE, TopKHeap, scoped_chunk_query
+from app.utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+STOP_WORDS = {
+    "and", "or", "the", "a", "an", "in", "on", "at", "to", "for",
+    "и", "или", "в", "на", "с", "по", "для", "от", "к", "у"
+}
+
+# Сколько последних запросов хранится для одной области поиска
+PREFIX_ENTRIES_PER_SCOPE = 4
+
+def extract_keywords(query: str) -> List[str]:
+    """Выделяет ключевые слова запроса без стоп-слов (или все слова, если остались только стоп-слова)"""
+    words = [w for w in re.split(r'\W+', query.lower()) if w]
+    keywords = [w for w in words if w not in STOP_WORDS and len(w) > 1]
+    return keywords or words
+
+def lexical_relevance(keywords: List[str], content_lower: str) -> float:
+    """
+    Оценка релевантности по количеству совпавших ключевых слов и длине чанка
+
+    Не превышает 0.7, чтобы результаты векторного поиска имели приоритет.
+    """
+    matches = sum(1 for kw in keywords if kw in content_lower)
+    if matches == 0:
+        return 0.0
+    relevance = matches / (len(keywords) * (1 + math.log10(max(len(content_lower), 1) / 100)))
+    return min(0.7, relevance * 0.7)
+
+class LexicalPrefixCache:
+    """
+    Кэш кандидатов лексического поиска по области поиска и запросу
+
+    Кандидаты - чанки, содержащие все ключевые слова запроса. Набор можно
+    переиспользовать для любого запроса, каждое слово которого содержит
+    какое-либо слово закэшированного запроса как подстроку.
+    """
+
+    def __init__(self, max_scopes: int = 128, candidate_limit: int = 500):
+        """
+        Args:
+            max_scopes: Сколько областей поиска (пользователь, документы, фильтры) держать в кэше
+            candidate_limit: Максимальный размер набора кандидатов; большие наборы не кэшируются
+        """
+        self.candidate_limit = candidate_limit
+        self.scopes = LRUCache(max_size=max_scopes)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def covers(cached_keywords: List[str], keywords: List[str]) -> bool:
+        """Содержит ли набор кандидатов для cached_keywords все чанки для keywords"""
+        return all(any(cached in keyword for keyword in keywords) for cached in cached_keywords)
+
+    def lookup(self, scope: Tuple, keywords: List[str]) -> Optional[List[Tuple[int, int, str]]]:
+        entries = self.scopes.get(scope)
+        if not entries:
+            return None
+        with self._lock:
+            for cached_keywords, candidates in reversed(entries):
+                if self.covers(cached_keywords, keywords):
+                    return candidates
+        return None
+
+    def store(self, scope: Tuple, keywords: List[str], candidates: List[Tuple[int, int, str]]) -> None:
+        with self._lock:
+            entries = self.scopes.get(scope) or []
+            entries = [entry for entry in entries if entry[0] != keywords][-(PREFIX_ENTRIES_PER_SCOPE - 1):]
+            entries.append((keywords, candidates))
+        self.scopes.set(scope, entries)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"candidate_limit": self.candidate_limit, "scopes": self.scopes.stats()}
+
+lexical_prefix_cache = LexicalPrefixCache(
+    max_scopes=settings.SEARCH_LIVE_PREFIX_CACHE_SIZE,
+    candidate_limit=settings.SEARCH_LIVE_CANDIDATE_LIMIT
+)
+
+metrics.register_collector("lexical_prefix_cache", lexical_prefix_cache.stats)
+
+def prefix_lexical_search(
+    db: Session,
+    user_id: int,
+    query: str,
+    max_chunks: int,
+    document_ids: Optional[List[int]] = None,
+    filters: Optional[SearchFilters] = None
+) -> Tuple[List[Tuple[float, int, int]], Dict[str, Any]]:
+    """
+    Быстрый лексический поиск для запросов, набираемых по символу
+
+    В отличие от text_based_search чанк должен содержать все ключевые слова:
+    так набор кандидатов для уточненного запроса вложен в набор для его
+    префикса и берется из кэша.
+
+    Returns:
+        Кортеж (top-k в формате TopKHeap.results, сведения о поиске)
+    """
+    keywords = extract_keywords(query)
+    info = {"prefix_reused": False, "truncated": False}
+    if not keywords:
+        return [], info
+
+    scope = (
+        user_id,
+        tuple(sorted(set(document_ids or []))),
+        SearchCache.filters_key(filters),
+        corpus_versions.scope_version(db, user_id, None, document_ids)
+    )
+
+    candidates = lexical_prefix_cache.lookup(scope, keywords)
+    if candidates is not None:
+        info["prefix_reused"] = True
+        metrics.increment("search.live.prefix_reused")
+    else:
+        rows = scoped_chunk_query(
+            db,
+            (DocumentChunk.id, DocumentChunk.document_id, DocumentChunk.content),
+            user_id=user_id,
+            document_ids=document_ids,
+            only_completed=True,
+            filters=filters
+        ).filter(
+            and_(*[DocumentChunk.content.ilike(f"%{kw}%") for kw in keywords])
+        ).limit(lexical_prefix_cache.candidate_limit + 1).yield_per(STREAM_BATCH_SIZE)
+
+        candidates = [(chunk_id, document_id, (content or "").lower()) for chunk_id, document_id, content in rows]
+        if len(candidates) > lexical_prefix_cache.candidate_limit:
+            # Неполный набор нельзя уточнять: следующий запрос снова пойдет в БД
+            candidates = candidates[:lexical_prefix_cache.candidate_limit]
+            info["truncated"] = True
+        else:
+            lexical_prefix_cache.store(scope, keywords, candidates)
+
+    heap = TopKHeap(max_chunks)
+    for chunk_id, document_id, content_lower in candidates:
+        if all(kw in content_lower for kw in keywords):
+            heap.push(lexical_relevance(keywords, content_lower), chunk_id, document_id)
+
+    return heap.results(), info
@@ -0,0 +1,329 @@
+"""
+Маршрутизация запросов к LLM с учетом задержек.
+
+Для каждой пары (провайдер, модель) в памяти хранится скользящее окно
+задержек: отдельно время полного ответа и время до первого токена потока.
+
+- Хеджирование: если основной запрос не дал первого токена (или ответа)
+  за перцентиль LLM_HEDGE_PERCENTILE наблюдаемой задержки, параллельно
+  отправляется дубликат в эквивалентную модель (MODEL_EQUIVALENTS) или,
+  если ее нет, в ту же модель. Побеждает первый ответ, проигравший
+  запрос отменяется.
+- Резерв: при ошибке провайдера запрос повторяется в следующей
+  эквивалентной модели; кандидаты упорядочены по медиане задержки.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.integrations.llm_clients import get_llm_client
+from app.services.circuit_breaker import is_circuit_open
+from app.services.rate_limiter import rate_limited_call, rate_limited_stream
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class Route:
+    """Куда отправить запрос: провайдер, модель, клиент и сообщения в формате провайдера"""
+    provider: str
+    model: str
+    client: Any
+    messages: List[Dict[str, Any]]
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return (self.provider.lower(), self.model)
+
+class LatencyTracker:
+    """Скользящие окна задержек по (провайдер, модель)"""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        # kind: "completion" - полный ответ, "first_token" - первый токен потока
+        self._samples: Dict[Tuple[str, Tuple[str, str]], Deque[float]] = {}
+        self._errors: Dict[Tuple[str, str], int] = {}
+
+    def record(self, key: Tuple[str, str], seconds: float, kind: str = "completion") -> None:
+        samples = self._samples.get((kind, key))
+        if samples is None:
+            samples = self._samples.setdefault((kind, key), deque(maxlen=self.window))
+        samples.append(seconds)
+
+    def record_error(self, key: Tuple[str, str]) -> None:
+        self._errors[key] = self._errors.get(key, 0) + 1
+
+    def percentile(self, key: Tuple[str, str], q: float, kind: str = "completion", min_samples: int = 1) -> Optional[float]:
+        samples = self._samples.get((kind, key))
+        if not samples or len(samples) < min_samples:
+            return None
+        return float(np.percentile(np.fromiter(samples, dtype=np.float64), q * 100))
+
+    def hedge_delay(self, key: Tuple[str, str], kind: str) -> Optional[float]:
+        """Сколько ждать основной запрос перед хеджированием (None - статистики пока мало)"""
+        delay = self.percentile(key, settings.LLM_HEDGE_PERCENTILE, kind, settings.LLM_HEDGE_MIN_SAMPLES)
+        if delay is None:
+            return None
+        return max(delay, settings.LLM_HEDGE_MIN_DELAY_MS / 1000)
+
+    def stats(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {
+            f"{provider}:{model}": {"errors": count} for (provider, model), count in list(self._errors.items())
+        }
+        for (kind, (provider, model)), samples in list(self._samples.items()):
+            entry = result.setdefault(f"{provider}:{model}", {"errors": 0})
+            values = np.fromiter(samples, dtype=np.float64)
+            entry[kind] = {
+                "samples": len(values),
+                "p50_ms": round(float(np.percentile(values, 50)) * 1000, 1),
+                "p95_ms": round(float(np.percentile(values, 95)) * 1000, 1),
+                "p99_ms": round(float(np.percentile(values, 99)) * 1000, 1)
+            }
+        return result
+
+latency_tracker = LatencyTracker(window=settings.LLM_LATENCY_WINDOW)
+
+metrics.register_collector("llm_latency", latency_tracker.stats)
+
+def equivalent_routes(
+    provider: str,
+    model: str,
+    format_messages: Callable[[str], List[Dict[str, Any]]],
+    user=None,
+    db=None
+) -> List[Route]:
+    """
+    Эквивалентные модели из MODEL_EQUIVALENTS, для которых есть рабочий клиент
+
+    Args:
+        provider: Провайдер основного запроса
+        model: Модель основного запроса
+        format_messages: Сообщения в формате указанного провайдера
+        user: Пользователь (для его API ключей)
+        db: Сессия БД
+    """
+    routes = []
+    for target in settings.MODEL_EQUIVALENTS.get(f"{provider.lower()}:{model}", []):
+        target_provider, _, target_model = target.partition(":")
+        client = get_llm_client(target_provider, user=user, db=db)
+        if client is None or client.client is None or not target_model:
+            continue
+        routes.append(Route(target_provider, target_model, client, format_messages(target_provider)))
+    return routes
+
+def _order_alternatives(alternatives: List[Route], kind: str) -> List[Route]:
+    """
+    Сначала модели с меньшей медианой задержки; модели без статистики - после них,
+    модели с разомкнутым выключателем - в самом конце
+    """
+    def order(route: Route) -> Tuple[bool, float]:
+        value = latency_tracker.percentile(route.key, 0.5, kind)
+        return is_circuit_open(route.provider, route.model), value if value is not None else float("inf")
+    return sorted(alternatives, key=order)
+
+def _route_info(route: Route, primary: Route, hedged: bool, errors: List[str]) -> Dict[str, Any]:
+    return {
+        "provider": route.provider,
+        "model": route.model,
+        "hedged": hedged,
+        "fallback": route.key != primary.key,
+        "errors": errors
+    }
+
+def served_route(route_info: Optional[Dict[str, Any]], provider: str, model: str) -> Tuple[str, str]:
+    """
+    Провайдер и модель, которые фактически ответили на запрос
+
+    После резерва это резервная модель; для ответа из кэша сведений
+    о маршруте нет - это запрошенные провайдер и модель.
+    """
+    if not route_info:
+        return provider, model
+    return route_info["provider"], route_info["model"]
+
+async def _cancel(tasks) -> None:
+    for task in tasks:
+        task.cancel()
+    # Дожидаемся отмены, чтобы исключения проигравших не остались необработанными
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def routed_completion(
+    primary: Route,
+    parameters: Dict[str, Any],
+    alternatives: Optional[List[Route]] = None,
+    owner=None
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Запрос к модели с хеджированием и резервными моделями
+
+    Args:
+        primary: Запрошенные провайдер и модель
+        parameters: Параметры модели
+        alternatives: Эквивалентные модели для хеджирования и резерва
+        owner: Владелец запроса для очереди лимитера
+
+    Returns:
+        Кортеж (ответ в формате format_response, сведения о маршруте)
+    """
+    candidates = _order_alternatives(alternatives or [], "completion")
+    hedge_delay = latency_tracker.hedge_delay(primary.key, "completion") if settings.LLM_HEDGING_ENABLED else None
+    errors: List[str] = []
+    hedged = False
+
+    async def attempt(route: Route):
+        start_time = time.monotonic()
+        raw_response = await rate_limited_call(route.client, route.provider, route.messages, route.model, parameters, owner=owner)
+        latency_tracker.record(route.key, time.monotonic() - start_time, "completion")
+        return route.client.format_response(raw_response)
+
+    def next_route(for_hedge: bool) -> Optional[Route]:
+        if candidates:
+            return candidates.pop(0)
+        if for_hedge and settings.LLM_HEDGE_SAME_MODEL:
+            return primary
+        return None
+
+    if hedge_delay is None and not candidates:
+        # Не с чем соревноваться и некуда отступать: обычный запрос
+        try:
+            return await attempt(primary), _route_info(primary, primary, False, errors)
+        except Exception:
+            latency_tracker.record_error(primary.key)
+            raise
+
+    pending: Dict[asyncio.Task, Route] = {asyncio.ensure_future(attempt(primary)): primary}
+    try:
+        while pending:
+            timeout = hedge_delay if not hedged else None
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                hedged = True
+                route = next_route(for_hedge=True)
+                if route is not None:
+                    metrics.increment("llm.router.hedged")
+                    pending[asyncio.ensure_future(attempt(route))] = route
+                continue
+
+            for task in done:
+                route = pending.pop(task)
+                if task.exception() is None:
+                    if hedged and pending:
+                        metrics.increment("llm.router.hedge_cancelled")
+                    return task.result(), _route_info(route, primary, hedged, errors)
+                latency_tracker.record_error(route.key)
+                errors.append(f"{route.provider}:{route.model}: {task.exception()}")
+                logger.warning(f"LLM request to {route.provider}:{route.model} failed: {task.exception()}")
+
+            if not pending and settings.LLM_FALLBACK_ENABLED:
+                route = next_route(for_hedge=False)
+                if route is not None:
+                    metrics.increment("llm.router.fallback")
+                    pending[asyncio.ensure_future(attempt(route))] = route
+
+        raise done.pop().exception()
+    finally:
+        await _cancel(list(pending))
+
+async def routed_stream(
+    primary: Route,
+    parameters: Dict[str, Any],
+    alternatives: Optional[List[Route]] = None,
+    owner=None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Потоковый запрос с хеджированием по времени до первого токена
+
+    Выдает события astream_prompt победившего маршрута, перед ними - {"route": сведения о маршруте}.
+    Резерв и хеджирование возможны только до первого события.
+    """
+    candidates = _order_alternatives(alternatives or [], "first_token")
+    hedge_delay = latency_tracker.hedge_delay(primary.key, "first_token") if settings.LLM_HEDGING_ENABLED else None
+    errors: List[str] = []
+    hedged = False
+
+    def start(route: Route):
+        stream = rate_limited_stream(route.client, route.provider, route.messages, route.model, parameters, owner=owner)
+        return asyncio.ensure_future(stream.__anext__()), (route, stream, time.monotonic())
+
+    def next_route(for_hedge: bool) -> Optional[Route]:
+        if candidates:
+            return candidates.pop(0)
+        if for_hedge and settings.LLM_HEDGE_SAME_MODEL:
+            return primary
+        return None
+
+    if hedge_delay is None and not candidates:
+        # Без гонки поток читается в текущей задаче
+        start_time = time.monotonic()
+        first = True
+        yield {"route": _route_info(primary, primary, False, errors)}
+        try:
+            async for event in rate_limited_stream(primary.client, primary.provider, primary.messages, primary.model, parameters, owner=owner):
+                if first:
+                    latency_tracker.record(primary.key, time.monotonic() - start_time, "first_token")
+                    first = False
+                yield event
+        except Exception:
+            latency_tracker.record_error(primary.key)
+            raise
+        return
+
+    task, state = start(primary)
+    pending = {task: state}
+    winner = None
+    first_event = None
+    try:
+        while pending and winner is None:
+            timeout = hedge_delay if not hedged else None
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                hedged = True
+                route = next_route(for_hedge=True)
+                if route is not None:
+                    metrics.increment("llm.router.hedged")
+                    task, state = start(route)
+                    pending[task] = state
+                continue
+
+            for task in done:
+                route, stream, start_time = pending.pop(task)
+                error = task.exception()
+                if error is None or isinstance(error, StopAsyncIteration):
+                    latency_tracker.record(route.key, time.monotonic() - start_time, "first_token")
+                    winner = (route, stream)
+                    first_event = None if error is not None else task.result()
+                    break
+                latency_tracker.record_error(route.key)
+                errors.append(f"{route.provider}:{route.model}: {error}")
+                logger.warning(f"LLM stream from {route.provider}:{route.model} failed: {error}")
+
+            if winner is None and not pending:
+                route = next_route(for_hedge=False) if settings.LLM_FALLBACK_ENABLED else None
+                if route is None:
+                    raise error
+                metrics.increment("llm.router.fallback")
+                task, state = start(route)
+                pending[task] = state
+    finally:
+        losers = list(pending.items())
+        await _cancel([task for task, _ in losers])
+        for _, (_, stream, _) in losers:
+            await stream.aclose()
+        if winner is not None and hedged and losers:
+            metrics.increment("llm.router.hedge_cancelled")
+
+    route, stream = winner
+    yield {"route": _route_info(route, primary, hedged, errors)}
+    if first_event is None:
+        return
+    yield first_event
+    async for event in stream:
+        yield event
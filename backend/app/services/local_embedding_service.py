@@ -33,6 +33,7 @@ class LocalEmbeddingService:
         self.use_gpu = use_gpu
         self.model = None
         self.embedding_dim = None
+        self._load_lock = asyncio.Lock()
         logger.info(f"Инициализирован LocalEmbeddingService с моделью {model_name}")
         
     async def _load_model(self):
@@ -42,6 +43,14 @@ class LocalEmbeddingService:
         if self.model is not None:
             return
         
+        async with self._load_lock:
+            if self.model is None:
+                await self._load_model_locked()
+    
+    async def _load_model_locked(self):
+        """
+        Загружает модель; вызывается под блокировкой, чтобы общая модель не загружалась дважды.
+        """
         # Используем блокирующую операцию в отдельном потоке через loop.run_in_executor
         logger.info(f"Загружаем модель {self.model_name}...")
         
@@ -79,6 +88,27 @@ class LocalEmbeddingService:
             logger.error(f"Ошибка при загрузке модели: {str(e)}")
             raise
     
+    async def ensure_loaded(self) -> None:
+        """
+        Загружает модель, если она еще не загружена; ошибка загрузки пробрасывается.
+        """
+        await self._load_model()
+    
+    def encode(self, texts: List[str]) -> List[List[float]]:
+        """
+        Синхронно генерирует эмбеддинги уже загруженной моделью.
+        Для рабочих потоков, которые не должны занимать event loop: модель нужно
+        заранее загрузить через ensure_loaded, ошибки модели пробрасываются.
+        
+        Args:
+            texts: Непустые тексты
+            
+        Returns:
+            Эмбеддинги в порядке текстов
+        """
+        embeddings = self.model.encode([t[:10000] for t in texts], convert_to_numpy=True)
+        return embeddings.tolist() if isinstance(embeddings, np.ndarray) else embeddings
+    
     async def get_embeddings(self, text: Union[str, List[str]]) -> Union[List[float], List[List[float]]]:
         """
         Генерирует эмбеддинги для текста или списка текстов.
@@ -170,6 +200,21 @@ class LocalEmbeddingService:
         
         return results
 
+DEFAULT_MODEL_NAME = "paraphrase-multilingual-MiniLM-L12-v2"
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "model_cache")
+
+_shared_service: Optional[LocalEmbeddingService] = None
+
+def get_local_embedding_service() -> LocalEmbeddingService:
+    """
+    Возвращает общий для процесса экземпляр сервиса, чтобы модель загружалась один раз
+    и переиспользовалась поиском и фоновым дозаполнением эмбеддингов.
+    """
+    global _shared_service
+    if _shared_service is None:
+        _shared_service = LocalEmbeddingService(model_name=DEFAULT_MODEL_NAME, cache_dir=DEFAULT_CACHE_DIR)
+    return _shared_service
+
 def torch_available() -> bool:
     """Проверяет доступность CUDA для PyTorch"""
     try:
@@ -0,0 +1,302 @@
+"""
+Каталог моделей LLM.
+
+Списки моделей кэшируются в памяти по (провайдер, отпечаток API ключа):
+запрос получает список из кэша, сеть нужна только при первом обращении.
+Фоновый воркер периодически обновляет все известные списки, поэтому
+новые модели провайдера появляются без перезапуска.
+
+Каталог не хранит клиентов и ключей: для обновления клиент берется из кэша
+клиентов по отпечатку. Если ключ заменен, список давно не запрашивали или
+провайдер несколько раз подряд отклонил ключ, запись удаляется.
+
+К моделям прикладываются метаданные - контекстное окно, цены,
+модальности - которые используют оценка стоимости и упаковка контекста RAG.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Hashable, List, Optional
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.integrations.llm_clients import get_cached_llm_client
+from app.utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Метаданные известных моделей. Модели с датой версии (gpt-4o-2024-08-06)
+# наследуют метаданные самого длинного совпадающего префикса.
+# Цены - в USD за 1000 токенов.
+MODEL_METADATA: Dict[str, Dict[str, Dict[str, Any]]] = {
+    "openai": {
+        "gpt-4o": {"context_window": 128000, "input_price_per_1k": 0.01, "output_price_per_1k": 0.03, "modalities": ["text", "image"]},
+        "gpt-4o-mini": {"context_window": 128000, "input_price_per_1k": 0.00015, "output_price_per_1k": 0.0006, "modalities": ["text", "image"]},
+        "gpt-4-turbo": {"context_window": 128000, "input_price_per_1k": 0.01, "output_price_per_1k": 0.03, "modalities": ["text", "image"]},
+        "gpt-4-vision-preview": {"context_window": 128000, "input_price_per_1k": 0.01, "output_price_per_1k": 0.03, "modalities": ["text", "image"]},
+        "gpt-4": {"context_window": 8192, "input_price_per_1k": 0.03, "output_price_per_1k": 0.06, "modalities": ["text"]},
+        "gpt-3.5-turbo": {"context_window": 16385, "input_price_per_1k": 0.0005, "output_price_per_1k": 0.0015, "modalities": ["text"]}
+    },
+    "anthropic": {
+        "claude-3-5-sonnet": {"context_window": 200000, "input_price_per_1k": 0.003, "output_price_per_1k": 0.015, "modalities": ["text", "image"]},
+        "claude-3-opus": {"context_window": 200000, "input_price_per_1k": 0.015, "output_price_per_1k": 0.075, "modalities": ["text", "image"]},
+        "claude-3-sonnet": {"context_window": 200000, "input_price_per_1k": 0.003, "output_price_per_1k": 0.015, "modalities": ["text", "image"]},
+        "claude-3-haiku": {"context_window": 200000, "input_price_per_1k": 0.00025, "output_price_per_1k": 0.00125, "modalities": ["text", "image"]},
+        "claude-2.1": {"context_window": 200000, "input_price_per_1k": 0.008, "output_price_per_1k": 0.024, "modalities": ["text"]},
+        "claude-2.0": {"context_window": 100000, "input_price_per_1k": 0.008, "output_price_per_1k": 0.024, "modalities": ["text"]}
+    },
+    "mistral": {
+        "mistral-large": {"context_window": 32000, "input_price_per_1k": 0.002, "output_price_per_1k": 0.006, "modalities": ["text"]},
+        "mistral-medium": {"context_window": 32000, "input_price_per_1k": 0.0006, "output_price_per_1k": 0.0018, "modalities": ["text"]},
+        "mistral-small": {"context_window": 32000, "input_price_per_1k": 0.0002, "output_price_per_1k": 0.0006, "modalities": ["text"]}
+    },
+    "google": {
+        "gemini-1.5-pro": {"context_window": 1000000, "input_price_per_1k": 0.0005, "output_price_per_1k": 0.0015, "modalities": ["text", "image", "audio"]},
+        "gemini-1.5-flash": {"context_window": 1000000, "input_price_per_1k": 0.00035, "output_price_per_1k": 0.00105, "modalities": ["text", "image", "audio"]},
+        "gemini-1.0-pro-vision": {"context_window": 12288, "input_price_per_1k": 0.0005, "output_price_per_1k": 0.0015, "modalities": ["text", "image"]},
+        "gemini-1.0-pro": {"context_window": 30720, "input_price_per_1k": 0.0005, "output_price_per_1k": 0.0015, "modalities": ["text"]}
+    }
+}
+
+# Провайдеры, использующие метаданные другого провайдера
+PROVIDER_ALIASES = {"gemini": "google"}
+
+# Для неизвестных моделей: консервативное окно и цены
+DEFAULT_MODEL_METADATA: Dict[str, Any] = {
+    "context_window": 8192,
+    "input_price_per_1k": 0.01,
+    "output_price_per_1k": 0.03,
+    "modalities": ["text"]
+}
+
+# Mock-провайдер бесплатен для любой модели
+MOCK_MODEL_METADATA: Dict[str, Any] = {
+    "context_window": 128000,
+    "input_price_per_1k": 0.0,
+    "output_price_per_1k": 0.0,
+    "modalities": ["text"]
+}
+
+def model_metadata(provider: str, model: str) -> Dict[str, Any]:
+    """
+    Метаданные модели: context_window, input_price_per_1k, output_price_per_1k, modalities
+
+    Неизвестные модели получают метаданные самого длинного совпадающего
+    префикса, а без совпадений - консервативные значения по умолчанию.
+    """
+    provider = (provider or "").lower()
+    provider = PROVIDER_ALIASES.get(provider, provider)
+    if provider == "mock":
+        return {**MOCK_MODEL_METADATA, "known": True}
+    if provider == "local":
+        # Локальный сервер инференса бесплатен; окно модели неизвестно - консервативное значение
+        return {**DEFAULT_MODEL_METADATA, "input_price_per_1k": 0.0, "output_price_per_1k": 0.0, "known": False}
+
+    models = MODEL_METADATA.get(provider, {})
+    metadata = models.get(model)
+    if metadata is None:
+        prefixes = [name for name in models if model and model.startswith(name)]
+        metadata = models[max(prefixes, key=len)] if prefixes else None
+    if metadata is None:
+        return {**DEFAULT_MODEL_METADATA, "known": False}
+    return {**metadata, "known": True}
+
+def get_model_pricing(provider: str, model: str) -> Dict[str, float]:
+    """Цены модели в USD за 1000 токенов"""
+    metadata = model_metadata(provider, model)
+    return {
+        "input_price_per_1k": metadata["input_price_per_1k"],
+        "output_price_per_1k": metadata["output_price_per_1k"]
+    }
+
+def _is_auth_error(error: Exception) -> bool:
+    """Провайдер отклонил ключ (401/403): SDK кладут код в status_code или response"""
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code in (401, 403)
+
+class ModelCatalog:
+    """Списки моделей по (провайдер, API ключ) с обновлением в фоне"""
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        refresh_interval: float = 6 * 60 * 60,
+        entry_ttl: float = 24 * 60 * 60,
+        max_auth_failures: int = 3
+    ):
+        """
+        Args:
+            max_entries: Сколько пар (провайдер, ключ) хранить
+            refresh_interval: Период фонового обновления списков (в секундах)
+            entry_ttl: Через сколько секунд без запросов список удаляется
+            max_auth_failures: После скольких отказов в доступе подряд список удаляется
+        """
+        self.refresh_interval = refresh_interval
+        self.entry_ttl = entry_ttl
+        self.max_auth_failures = max(1, max_auth_failures)
+        # Запись: {"provider", "fingerprint", "models", "updated_at", "requested_at", "error", "auth_failures"}
+        self._entries = LRUCache(max_size=max_entries)
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self.dropped = 0
+
+    @staticmethod
+    def _key(provider: str, client) -> Hashable:
+        return (provider.lower(), client.key_fingerprint)
+
+    async def get_models(self, provider: str, client) -> List[str]:
+        """Список моделей из памяти; сеть нужна только при первом обращении для этого ключа"""
+        key = self._key(provider, client)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = await self.refresh(provider, client)
+        entry["requested_at"] = time.time()
+        return entry["models"]
+
+    async def refresh(self, provider: str, client) -> Dict[str, Any]:
+        """Загружает список моделей; параллельные обновления одного ключа объединяются"""
+        key = self._key(provider, client)
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            entry = await self._load(key, provider, client)
+            future.set_result(entry)
+            return entry
+        except BaseException as e:
+            future.set_exception(e)
+            # Исключение уже передано ожидающим; само future больше никто не читает
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _load(self, key: Hashable, provider: str, client) -> Dict[str, Any]:
+        previous = self._entries.get(key)
+        start_time = time.time()
+        auth_failures = 0
+        try:
+            # Список моделей некоторых SDK - блокирующий сетевой вызов
+            models = await asyncio.to_thread(client.get_available_models)
+            error = None
+        except Exception as e:
+            self.refresh_errors += 1
+            logger.warning(f"Failed to refresh {provider} model list: {str(e)}")
+            # Прежний список лучше пустого
+            models = previous["models"] if previous else []
+            error = str(e)
+            if _is_auth_error(e):
+                auth_failures = (previous["auth_failures"] if previous else 0) + 1
+
+        entry = {
+            "provider": provider.lower(),
+            "fingerprint": key[1],
+            "models": list(dict.fromkeys(models)),
+            "updated_at": time.time(),
+            "requested_at": previous["requested_at"] if previous else time.time(),
+            "error": error,
+            "auth_failures": auth_failures
+        }
+        self.refreshes += 1
+        metrics.observe("model_catalog.refresh_seconds", time.time() - start_time)
+        if auth_failures >= self.max_auth_failures:
+            # Ключ отозван: не обращаемся к провайдеру с ним при каждом обновлении
+            logger.warning(f"Dropping {provider} model list after {auth_failures} rejected requests")
+            self._drop(key)
+        else:
+            self._entries.set(key, entry)
+        return entry
+
+    def _drop(self, key: Hashable) -> None:
+        self._entries.pop(key)
+        self.dropped += 1
+
+    async def refresh_all(self) -> int:
+        """
+        Обновляет известные списки; возвращает количество обновленных
+
+        Давно не запрашиваемые списки и списки, для ключа которых в кэше
+        больше нет клиента (ключ заменен или не использовался), удаляются:
+        следующий запрос загрузит список заново своим клиентом.
+        """
+        refreshed = 0
+        now = time.time()
+        for key in self._entries.keys():
+            entry = self._entries.get(key)
+            if entry is None:
+                continue
+            client = None
+            if now - entry["requested_at"] <= self.entry_ttl:
+                client = get_cached_llm_client(entry["provider"], entry["fingerprint"])
+            if client is None:
+                self._drop(key)
+                continue
+            await self.refresh(entry["provider"], client)
+            refreshed += 1
+        return refreshed
+
+    def describe(self, provider: str, models: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Метаданные для списка моделей провайдера"""
+        return {model: model_metadata(provider, model) for model in models}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": self._entries.stats(),
+            "refreshes": self.refreshes,
+            "refresh_errors": self.refresh_errors,
+            "dropped": self.dropped
+        }
+
+model_catalog = ModelCatalog(
+    max_entries=settings.MODEL_CATALOG_MAX_ENTRIES,
+    refresh_interval=settings.MODEL_CATALOG_REFRESH_INTERVAL,
+    entry_ttl=settings.MODEL_CATALOG_ENTRY_TTL,
+    max_auth_failures=settings.MODEL_CATALOG_MAX_AUTH_FAILURES
+)
+
+metrics.register_collector("model_catalog", model_catalog.stats)
+
+class ModelCatalogRefresher:
+    """Фоновый воркер, обновляющий списки моделей раз в refresh_interval"""
+
+    def __init__(self, catalog: ModelCatalog):
+        self.catalog = catalog
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """Запускает воркер в текущем event loop"""
+        if self._task and not self._task.done():
+            return
+        self._task = asyncio.create_task(self._run())
+        logger.info("Model catalog refresher started")
+
+    async def stop(self) -> None:
+        """Останавливает воркер"""
+        if not self._task:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        logger.info("Model catalog refresher stopped")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.catalog.refresh_interval)
+            try:
+                refreshed = await self.catalog.refresh_all()
+                logger.info(f"Refreshed {refreshed} model lists")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Error in model catalog refresher: {str(e)}")
+
+model_catalog_refresher = ModelCatalogRefresher(model_catalog)
@@ -0,0 +1,255 @@
+"""
+Потоковая выдача ответов LLM клиенту в формате Server-Sent Events.
+
+Токены пересылаются по мере генерации провайдером. Для каждого потока
+считаются время до первого токена и скорость генерации, а итоговый учет
+(аналитика промпта) записывается и при нормальном завершении, и при
+отключении клиента посреди ответа.
+"""
+import asyncio
+import json
+import logging
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.core.metrics import metrics
+from app.db.models.analytics import PromptAnalytics
+from app.db.session import SessionLocal
+from app.services.context_packer import estimate_tokens
+from app.services.llm_router import Route, routed_stream, served_route
+from app.services.response_cache import CachedRequest
+
+logger = logging.getLogger(__name__)
+
+# Заголовки, отключающие буферизацию ответа в прокси (nginx) и кэширование
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no"
+}
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    """Форматирует одно событие SSE"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def usage_token_counts(usage: Dict[str, Any]) -> Tuple[int, int]:
+    """Возвращает (входные, выходные) токены из usage любого провайдера"""
+    if "prompt_tokens" in usage or "completion_tokens" in usage:
+        return usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0
+    return usage.get("input_tokens") or 0, usage.get("output_tokens") or 0
+
+def estimate_usage(prompt_data: List[Dict[str, Any]], content: str) -> Dict[str, Any]:
+    """Оценка usage, если провайдер не успел его прислать (например, клиент отключился)"""
+    input_tokens = sum(
+        estimate_tokens(item.get("content")) for item in prompt_data
+        if isinstance(item.get("content"), str)
+    )
+    output_tokens = estimate_tokens(content)
+    return {
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "total_tokens": input_tokens + output_tokens
+    }
+
+def stream_stats(
+    start_time: float,
+    first_token_time: Optional[float],
+    end_time: float,
+    output_tokens: int,
+    fragments: int
+) -> Dict[str, Any]:
+    """
+    Метрики потока: время до первого токена и скорость генерации
+
+    Скорость считается от первого токена, чтобы не смешивать ее
+    с задержкой очереди и обработки промпта у провайдера. Если ответ
+    пришел одним фрагментом (провайдер без потоковой выдачи), скорость
+    считается от начала запроса.
+    """
+    if first_token_time is None:
+        generation_time = 0.0
+    elif fragments > 1:
+        generation_time = end_time - first_token_time
+    else:
+        generation_time = end_time - start_time
+    return {
+        "ttft_ms": round((first_token_time - start_time) * 1000, 1) if first_token_time is not None else None,
+        "tokens_per_sec": round(output_tokens / generation_time, 2) if generation_time > 0 else None,
+        "execution_time": end_time - start_time
+    }
+
+def record_stream_analytics(
+    session_factory: Callable[[], Session],
+    prompt_id: int,
+    user_id: int,
+    provider: str,
+    metrics_data: Dict[str, Any],
+    execution_time: float,
+    total_tokens: int
+) -> None:
+    """
+    Сохраняет аналитику потока в отдельной сессии
+
+    Сессия запроса к этому моменту уже закрыта: зависимости FastAPI
+    завершаются до отправки тела потокового ответа.
+    """
+    db = session_factory()
+    try:
+        db.add(PromptAnalytics(
+            prompt_id=prompt_id,
+            user_id=user_id,
+            provider=provider,
+            metrics=metrics_data,
+            usage_count=1,
+            average_response_time=execution_time,
+            average_token_count=total_tokens
+        ))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error saving streaming analytics for prompt {prompt_id}: {str(e)}")
+    finally:
+        db.close()
+
+async def cached_events(response: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+    """События astream_prompt для ответа из кэша: весь текст одним фрагментом"""
+    if response.get("content"):
+        yield {"delta": response["content"]}
+    if response.get("usage"):
+        yield {"usage": response["usage"]}
+
+async def stream_completion(
+    client,
+    prompt_data: List[Dict[str, Any]],
+    model: str,
+    parameters: Dict[str, Any],
+    prompt_id: int,
+    user_id: int,
+    provider: str,
+    extra_metrics: Optional[Dict[str, Any]] = None,
+    cache: Optional[CachedRequest] = None,
+    alternatives: Optional[List[Route]] = None,
+    session_factory: Callable[[], Session] = SessionLocal
+) -> AsyncIterator[str]:
+    """
+    Генерирует события SSE для ответа модели
+
+    События:
+        token - очередной фрагмент текста: {"content": ...}
+        done - поток завершен: usage и метрики потока
+        error - ошибка провайдера: {"detail": ...}
+
+    Аналитика записывается в finally, поэтому учитываются и потоки,
+    прерванные отключением клиента (usage тогда оценивается по тексту).
+
+    Args:
+        client: Клиент LLM (get_llm_client)
+        prompt_data: Сообщения в формате провайдера
+        model: Модель
+        parameters: Параметры модели
+        prompt_id: ID промпта для аналитики
+        user_id: ID пользователя для аналитики
+        provider: Провайдер LLM
+        extra_metrics: Дополнительные поля для PromptAnalytics.metrics
+        cache: Кэш ответов для этого запроса; None - без кэша
+        alternatives: Эквивалентные модели для хеджирования и резерва
+        session_factory: Фабрика сессий БД для записи аналитики
+    """
+    start_time = time.time()
+    first_token_time = None
+    parts: List[str] = []
+    usage: Dict[str, Any] = {}
+    status = "streaming"
+    error_message = None
+
+    cached, cache_info = await cache.lookup() if cache is not None else (None, {"cached": False})
+    if cached is not None:
+        events = cached_events(cached)
+    else:
+        events = routed_stream(Route(provider, model, client, prompt_data), parameters, alternatives, owner=user_id)
+    route_info = None
+
+    try:
+        async for event in events:
+            if event.get("delta"):
+                if first_token_time is None:
+                    first_token_time = time.time()
+                parts.append(event["delta"])
+                yield sse_event("token", {"content": event["delta"]})
+            elif event.get("route"):
+                route_info = event["route"]
+            elif event.get("usage"):
+                usage = event["usage"]
+        status = "completed"
+    except (asyncio.CancelledError, GeneratorExit):
+        status = "disconnected"
+        raise
+    except Exception as e:
+        status = "error"
+        error_message = str(e)
+        logger.error(f"Error streaming prompt {prompt_id} from {provider}: {error_message}", exc_info=True)
+    finally:
+        content = "".join(parts)
+        usage_estimated = not usage
+        if usage_estimated:
+            usage = estimate_usage(prompt_data, content)
+        input_tokens, output_tokens = usage_token_counts(usage)
+        stats = stream_stats(start_time, first_token_time, time.time(), output_tokens, len(parts))
+
+        # В кэш попадают только полные ответы с usage от провайдера
+        # Ответ резервной модели не кэшируется под ключом запрошенной
+        fallback = route_info is not None and route_info["fallback"]
+        if status == "completed" and cache is not None and cached is None and not usage_estimated and not fallback:
+            cache.store({"content": content, "usage": usage})
+
+        metrics.increment(f"llm.stream.{status}")
+        if stats["ttft_ms"] is not None:
+            metrics.observe("llm.stream.ttft_ms", stats["ttft_ms"])
+        if stats["tokens_per_sec"] is not None:
+            metrics.observe("llm.stream.tokens_per_sec", stats["tokens_per_sec"])
+
+        # Аналитика относится к модели, которая ответила (после резерва - к резервной)
+        served_provider, served_model = served_route(route_info, provider, model)
+        metrics_data = {
+            **(extra_metrics or {}),
+            "provider": served_provider,
+            "model": served_model,
+            "timestamp": time.time(),
+            "success": status == "completed",
+            "streamed": True,
+            **cache_info,
+            "stream_status": status,
+            "route": route_info,
+            "usage": usage,
+            "usage_estimated": usage_estimated,
+            **stats
+        }
+        if error_message:
+            metrics_data["error"] = error_message
+
+        # Синхронная запись: при отмене задачи await в finally уже не выполнится
+        record_stream_analytics(
+            session_factory,
+            prompt_id=prompt_id,
+            user_id=user_id,
+            provider=served_provider,
+            metrics_data=metrics_data,
+            execution_time=stats["execution_time"],
+            total_tokens=input_tokens + output_tokens
+        )
+
+    if status == "completed":
+        yield sse_event("done", {
+            "provider": provider,
+            "model": model,
+            "usage": usage,
+            "usage_estimated": usage_estimated,
+            **cache_info,
+            "route": route_info,
+            "ttft_ms": stats["ttft_ms"],
+            "tokens_per_sec": stats["tokens_per_sec"],
+            "execution_time": round(stats["execution_time"], 2)
+        })
+    else:
+        yield sse_event("error", {"detail": error_message})
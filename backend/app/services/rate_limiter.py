@@ -0,0 +1,417 @@
+"""
+Ограничение частоты запросов к провайдерам LLM.
+
+Для каждой пары (провайдер, API ключ) действуют:
+- token bucket по запросам в минуту и по токенам в минуту;
+- адаптивный лимит параллельных запросов (AIMD): +1/limit за каждый
+  успешный ответ, уменьшение вдвое при 429 с паузой по retry-after;
+- справедливая очередь: ожидающие запросы разных пользователей
+  обслуживаются по кругу, запросы одного пользователя - по порядку.
+
+Запрос, получивший 429, не завершается ошибкой, а снова встает в очередь
+(до RATE_LIMIT_MAX_RETRIES раз).
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Deque, Dict, Hashable, List, Optional, Tuple
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.integrations.llm_clients import api_key_fingerprint
+from app.services.circuit_breaker import get_circuit_breaker
+from app.services.context_packer import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# После уменьшения лимита следующие 429 из той же волны его не уменьшают
+DECREASE_COOLDOWN = 1.0  # seconds
+
+class RateLimitExceeded(Exception):
+    """Запрос не дождался своей очереди или исчерпал повторы после 429"""
+
+class TokenBucket:
+    """Корзина токенов, пополняемая равномерно: rate_per_minute в минуту, не больше capacity"""
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Через сколько секунд в корзине будет amount токенов (0 - уже есть)"""
+        self._refill(now)
+        # Запрос больше емкости корзины ждет полную корзину, а не вечно
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def consume(self, amount: float) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount: float) -> None:
+        """Возвращает (или дописывает в долг при amount < 0) разницу между оценкой и фактом"""
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+@dataclass
+class Waiter:
+    owner: Hashable
+    tokens: int
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+class ProviderRateLimiter:
+    """Лимиты, адаптивная параллельность и очередь для одного (провайдер, API ключ)"""
+
+    def __init__(
+        self,
+        name: str,
+        requests_per_minute: float,
+        tokens_per_minute: float,
+        initial_concurrency: int = 4,
+        max_concurrency: int = 32
+    ):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency_limit = float(min(initial_concurrency, self.max_concurrency))
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._queues: "OrderedDict[Hashable, Deque[Waiter]]" = OrderedDict()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.throttled = 0
+        self.granted = 0
+
+    # --- Очередь ---
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _next_waiter(self) -> Optional[Waiter]:
+        """Голова очереди следующего по кругу пользователя (отмененные ожидания пропускаются)"""
+        while self._queues:
+            owner, queue = next(iter(self._queues.items()))
+            while queue and queue[0].future.done():
+                queue.popleft()
+            if queue:
+                return queue[0]
+            del self._queues[owner]
+        return None
+
+    def _schedule(self) -> None:
+        """Выдает разрешения, пока позволяют лимиты; иначе ставит таймер на ближайшее пополнение"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        while self.in_flight < int(self.concurrency_limit):
+            waiter = self._next_waiter()
+            if waiter is None:
+                break
+
+            now = time.monotonic()
+            wait = max(
+                self.blocked_until - now,
+                self.requests.wait_time(1, now),
+                self.tokens.wait_time(waiter.tokens, now)
+            )
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._schedule)
+                break
+
+            self.requests.consume(1)
+            self.tokens.consume(waiter.tokens)
+            self.in_flight += 1
+            self.granted += 1
+
+            # Пользователь уходит в конец круга
+            queue = self._queues.pop(waiter.owner)
+            queue.popleft()
+            if queue:
+                self._queues[waiter.owner] = queue
+
+            waiter.future.set_result(None)
+            metrics.observe("rate_limiter.wait_ms", (now - waiter.enqueued_at) * 1000)
+
+        metrics.set_gauge(f"rate_limiter.{self.name}.queue_depth", self.queue_depth)
+        metrics.set_gauge(f"rate_limiter.{self.name}.in_flight", self.in_flight)
+
+    async def acquire(self, tokens: int, owner: Hashable = None, timeout: Optional[float] = None) -> None:
+        """Ждет разрешения на запрос с оценкой tokens токенов"""
+        waiter = Waiter(owner=owner, tokens=tokens, future=asyncio.get_running_loop().create_future())
+        self._queues.setdefault(owner, deque()).append(waiter)
+        self._schedule()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except asyncio.TimeoutError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Разрешение выдано в момент истечения таймаута
+                return
+            waiter.future.cancel()
+            self._schedule()
+            metrics.increment("rate_limiter.queue_timeouts")
+            raise RateLimitExceeded(f"Timed out waiting for {self.name} rate limit after {timeout:g}s")
+        except asyncio.CancelledError:
+            # Разрешение могло быть выдано одновременно с отменой: возвращаем его
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release()
+            else:
+                waiter.future.cancel()
+                self._schedule()
+            raise
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._schedule()
+
+    # --- AIMD ---
+
+    def on_success(self, estimated_tokens: int, actual_tokens: Optional[int]) -> None:
+        self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1.0 / self.concurrency_limit)
+        if actual_tokens:
+            self.tokens.refund(estimated_tokens - actual_tokens)
+
+    def on_throttled(self, retry_after: Optional[float]) -> None:
+        """429 от провайдера: уменьшаем параллельность и ставим паузу до retry-after"""
+        self.throttled += 1
+        metrics.increment("rate_limiter.throttled")
+        now = time.monotonic()
+        if now - self._last_decrease >= DECREASE_COOLDOWN:
+            self.concurrency_limit = max(1.0, self.concurrency_limit / 2)
+            self._last_decrease = now
+        self.blocked_until = max(self.blocked_until, now + (retry_after if retry_after is not None else 1.0))
+
+    @asynccontextmanager
+    async def permit(self, tokens: int, owner: Hashable = None) -> AsyncIterator["ProviderRateLimiter"]:
+        """Разрешение на один запрос; 429 внутри блока учитывается в AIMD и пробрасывается"""
+        await self.acquire(tokens, owner, timeout=settings.RATE_LIMIT_QUEUE_TIMEOUT)
+        try:
+            yield self
+        except Exception as e:
+            if is_rate_limit_error(e):
+                self.on_throttled(retry_after_seconds(e))
+            raise
+        finally:
+            self.release()
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "concurrency_limit": round(self.concurrency_limit, 2),
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "requests_available": round(min(self.requests.capacity, self.requests.tokens + (now - self.requests.updated_at) * self.requests.rate), 1),
+            "tokens_available": round(min(self.tokens.capacity, self.tokens.tokens + (now - self.tokens.updated_at) * self.tokens.rate)),
+            "blocked_for": round(max(0.0, self.blocked_until - now), 2),
+            "granted": self.granted,
+            "throttled": self.throttled
+        }
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Ответ 429 от SDK любого провайдера"""
+    for attribute in ("status_code", "http_status", "code", "status"):
+        if getattr(error, attribute, None) == 429:
+            return True
+    response = getattr(error, "response", None)
+    if getattr(response, "status_code", None) == 429:
+        return True
+    name = type(error).__name__
+    return name in ("RateLimitError", "ResourceExhausted", "TooManyRequests")
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Пауза из заголовков retry-after-ms / retry-after ответа с ошибкой"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or getattr(error, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def estimate_request_tokens(messages: List[Dict[str, Any]], parameters: Dict[str, Any]) -> int:
+    """Оценка токенов запроса для лимита TPM: промпт плюс максимальная длина ответа"""
+    prompt_tokens = sum(
+        estimate_tokens(message.get("content")) for message in messages
+        if isinstance(message.get("content"), str)
+    )
+    return prompt_tokens + int(parameters.get("max_tokens") or 1000)
+
+def usage_total_tokens(usage: Dict[str, Any]) -> Optional[int]:
+    if not usage:
+        return None
+    if usage.get("total_tokens"):
+        return usage["total_tokens"]
+    return (usage.get("prompt_tokens") or usage.get("input_tokens") or 0) + \
+        (usage.get("completion_tokens") or usage.get("output_tokens") or 0)
+
+_limiters: Dict[Tuple[str, str], ProviderRateLimiter] = {}
+
+def get_rate_limiter(provider: str, api_key: Optional[str]) -> ProviderRateLimiter:
+    """Лимитер для (провайдер, API ключ); лимиты провайдера берутся из RATE_LIMITS"""
+    provider = provider.lower()
+    key = (provider, api_key_fingerprint(api_key))
+    limiter = _limiters.get(key)
+    if limiter is None:
+        limits = settings.RATE_LIMITS.get(provider) or settings.RATE_LIMITS["default"]
+        limiter = _limiters.setdefault(key, ProviderRateLimiter(
+            name=provider,
+            requests_per_minute=limits["rpm"],
+            tokens_per_minute=limits["tpm"],
+            initial_concurrency=settings.RATE_LIMIT_INITIAL_CONCURRENCY,
+            max_concurrency=settings.RATE_LIMIT_MAX_CONCURRENCY
+        ))
+    return limiter
+
+def rate_limiter_stats() -> Dict[str, Any]:
+    return {f"{provider}:{fingerprint[:8]}": limiter.stats() for (provider, fingerprint), limiter in list(_limiters.items())}
+
+metrics.register_collector("rate_limiter", rate_limiter_stats)
+
+async def rate_limited_call(
+    client,
+    provider: str,
+    messages: List[Dict[str, Any]],
+    model: str,
+    parameters: Dict[str, Any],
+    owner: Hashable = None
+):
+    """
+    Вызывает client.aprocess_prompt через лимитер провайдера
+
+    Запрос ждет своей очереди, а после 429 встает в нее снова.
+    Если выключатель модели разомкнут, запрос сразу завершается CircuitOpenError.
+
+    Args:
+        client: Клиент LLM (get_llm_client)
+        provider: Провайдер LLM
+        messages: Сообщения в формате провайдера
+        model: Модель
+        parameters: Параметры модели
+        owner: Владелец запроса для справедливой очереди (обычно ID пользователя)
+
+    Returns:
+        Сырой ответ клиента (как aprocess_prompt)
+    """
+    breaker = get_circuit_breaker(provider, model)
+    probe = breaker.before_call()
+    try:
+        return await _rate_limited_call(client, provider, messages, model, parameters, owner, breaker)
+    finally:
+        breaker.release(probe)
+
+async def _provider_call(client, messages, model, parameters, breaker):
+    """Вызов провайдера с учетом исхода в выключателе (время в очереди лимитера не учитывается)"""
+    start_time = time.monotonic()
+    try:
+        response = await client.aprocess_prompt(messages, model, parameters)
+    except Exception as e:
+        breaker.on_failure(e)
+        raise
+    breaker.on_success(time.monotonic() - start_time)
+    return response
+
+async def _rate_limited_call(client, provider, messages, model, parameters, owner, breaker):
+    if not settings.RATE_LIMIT_ENABLED:
+        return await _provider_call(client, messages, model, parameters, breaker)
+
+    limiter = get_rate_limiter(provider, client.api_key)
+    estimated_tokens = estimate_request_tokens(messages, parameters)
+    for attempt in range(settings.RATE_LIMIT_MAX_RETRIES + 1):
+        try:
+            async with limiter.permit(estimated_tokens, owner):
+                response = await _provider_call(client, messages, model, parameters, breaker)
+        except Exception as e:
+            if is_rate_limit_error(e) and attempt < settings.RATE_LIMIT_MAX_RETRIES:
+                logger.info(f"{provider} rate limited, retrying ({attempt + 1}/{settings.RATE_LIMIT_MAX_RETRIES})")
+                continue
+            raise
+
+        try:
+            actual_tokens = usage_total_tokens(client.format_response(response).get("usage", {}))
+        except Exception:
+            actual_tokens = None
+        limiter.on_success(estimated_tokens, actual_tokens)
+        return response
+
+async def rate_limited_stream(
+    client,
+    provider: str,
+    messages: List[Dict[str, Any]],
+    model: str,
+    parameters: Dict[str, Any],
+    owner: Hashable = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    client.astream_prompt через лимитер провайдера
+
+    Разрешение держится до конца потока. Повтор после 429 возможен, только
+    пока клиенту не отправлено ни одного фрагмента. Выключатель модели
+    учитывает время до первого события и ошибки в любой момент потока.
+    """
+    breaker = get_circuit_breaker(provider, model)
+    probe = breaker.before_call()
+    try:
+        async for event in _rate_limited_stream(client, provider, messages, model, parameters, owner, breaker):
+            yield event
+    finally:
+        breaker.release(probe)
+
+async def _provider_stream(client, messages, model, parameters, breaker):
+    start_time = time.monotonic()
+    first_event_latency = None
+    try:
+        async for event in client.astream_prompt(messages, model, parameters):
+            if first_event_latency is None:
+                first_event_latency = time.monotonic() - start_time
+            yield event
+    except Exception as e:
+        breaker.on_failure(e)
+        raise
+    breaker.on_success(first_event_latency if first_event_latency is not None else time.monotonic() - start_time)
+
+async def _rate_limited_stream(client, provider, messages, model, parameters, owner, breaker):
+    if not settings.RATE_LIMIT_ENABLED:
+        async for event in _provider_stream(client, messages, model, parameters, breaker):
+            yield event
+        return
+
+    limiter = get_rate_limiter(provider, client.api_key)
+    estimated_tokens = estimate_request_tokens(messages, parameters)
+    for attempt in range(settings.RATE_LIMIT_MAX_RETRIES + 1):
+        started = False
+        actual_tokens = None
+        try:
+            async with limiter.permit(estimated_tokens, owner):
+                async for event in _provider_stream(client, messages, model, parameters, breaker):
+                    started = True
+                    if event.get("usage"):
+                        actual_tokens = usage_total_tokens(event["usage"])
+                    yield event
+        except Exception as e:
+            if is_rate_limit_error(e) and not started and attempt < settings.RATE_LIMIT_MAX_RETRIES:
+                continue
+            raise
+        limiter.on_success(estimated_tokens, actual_tokens)
+        return
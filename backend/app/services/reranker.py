@@ -0,0 +1,179 @@
+import asyncio
+import hashlib
+import logging
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.services.local_embedding_service import DEFAULT_CACHE_DIR
+from app.services.search_cache import SearchCache
+from app.utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+class CrossEncoderReranker:
+    """
+    Переранжирование кандидатов плотного поиска CPU-моделью cross-encoder.
+    Пары (запрос, чанк) прогоняются через модель пачками, оценки кэшируются
+    по (хэш запроса, ID чанка). Если бюджет времени исчерпан до того, как
+    оценены все кандидаты, возвращается исходный порядок плотного поиска.
+    """
+
+    def __init__(
+        self,
+        model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2",
+        cache_dir: Optional[str] = None,
+        batch_size: int = 16,
+        cache_size: int = 10000
+    ):
+        """
+        Args:
+            model_name: Название модели cross-encoder
+            cache_dir: Директория для кэширования модели
+            batch_size: Количество пар в одном вызове модели
+            cache_size: Максимальное количество закэшированных оценок
+        """
+        self.model_name = model_name
+        self.cache_dir = cache_dir
+        self.batch_size = batch_size
+        self.model = None
+        self.scores = LRUCache(max_size=cache_size)
+        self._load_lock = asyncio.Lock()
+
+    async def _load_model(self):
+        """Загружает модель один раз на процесс"""
+        if self.model is not None:
+            return
+
+        async with self._load_lock:
+            if self.model is not None:
+                return
+
+            logger.info(f"Загружаем модель переранжирования {self.model_name}...")
+            try:
+                # Импортируем здесь, чтобы не требовать зависимость, если переранжирование выключено
+                from sentence_transformers import CrossEncoder
+            except ImportError:
+                logger.error("Не удалось импортировать CrossEncoder. Установите библиотеку: pip install sentence-transformers")
+                raise ImportError("Требуется установить sentence-transformers")
+
+            loop = asyncio.get_event_loop()
+            self.model = await loop.run_in_executor(
+                None,
+                lambda: CrossEncoder(
+                    self.model_name,
+                    device="cpu",
+                    cache_folder=self.cache_dir
+                )
+            )
+            logger.info(f"Модель переранжирования {self.model_name} загружена")
+
+    @staticmethod
+    def query_hash(query: str) -> str:
+        """Хэш нормализованного запроса для ключа кэша оценок"""
+        return hashlib.sha256(SearchCache.normalize_query(query).encode("utf-8")).hexdigest()
+
+    async def _score_pairs(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        loop = asyncio.get_event_loop()
+        scores = await loop.run_in_executor(None, lambda: self.model.predict(pairs, convert_to_numpy=True))
+        return [float(score) for score in scores]
+
+    async def rerank(
+        self,
+        query: str,
+        results: List[Dict[str, Any]],
+        budget_ms: float
+    ) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        Переранжирует результаты поиска
+
+        Args:
+            query: Текстовый запрос
+            results: Результаты плотного поиска (с ключами chunk_id и content) в порядке убывания сходства
+            budget_ms: Бюджет времени на переранжирование в миллисекундах
+
+        Returns:
+            Кортеж (результаты в новом порядке или в исходном при откате, сведения о переранжировании)
+        """
+        start_time = time.monotonic()
+        deadline = start_time + budget_ms / 1000
+        query_hash = self.query_hash(query)
+
+        info = {
+            "applied": False,
+            "model": self.model_name,
+            "candidates": len(results),
+            "cache_hits": 0,
+            "budget_ms": budget_ms
+        }
+
+        scores: Dict[int, float] = {}
+        pending = []
+        for result in results:
+            cached_score = self.scores.get((query_hash, result["chunk_id"]))
+            if cached_score is not None:
+                scores[result["chunk_id"]] = cached_score
+            else:
+                pending.append(result)
+        info["cache_hits"] = len(scores)
+
+        try:
+            if pending:
+                # Загрузка модели продолжается и после таймаута, чтобы следующие запросы ее застали
+                await asyncio.wait_for(
+                    asyncio.shield(self._load_model()),
+                    timeout=max(0.0, deadline - time.monotonic())
+                )
+
+            for i in range(0, len(pending), self.batch_size):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+
+                batch = pending[i:i + self.batch_size]
+                # Вычисление в потоке не прерывается: оценки, досчитанные после таймаута,
+                # все равно не попадут в кэш, но и не задержат ответ
+                batch_scores = await asyncio.wait_for(
+                    self._score_pairs([(query, result["content"]) for result in batch]),
+                    timeout=remaining
+                )
+                for result, score in zip(batch, batch_scores):
+                    scores[result["chunk_id"]] = score
+                    self.scores.set((query_hash, result["chunk_id"]), score)
+        except asyncio.TimeoutError:
+            info["fallback"] = "budget_exceeded"
+        except Exception as e:
+            logger.error(f"Ошибка при переранжировании: {str(e)}")
+            info["fallback"] = "error"
+
+        info["rerank_ms"] = round((time.monotonic() - start_time) * 1000, 2)
+        metrics.observe("search.rerank.ms", info["rerank_ms"])
+
+        if "fallback" in info:
+            metrics.increment(f"search.rerank.fallback.{info['fallback']}")
+            return results, info
+
+        reranked = sorted(results, key=lambda result: scores[result["chunk_id"]], reverse=True)
+        for result in reranked:
+            result["rerank_score"] = scores[result["chunk_id"]]
+
+        info["applied"] = True
+        metrics.increment("search.rerank.applied")
+        return reranked, info
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "model": self.model_name,
+            "loaded": self.model is not None,
+            "scores": self.scores.stats()
+        }
+
+reranker = CrossEncoderReranker(
+    model_name=settings.RERANK_MODEL,
+    cache_dir=DEFAULT_CACHE_DIR,
+    batch_size=settings.RERANK_BATCH_SIZE,
+    cache_size=settings.RERANK_CACHE_SIZE
+)
+
+metrics.register_collector("reranker", reranker.stats)
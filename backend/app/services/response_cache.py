@@ -0,0 +1,355 @@
+"""
+Кэш ответов LLM для детерминированных вызовов.
+
+Ключ - канонический хэш (провайдер, модель, сообщения после
+format_prompt_for_provider, параметры). Первый уровень - LRU в памяти,
+второй - JSON-файлы на диске, которые переживают перезапуск процесса.
+Оба уровня ограничены TTL. CachedRequest объединяет этот кэш
+с семантическим (app.services.semantic_cache).
+
+Одинаковые запросы одного пользователя, пришедшие, пока первый еще
+выполняется (двойной клик, повтор фронтенда по таймауту), к провайдеру
+не отправляются: они ждут ответ первого (RequestCoalescer).
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.services.llm_router import Route, routed_completion
+from app.services.semantic_cache import embed_prompt, semantic_cache
+from app.utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+class ResponseCache:
+    """
+    Двухуровневый кэш отформатированных ответов (format_response)
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 24 * 60 * 60, disk_dir: Optional[str] = None):
+        """
+        Args:
+            max_size: Количество ответов в памяти
+            ttl: Время жизни ответа в секундах (для обоих уровней)
+            disk_dir: Каталог дискового уровня (None - только память)
+        """
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.memory = LRUCache(max_size=max_size, ttl=ttl)
+        self._lock = threading.Lock()
+        self.disk_hits = 0
+        self.disk_writes = 0
+        self.disk_errors = 0
+
+    @staticmethod
+    def make_key(provider: str, model: str, messages: List[Dict[str, Any]], parameters: Dict[str, Any]) -> str:
+        """Канонический хэш запроса: порядок ключей, пробелы JSON и запись чисел (0 и 0.0) не влияют на ключ"""
+        parameters = {
+            name: float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else value
+            for name, value in parameters.items()
+        }
+        payload = json.dumps(
+            {"provider": provider.lower(), "model": model, "messages": messages, "parameters": parameters},
+            sort_keys=True,
+            ensure_ascii=False,
+            separators=(",", ":"),
+            default=str
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def is_cacheable(parameters: Dict[str, Any]) -> bool:
+        """Кэшируются только детерминированные вызовы (temperature=0), если не задано иное"""
+        if not settings.RESPONSE_CACHE_DETERMINISTIC_ONLY:
+            return True
+        try:
+            return float(parameters.get("temperature", 1)) == 0
+        except (TypeError, ValueError):
+            return False
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Ищет ответ в памяти, затем на диске (найденный на диске поднимается в память)"""
+        response = self.memory.get(key)
+        if response is not None or not self.disk_dir:
+            return response
+
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self.disk_errors += 1
+            logger.warning(f"Unreadable response cache entry {path}: {str(e)}")
+            return None
+
+        age = time.time() - entry.get("stored_at", 0)
+        if age > self.ttl:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+        with self._lock:
+            self.disk_hits += 1
+        response = entry["response"]
+        self.memory.set(key, response, ttl=self.ttl - age)
+        return response
+
+    def set(self, key: str, response: Dict[str, Any]) -> None:
+        """Сохраняет ответ в память и на диск"""
+        self.memory.set(key, response)
+        if not self.disk_dir:
+            return
+
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"stored_at": time.time(), "response": response}, f, ensure_ascii=False)
+            # Атомарная замена: параллельный читатель не увидит недописанный файл
+            os.replace(tmp_path, path)
+            with self._lock:
+                self.disk_writes += 1
+        except (OSError, TypeError, ValueError) as e:
+            self.disk_errors += 1
+            logger.warning(f"Failed to write response cache entry {path}: {str(e)}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": settings.RESPONSE_CACHE_ENABLED,
+            "memory": self.memory.stats(),
+            "disk_dir": self.disk_dir,
+            "disk_hits": self.disk_hits,
+            "disk_writes": self.disk_writes,
+            "disk_errors": self.disk_errors
+        }
+
+response_cache = ResponseCache(
+    max_size=settings.RESPONSE_CACHE_SIZE,
+    ttl=settings.RESPONSE_CACHE_TTL,
+    disk_dir=settings.RESPONSE_CACHE_DIR or None
+)
+
+metrics.register_collector("response_cache", response_cache.stats)
+
+def response_cache_key(
+    provider: str,
+    model: str,
+    messages: List[Dict[str, Any]],
+    parameters: Dict[str, Any]
+) -> Optional[str]:
+    """Ключ кэша для запроса или None, если запрос не кэшируется"""
+    if not settings.RESPONSE_CACHE_ENABLED or not ResponseCache.is_cacheable(parameters):
+        return None
+    return ResponseCache.make_key(provider, model, messages, parameters)
+
+class _Flight:
+    """Выполняющийся запрос и число ожидающих его вызовов"""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+class RequestCoalescer:
+    """
+    Single-flight для одинаковых запросов к провайдеру
+
+    Первый вызов с ключом выполняет запрос в отдельной задаче, последующие
+    с тем же ключом ждут ее результат (или ошибку). Отмена одного из вызовов
+    (клиент закрыл соединение) остальным не мешает; запрос отменяется,
+    только когда его больше никто не ждет.
+    """
+
+    def __init__(self):
+        self._flights: Dict[Hashable, _Flight] = {}
+        self.executed = 0
+        self.duplicates_saved = 0
+        self.tokens_saved = 0
+
+    async def run(
+        self,
+        key: Hashable,
+        execute: Callable[[], Awaitable[Tuple[Dict[str, Any], Dict[str, Any]]]]
+    ) -> Tuple[Tuple[Dict[str, Any], Dict[str, Any]], bool]:
+        """
+        Args:
+            key: Ключ запроса (область видимости и канонический хэш)
+            execute: Выполняет запрос, возвращает (ответ, сведения о маршруте)
+
+        Returns:
+            Кортеж (результат execute, получен ли он от чужого вызова)
+        """
+        flight = self._flights.get(key)
+        shared = flight is not None
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(execute()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            self.executed += 1
+        else:
+            self.duplicates_saved += 1
+            metrics.increment("llm.coalesced")
+
+        flight.waiters += 1
+        try:
+            result = await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                flight.task.cancel()
+
+        if shared:
+            self.tokens_saved += result[0].get("usage", {}).get("total_tokens", 0) or 0
+        return result, shared
+
+    def _forget(self, key: Hashable, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": settings.REQUEST_COALESCING_ENABLED,
+            "in_flight": len(self._flights),
+            "executed": self.executed,
+            "duplicates_saved": self.duplicates_saved,
+            "tokens_saved": self.tokens_saved
+        }
+
+request_coalescer = RequestCoalescer()
+
+metrics.register_collector("request_coalescing", request_coalescer.stats)
+
+class CachedRequest:
+    """
+    Поиск и сохранение ответа для одного запроса к модели
+
+    Сначала проверяется точный кэш, затем семантический - только если
+    промпт включил его (semantic_user_id задан): близкие, но не совпадающие
+    промпты допустимы не для каждой задачи.
+    """
+
+    def __init__(
+        self,
+        provider: str,
+        model: str,
+        messages: List[Dict[str, Any]],
+        parameters: Dict[str, Any],
+        semantic_user_id: Optional[int] = None,
+        bypass_cache: bool = False
+    ):
+        """
+        Args:
+            provider: Провайдер LLM
+            model: Модель
+            messages: Сообщения в формате провайдера
+            parameters: Параметры модели
+            semantic_user_id: Владелец корзины семантического кэша; None - без семантического кэша
+            bypass_cache: Не искать ответ в кэше (свежий ответ все равно сохраняется)
+        """
+        self.provider = provider
+        self.model = model
+        self.messages = messages
+        self.parameters = parameters
+        self.bypass_cache = bypass_cache
+        self.key = response_cache_key(provider, model, messages, parameters)
+        self.semantic_bucket = None
+        if semantic_user_id is not None and settings.SEMANTIC_CACHE_ENABLED and ResponseCache.is_cacheable(parameters):
+            # Корзина - те же провайдер, модель и параметры без учета сообщений
+            self.semantic_bucket = (semantic_user_id, ResponseCache.make_key(provider, model, [], parameters))
+        self.embedding = None
+
+    async def lookup(self) -> Tuple[Optional[Dict[str, Any]], Dict[str, Any]]:
+        """
+        Returns:
+            Кортеж (ответ из кэша или None, сведения для метаданных и аналитики)
+        """
+        if self.key is not None and not self.bypass_cache:
+            response = response_cache.get(self.key)
+            if response is not None:
+                metrics.increment("llm.response_cache.hit")
+                return response, {"cached": True, "cache_type": "exact"}
+            metrics.increment("llm.response_cache.miss")
+
+        if self.semantic_bucket is not None:
+            # Эмбеддинг нужен и при bypass_cache, чтобы сохранить свежий ответ
+            self.embedding = await embed_prompt(self.messages)
+            if self.embedding is not None and not self.bypass_cache:
+                found = semantic_cache.lookup(self.semantic_bucket, self.embedding)
+                if found is not None:
+                    metrics.increment("llm.semantic_cache.hit")
+                    response, similarity = found
+                    return response, {"cached": True, "cache_type": "semantic", "similarity": round(similarity, 4)}
+                metrics.increment("llm.semantic_cache.miss")
+
+        return None, {"cached": False}
+
+    def store(self, response: Dict[str, Any]) -> None:
+        """Сохраняет ответ провайдера во все включенные уровни кэша"""
+        if self.key is not None:
+            response_cache.set(self.key, response)
+        if self.semantic_bucket is not None and self.embedding is not None:
+            semantic_cache.store(self.semantic_bucket, self.embedding, response)
+
+async def cached_completion(
+    client,
+    cache: CachedRequest,
+    owner: Optional[int] = None,
+    alternatives: Optional[List[Route]] = None
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Выполняет запрос к модели через кэш ответов, маршрутизатор и лимитер провайдера
+
+    Args:
+        client: Клиент LLM (get_llm_client)
+        cache: Запрос с параметрами кэширования
+        owner: Владелец запроса для очереди лимитера и объединения одинаковых запросов (ID пользователя)
+        alternatives: Эквивалентные модели для хеджирования и резерва (equivalent_routes)
+
+    Returns:
+        Кортеж (ответ в формате format_response, сведения о кэше и маршруте)
+    """
+    response, cache_info = await cache.lookup()
+    if response is not None:
+        return response, cache_info
+
+    async def execute() -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        response, route_info = await routed_completion(
+            Route(cache.provider, cache.model, client, cache.messages),
+            cache.parameters,
+            alternatives=alternatives,
+            owner=owner
+        )
+        # Ответ резервной модели не кэшируется под ключом запрошенной
+        if not route_info["fallback"]:
+            cache.store(response)
+        return response, route_info
+
+    if not settings.REQUEST_COALESCING_ENABLED:
+        response, route_info = await execute()
+        return response, {**cache_info, "route": route_info}
+
+    # Одинаковые запросы объединяются только в пределах одного владельца
+    key = (owner, ResponseCache.make_key(cache.provider, cache.model, cache.messages, cache.parameters))
+    (response, route_info), shared = await request_coalescer.run(key, execute)
+    if shared:
+        # Провайдеру этот вызов не оплачивается, как и ответ из кэша
+        return response, {"cached": True, "cache_type": "coalesced", "route": route_info}
+    return response, {**cache_info, "route": route_info}
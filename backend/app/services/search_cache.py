@@ -0,0 +1,165 @@
+import json
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session, object_session
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.db.models.document import Document, DocumentCollection
+from app.db.models.user import User
+from app.utils.cache import LRUCache
+
+class CorpusVersions:
+    """
+    Версии корпуса документов.
+    Версия увеличивается при добавлении, удалении или повторном разбиении документа,
+    записи эмбеддингов его чанков, а также при изменении состава коллекции. Версия
+    области поиска входит в ключ кэша результатов, поэтому закэшированные результаты
+    никогда не устаревают.
+    Счетчики хранятся в БД (corpus_version пользователя, документа и коллекции):
+    изменение, сделанное одним воркером, сразу меняет ключи кэшей во всех остальных.
+    Увеличение выполняется в транзакции вызывающего кода и фиксируется его commit.
+    """
+
+    @staticmethod
+    def _increment(db: Session, model, ids: Iterable[int]) -> None:
+        ids = sorted(set(ids))
+        if ids:
+            db.query(model).filter(model.id.in_(ids)).update(
+                {model.corpus_version: model.corpus_version + 1},
+                synchronize_session=False
+            )
+
+    def bump_document(
+        self,
+        db: Session,
+        user_id: int,
+        document_id: int,
+        collection_ids: Iterable[int] = ()
+    ) -> None:
+        """Отмечает изменение документа и всех коллекций, в которые он входит"""
+        self._increment(db, User, [user_id])
+        self._increment(db, Document, [document_id])
+        self._increment(db, DocumentCollection, collection_ids)
+
+    def bump_collection(self, db: Session, user_id: int, collection_id: int) -> None:
+        """Отмечает изменение состава коллекции"""
+        self._increment(db, User, [user_id])
+        self._increment(db, DocumentCollection, [collection_id])
+
+    def scope_version(
+        self,
+        db: Session,
+        user_id: int,
+        collection_ids: Optional[List[int]] = None,
+        document_ids: Optional[List[int]] = None
+    ) -> Tuple:
+        """
+        Возвращает версию области поиска
+
+        Если область ограничена документами и/или коллекциями, версия складывается
+        только из их счетчиков, и изменения вне области не сбрасывают кэш.
+        """
+        if not collection_ids and not document_ids:
+            version = db.query(User.corpus_version).filter(User.id == user_id).scalar()
+            return ("user", version or 0)
+
+        def versions(model, ids):
+            if not ids:
+                return ()
+            rows = db.query(model.id, model.corpus_version).filter(
+                model.id.in_(sorted(set(ids)))
+            ).order_by(model.id).all()
+            return tuple((row.id, row.corpus_version) for row in rows)
+
+        return (versions(DocumentCollection, collection_ids), versions(Document, document_ids))
+
+def invalidate_document(document, commit: bool = True) -> None:
+    """
+    Увеличивает версию корпуса для документа (ORM-объекта) и его коллекций
+
+    Args:
+        document: Документ, привязанный к сессии
+        commit: Зафиксировать сразу; False - версия войдет в транзакцию вызывающего
+            (например, вместе с удалением документа)
+    """
+    db = object_session(document)
+    corpus_versions.bump_document(
+        db,
+        document.user_id,
+        document.id,
+        [collection.id for collection in (document.collections or [])]
+    )
+    if commit:
+        db.commit()
+
+class SearchCache:
+    """
+    Кэши поиска по документам:
+    - LRU эмбеддингов запросов по (провайдер, модель, нормализованный запрос)
+    - кэш результатов по (пользователь, запрос, область, параметры, версия корпуса)
+    """
+
+    def __init__(
+        self,
+        embedding_cache_size: int = 2048,
+        result_cache_size: int = 1024,
+        result_ttl: Optional[float] = None
+    ):
+        self.query_embeddings = LRUCache(max_size=embedding_cache_size)
+        self.results = LRUCache(max_size=result_cache_size, ttl=result_ttl)
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        """
+        Канонический вид запроса для ключей кэшей: схлопывает пробелы
+
+        Регистр сохраняется: он меняет эмбеддинг. Сами эмбеддинги строятся
+        по исходному тексту запроса, нормализованный нужен только для ключа.
+        """
+        return " ".join(query.split())
+
+    @staticmethod
+    def filters_key(filters) -> Optional[str]:
+        """Канонический вид фильтров поиска (pydantic-модели) для ключа кэша"""
+        if filters is None:
+            return None
+        return json.dumps(filters.model_dump(exclude_none=True), sort_keys=True, default=str)
+
+    @staticmethod
+    def embedding_key(provider: str, model: str, normalized_query: str) -> Tuple:
+        return (provider, model, normalized_query)
+
+    @staticmethod
+    def result_key(
+        user_id: int,
+        normalized_query: str,
+        collection_ids: Optional[List[int]],
+        document_ids: Optional[List[int]],
+        params: Dict[str, Any],
+        corpus_version: Tuple
+    ) -> Tuple:
+        return (
+            user_id,
+            normalized_query,
+            tuple(sorted(set(collection_ids or []))),
+            tuple(sorted(set(document_ids or []))),
+            tuple(sorted((key, repr(value)) for key, value in params.items())),
+            corpus_version
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "query_embeddings": self.query_embeddings.stats(),
+            "results": self.results.stats()
+        }
+
+corpus_versions = CorpusVersions()
+
+search_cache = SearchCache(
+    embedding_cache_size=settings.SEARCH_EMBEDDING_CACHE_SIZE,
+    result_cache_size=settings.SEARCH_RESULT_CACHE_SIZE,
+    result_ttl=settings.SEARCH_RESULT_CACHE_TTL
+)
+
+metrics.register_collector("search_cache", search_cache.stats)
@@ -0,0 +1,234 @@
+"""
+Семантический кэш ответов LLM.
+
+Промпт нормализуется (регистр, пробелы), встраивается локальной моделью
+эмбеддингов и ищется среди прежних запросов той же корзины
+(пользователь, провайдер, модель, параметры). Ответ переиспользуется,
+если косинусная близость не ниже порога.
+
+Поиск приближенный: у каждого вектора есть 16-битная сигнатура SimHash
+(знаки проекций на случайные гиперплоскости). Кандидаты - векторы, чья
+сигнатура отличается от сигнатуры запроса не более чем на radius бит;
+точная близость считается только для них. Для порогов около 0.95
+ожидаемое расстояние между сигнатурами близких векторов - 1-2 бита.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.services.local_embedding_service import get_local_embedding_service
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_BITS = 16
+
+# Количество единичных бит для каждого 16-битного значения
+_POPCOUNT = np.array([bin(value).count("1") for value in range(1 << SIGNATURE_BITS)], dtype=np.uint8)
+
+# Начальная емкость корзины; дальше она удваивается до bucket_size
+INITIAL_BUCKET_CAPACITY = 16
+
+def normalize_prompt_text(messages: List[Dict[str, Any]]) -> str:
+    """Текст промпта для эмбеддинга: роли и содержимое без различий в регистре и пробелах"""
+    lines = []
+    for message in messages:
+        content = message.get("content", "")
+        if isinstance(content, list):
+            content = " ".join(
+                part.get("text", "") for part in content if isinstance(part, dict)
+            )
+        lines.append(f"{message.get('role', 'user')}: {' '.join(str(content).split()).lower()}")
+    return "\n".join(lines)
+
+class SemanticBucket:
+    """Векторы и ответы одной корзины; при заполнении перезаписываются самые старые"""
+
+    def __init__(self, dim: int, capacity: int):
+        self.capacity = capacity
+        self.vectors = np.zeros((min(INITIAL_BUCKET_CAPACITY, capacity), dim), dtype=np.float32)
+        self.signatures = np.zeros(len(self.vectors), dtype=np.uint16)
+        self.stored_at = np.zeros(len(self.vectors), dtype=np.float64)
+        self.responses: List[Dict[str, Any]] = []
+        self._next_slot = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self.vectors.nbytes + self.signatures.nbytes + self.stored_at.nbytes
+
+    def _grow(self) -> None:
+        size = min(len(self.vectors) * 2, self.capacity)
+        extra = size - len(self.vectors)
+        self.vectors = np.vstack([self.vectors, np.zeros((extra, self.vectors.shape[1]), dtype=np.float32)])
+        self.signatures = np.concatenate([self.signatures, np.zeros(extra, dtype=np.uint16)])
+        self.stored_at = np.concatenate([self.stored_at, np.zeros(extra, dtype=np.float64)])
+
+    def add(self, vector: np.ndarray, signature: int, response: Dict[str, Any], now: float) -> None:
+        if len(self.responses) < self.capacity:
+            slot = len(self.responses)
+            if slot == len(self.vectors):
+                self._grow()
+            self.responses.append(response)
+        else:
+            slot = self._next_slot
+            self._next_slot = (slot + 1) % self.capacity
+            self.responses[slot] = response
+        self.vectors[slot] = vector
+        self.signatures[slot] = signature
+        self.stored_at[slot] = now
+
+class SemanticCache:
+    """Корзины векторов промптов с LRU-вытеснением по лимиту памяти"""
+
+    def __init__(
+        self,
+        threshold: float = 0.97,
+        ttl: float = 24 * 60 * 60,
+        bucket_size: int = 1024,
+        memory_limit_bytes: int = 64 * 1024 * 1024,
+        radius: int = 3,
+        seed: int = 0
+    ):
+        """
+        Args:
+            threshold: Минимальная косинусная близость для попадания
+            ttl: Время жизни ответа в секундах
+            bucket_size: Максимум записей в одной корзине
+            memory_limit_bytes: Лимит суммарного размера корзин
+            radius: Максимальное число различающихся бит сигнатуры у кандидата
+            seed: Зерно случайных гиперплоскостей SimHash
+        """
+        self.threshold = threshold
+        self.ttl = ttl
+        self.bucket_size = max(1, bucket_size)
+        self.memory_limit_bytes = memory_limit_bytes
+        self.radius = radius
+        self.seed = seed
+        self._planes: Optional[np.ndarray] = None
+        self._buckets: "OrderedDict[Hashable, SemanticBucket]" = OrderedDict()
+        self._resident_bytes = 0
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.candidates = 0
+        self.evictions = 0
+
+    def _signature(self, vector: np.ndarray) -> Optional[int]:
+        if self._planes is None:
+            rng = np.random.default_rng(self.seed)
+            self._planes = rng.standard_normal((len(vector), SIGNATURE_BITS)).astype(np.float32)
+        elif self._planes.shape[0] != len(vector):
+            # Сменилась модель эмбеддингов: старые сигнатуры несравнимы с новыми
+            return None
+        bits = (vector @ self._planes) > 0
+        return int(np.dot(bits, 1 << np.arange(SIGNATURE_BITS)))
+
+    @staticmethod
+    def _unit(embedding) -> Optional[np.ndarray]:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        # Нулевой вектор - признак ошибки модели эмбеддингов
+        if vector.ndim != 1 or norm == 0:
+            return None
+        return vector / norm
+
+    def lookup(self, bucket_key: Hashable, embedding) -> Optional[Tuple[Dict[str, Any], float]]:
+        """Ищет самый близкий ответ корзины; возвращает (ответ, близость) или None"""
+        vector = self._unit(embedding)
+        if vector is None:
+            return None
+
+        with self._lock:
+            self.lookups += 1
+            bucket = self._buckets.get(bucket_key)
+            signature = self._signature(vector)
+            if bucket is None or signature is None or bucket.vectors.shape[1] != len(vector):
+                return None
+            self._buckets.move_to_end(bucket_key)
+
+            size = len(bucket.responses)
+            distances = _POPCOUNT[np.bitwise_xor(bucket.signatures[:size], np.uint16(signature))]
+            fresh = bucket.stored_at[:size] >= time.time() - self.ttl
+            candidates = np.nonzero((distances <= self.radius) & fresh)[0]
+            self.candidates += len(candidates)
+            if len(candidates) == 0:
+                return None
+
+            scores = bucket.vectors[candidates] @ vector
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+
+            self.hits += 1
+            return bucket.responses[candidates[best]], float(scores[best])
+
+    def store(self, bucket_key: Hashable, embedding, response: Dict[str, Any]) -> None:
+        """Добавляет ответ в корзину и вытесняет давно неиспользуемые корзины сверх лимита"""
+        vector = self._unit(embedding)
+        if vector is None:
+            return
+
+        with self._lock:
+            signature = self._signature(vector)
+            if signature is None:
+                return
+
+            bucket = self._buckets.get(bucket_key)
+            if bucket is None or bucket.vectors.shape[1] != len(vector):
+                if bucket is not None:
+                    self._resident_bytes -= bucket.nbytes
+                bucket = SemanticBucket(len(vector), self.bucket_size)
+                self._buckets[bucket_key] = bucket
+                self._resident_bytes += bucket.nbytes
+            self._buckets.move_to_end(bucket_key)
+
+            previous_bytes = bucket.nbytes
+            bucket.add(vector, signature, response, time.time())
+            self._resident_bytes += bucket.nbytes - previous_bytes
+
+            # Текущую корзину не вытесняем, даже если она одна превышает лимит
+            while self._resident_bytes > self.memory_limit_bytes and len(self._buckets) > 1:
+                _, evicted = self._buckets.popitem(last=False)
+                self._resident_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": settings.SEMANTIC_CACHE_ENABLED,
+                "threshold": self.threshold,
+                "buckets": len(self._buckets),
+                "entries": sum(len(bucket.responses) for bucket in self._buckets.values()),
+                "resident_bytes": self._resident_bytes,
+                "memory_limit_bytes": self.memory_limit_bytes,
+                "evictions": self.evictions,
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "avg_candidates": round(self.candidates / self.lookups, 2) if self.lookups else 0.0
+            }
+
+semantic_cache = SemanticCache(
+    threshold=settings.SEMANTIC_CACHE_THRESHOLD,
+    ttl=settings.SEMANTIC_CACHE_TTL,
+    bucket_size=settings.SEMANTIC_CACHE_BUCKET_SIZE,
+    memory_limit_bytes=settings.SEMANTIC_CACHE_MEMORY_LIMIT_MB * 1024 * 1024,
+    radius=settings.SEMANTIC_CACHE_LSH_RADIUS
+)
+
+metrics.register_collector("semantic_cache", semantic_cache.stats)
+
+async def embed_prompt(messages: List[Dict[str, Any]]) -> Optional[List[float]]:
+    """Эмбеддинг нормализованного промпта локальной моделью (None, если модель недоступна)"""
+    text = normalize_prompt_text(messages)
+    if not text.strip():
+        return None
+    try:
+        return await get_local_embedding_service().get_embeddings(text)
+    except Exception as e:
+        logger.warning(f"Semantic cache disabled for this request, embedding failed: {str(e)}")
+        return None
@@ -1,12 +1,13 @@
 import time
 import logging
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Hashable, Optional, List
 from sqlalchemy.orm import Session
 
 from app.db.models.analytics import PromptAnalytics
 from app.schemas.test import TestResult
 from app.integrations.llm_clients import get_llm_client
 from app.api.endpoints.testing import format_prompt_for_provider
+from app.services.rate_limiter import rate_limited_call
 
 logger = logging.getLogger(__name__)
 
@@ -27,7 +28,8 @@ class TestingService:
         top_p: float = 1.0,
         frequency_penalty: float = 0.0,
         presence_penalty: float = 0.0,
-        llm_client = None
+        llm_client = None,
+        owner: Hashable = None
     ) -> TestResult:
         """
         Тестирует промпт с заданными параметрами и возвращает результат
@@ -43,6 +45,7 @@ class TestingService:
             frequency_penalty: Штраф за повторение частотных токенов
             presence_penalty: Штраф за повторение любых токенов
             llm_client: Опционально, предварительно созданный клиент LLM
+            owner: Владелец запроса для очереди лимитера (обычно ID пользователя)
             
         Returns:
             TestResult: Результат выполнения теста
@@ -76,8 +79,10 @@ class TestingService:
             # Форматирование промпта с учетом провайдера
             formatted_content = format_prompt_for_provider(prompt.content, provider, variables)
             
-            # Выполнение запроса к модели
-            raw_response = llm_client.process_prompt(formatted_content, model, parameters)
+            # Выполнение запроса к модели через выключатель и лимитер провайдера
+            raw_response = await rate_limited_call(
+                llm_client, provider, formatted_content, model, parameters, owner=owner
+            )
             response = llm_client.format_response(raw_response)
             
             # Рассчет времени выполнения
@@ -0,0 +1,489 @@
+"""
+Шардированный векторный индекс на memory-mapped файлах.
+
+Для каждого пользователя эмбеддинги чанков выгружаются из БД в .npy файлы
+(нормированные векторы float32, ID чанков и документов). Файлы открываются
+через np.load(mmap_mode="r"), поэтому страницы индекса живут в page cache ОС
+и разделяются всеми воркерами uvicorn. В памяти процесса держатся только
+отображения недавно использованных шардов: при превышении лимита самые
+давно использованные вытесняются.
+
+Актуальность шарда проверяется по версии корпуса пользователя в БД
+(users.corpus_version), которая увеличивается при каждой записи эмбеддингов,
+разбиении и удалении документов. Шард, построенный одним воркером,
+переиспользуется остальными.
+
+Устаревший шард перестраивается в фоновом потоке со своей сессией БД. Пока
+новая версия строится, поиск идет потоковым сканированием БД: прежний шард
+содержит чанки удаленных документов и не видит новых эмбеддингов.
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.db.models.document import Document, DocumentChunk
+from app.db.session import SessionLocal
+from app.schemas.document import SearchFilters
+from app.services.search_cache import corpus_versions
+from app.services.vector_search import (
+    STREAM_BATCH_SIZE,
+    TopKHeap,
+    build_coverage,
+    decode_embedding,
+    embeddable_chunk,
+    has_chunk_filters,
+    scoped_chunk_query,
+    scoped_document_query,
+    stream_top_k_batch
+)
+
+logger = logging.getLogger(__name__)
+
+# Количество строк шарда, умножаемых на матрицу запросов за один раз
+SCORE_BLOCK_SIZE = 65536
+
+@dataclass
+class IndexShard:
+    """Загруженный (отображенный в память) шард пользователя"""
+    user_id: int
+    fingerprint: str
+    path: str
+    # Размерность -> (векторы, ID чанков, ID документов)
+    matrices: Dict[int, Tuple[np.ndarray, np.ndarray, np.ndarray]] = field(default_factory=dict)
+    # ID документа -> (всего чанков, чанков с эмбеддингами)
+    documents: Dict[int, Tuple[int, int]] = field(default_factory=dict)
+    nbytes: int = 0
+
+class ShardedVectorIndex:
+    """Пул memory-mapped шардов с LRU-вытеснением по лимиту памяти"""
+
+    def __init__(
+        self,
+        root_dir: str,
+        memory_limit_bytes: int,
+        build_workers: int = 1,
+        session_factory: Callable[[], Session] = SessionLocal
+    ):
+        """
+        Args:
+            root_dir: Каталог для файлов шардов
+            memory_limit_bytes: Лимит суммарного размера отображенных шардов
+            build_workers: Потоков для фонового построения шардов
+            session_factory: Фабрика сессий БД для фонового построения
+        """
+        self.root_dir = root_dir
+        self.memory_limit_bytes = memory_limit_bytes
+        self.session_factory = session_factory
+        self._lock = threading.Lock()
+        self._shards: "OrderedDict[int, IndexShard]" = OrderedDict()
+        self._building: Set[int] = set()
+        self._executor = ThreadPoolExecutor(max_workers=build_workers, thread_name_prefix="vector-index")
+        self._resident_bytes = 0
+        self._evictions = 0
+        self._builds = 0
+
+    # --- Файлы шардов ---
+
+    def _user_dir(self, user_id: int) -> str:
+        return os.path.join(self.root_dir, f"user_{user_id}")
+
+    @staticmethod
+    def corpus_fingerprint(db: Session, user_id: int) -> str:
+        """Отпечаток корпуса пользователя - его версия в БД"""
+        _, version = corpus_versions.scope_version(db, user_id)
+        return str(version)
+
+    def _read_current(self, user_id: int) -> Optional[str]:
+        try:
+            with open(os.path.join(self._user_dir(user_id), "current"), encoding="utf-8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def build_shard(self, db: Session, user_id: int, fingerprint: str) -> str:
+        """
+        Выгружает эмбеддинги пользователя в файлы шарда
+
+        Файлы пишутся в отдельный каталог версии, затем указатель current
+        атомарно переключается на него; старые версии удаляются (уже открытые
+        отображения остаются валидными до закрытия).
+
+        Returns:
+            Путь к каталогу построенной версии
+        """
+        start_time = time.time()
+        user_dir = self._user_dir(user_id)
+        version_dir = os.path.join(user_dir, f"v_{fingerprint}")
+        tmp_dir = f"{version_dir}.tmp-{os.getpid()}-{threading.get_ident()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        groups: Dict[int, Tuple[List[np.ndarray], List[int], List[int]]] = {}
+        totals: Counter = Counter()
+        embedded: Counter = Counter()
+
+        rows = db.query(
+            DocumentChunk.id, DocumentChunk.document_id, DocumentChunk.embedding
+        ).join(Document, DocumentChunk.document_id == Document.id).filter(
+            Document.user_id == user_id,
+            embeddable_chunk()
+        ).order_by(DocumentChunk.id).yield_per(STREAM_BATCH_SIZE)
+
+        for chunk_id, document_id, raw_embedding in rows:
+            totals[document_id] += 1
+            vector = decode_embedding(raw_embedding)
+            if vector is None:
+                continue
+            embedded[document_id] += 1
+            norm = np.linalg.norm(vector)
+            if norm == 0:
+                continue
+            vectors, chunk_ids, document_ids = groups.setdefault(vector.shape[0], ([], [], []))
+            vectors.append(vector / norm)
+            chunk_ids.append(chunk_id)
+            document_ids.append(document_id)
+
+        for dimension, (vectors, chunk_ids, document_ids) in groups.items():
+            np.save(os.path.join(tmp_dir, f"vectors_{dimension}.npy"), np.vstack(vectors).astype(np.float32))
+            np.save(os.path.join(tmp_dir, f"chunk_ids_{dimension}.npy"), np.asarray(chunk_ids, dtype=np.int64))
+            np.save(os.path.join(tmp_dir, f"document_ids_{dimension}.npy"), np.asarray(document_ids, dtype=np.int64))
+
+        with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "fingerprint": fingerprint,
+                "dimensions": sorted(groups),
+                "documents": {str(d): [totals[d], embedded[d]] for d in totals},
+                "built_at": time.time()
+            }, f)
+
+        if os.path.exists(version_dir):
+            # Ту же версию уже построил другой воркер
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        else:
+            os.replace(tmp_dir, version_dir)
+
+        pointer_tmp = os.path.join(user_dir, f"current.tmp-{os.getpid()}-{threading.get_ident()}")
+        with open(pointer_tmp, "w", encoding="utf-8") as f:
+            f.write(os.path.basename(version_dir))
+        os.replace(pointer_tmp, os.path.join(user_dir, "current"))
+
+        for name in os.listdir(user_dir):
+            if name.startswith("v_") and name != os.path.basename(version_dir) and ".tmp-" not in name:
+                shutil.rmtree(os.path.join(user_dir, name), ignore_errors=True)
+
+        build_ms = (time.time() - start_time) * 1000
+        metrics.observe("vector_index.build_ms", build_ms)
+        logger.info(f"Built vector index shard for user {user_id} ({sum(embedded.values())} vectors) in {build_ms:.0f} ms")
+        return version_dir
+
+    def _map_shard(self, user_id: int, fingerprint: str, path: str) -> IndexShard:
+        start_time = time.time()
+        with open(os.path.join(path, "manifest.json"), encoding="utf-8") as f:
+            manifest = json.load(f)
+
+        shard = IndexShard(user_id=user_id, fingerprint=fingerprint, path=path)
+        shard.documents = {int(d): tuple(counts) for d, counts in manifest["documents"].items()}
+        for dimension in manifest["dimensions"]:
+            arrays = tuple(
+                np.load(os.path.join(path, f"{name}_{dimension}.npy"), mmap_mode="r")
+                for name in ("vectors", "chunk_ids", "document_ids")
+            )
+            shard.matrices[dimension] = arrays
+            shard.nbytes += sum(array.nbytes for array in arrays)
+
+        metrics.observe("vector_index.load_ms", (time.time() - start_time) * 1000)
+        return shard
+
+    # --- Резидентность ---
+
+    def _admit(self, shard: IndexShard) -> None:
+        with self._lock:
+            previous = self._shards.pop(shard.user_id, None)
+            if previous is not None:
+                self._resident_bytes -= previous.nbytes
+            self._shards[shard.user_id] = shard
+            self._resident_bytes += shard.nbytes
+
+            # Вытесняем давно неиспользуемые шарды, но не только что загруженный
+            while self._resident_bytes > self.memory_limit_bytes and len(self._shards) > 1:
+                _, evicted = self._shards.popitem(last=False)
+                self._resident_bytes -= evicted.nbytes
+                self._evictions += 1
+                metrics.increment("vector_index.evictions")
+
+            metrics.set_gauge("vector_index.resident_shards", len(self._shards))
+            metrics.set_gauge("vector_index.resident_bytes", self._resident_bytes)
+
+    def get_shard(self, db: Session, user_id: int) -> Optional[IndexShard]:
+        """
+        Возвращает шард текущей версии корпуса, не блокируясь на его построении
+
+        Готовый шард (в памяти или на диске) используется сразу. Иначе
+        запускается фоновое построение и возвращается None: до его окончания
+        поиск сканирует БД.
+        """
+        fingerprint = self.corpus_fingerprint(db, user_id)
+
+        with self._lock:
+            shard = self._shards.get(user_id)
+            if shard is not None:
+                self._shards.move_to_end(user_id)
+        if shard is not None and shard.fingerprint == fingerprint:
+            metrics.increment("vector_index.hit")
+            return shard
+
+        # Текущую версию мог уже построить другой воркер: отображение файлов дешевое
+        path = os.path.join(self._user_dir(user_id), f"v_{fingerprint}")
+        if self._read_current(user_id) == f"v_{fingerprint}" and os.path.exists(path):
+            metrics.increment("vector_index.load")
+            shard = self._map_shard(user_id, fingerprint, path)
+            self._admit(shard)
+            return shard
+
+        metrics.increment("vector_index.miss")
+        self._schedule_build(user_id)
+        return None
+
+    def _schedule_build(self, user_id: int) -> None:
+        with self._lock:
+            if user_id in self._building:
+                return
+            self._building.add(user_id)
+        self._executor.submit(self._build_in_background, user_id)
+
+    def _build_in_background(self, user_id: int) -> None:
+        db = self.session_factory()
+        try:
+            fingerprint = self.corpus_fingerprint(db, user_id)
+            path = self.build_shard(db, user_id, fingerprint)
+            self._admit(self._map_shard(user_id, fingerprint, path))
+            self._builds += 1
+        except Exception as e:
+            logger.exception(f"Failed to build vector index shard for user {user_id}: {str(e)}")
+            metrics.increment("vector_index.build_errors")
+        finally:
+            db.close()
+            with self._lock:
+                self._building.discard(user_id)
+
+    # --- Поиск ---
+
+    def top_k_batch(
+        self,
+        db: Session,
+        user_id: int,
+        query_embeddings: List[List[float]],
+        k: int,
+        min_similarity: float = 0.0,
+        document_ids: Optional[List[int]] = None,
+        collection_ids: Optional[List[int]] = None,
+        filters: Optional[SearchFilters] = None,
+        only_completed: bool = False
+    ) -> Optional[Tuple[List[List[Tuple[float, int, int]]], Dict[str, Any]]]:
+        """
+        Ищет top-k чанков для нескольких запросов по шарду пользователя
+
+        Область поиска и фильтры превращаются в битовую маску по строкам шарда:
+        ID подходящих документов (или чанков при фильтрах уровня чанка) берутся
+        из БД легким запросом без чтения эмбеддингов.
+
+        Returns:
+            Тот же формат, что и у stream_top_k_batch; None, если шарда текущей
+            версии корпуса еще нет (он строится в фоне)
+        """
+        shard = self.get_shard(db, user_id)
+        if shard is None:
+            return None
+        query_matrix = np.asarray(query_embeddings, dtype=np.float32)
+        results: List[List[Tuple[float, int, int]]] = [[] for _ in query_embeddings]
+
+        allowed_documents, allowed_chunks, coverage = self._resolve_scope(
+            db, shard, user_id, document_ids, collection_ids, filters, only_completed
+        )
+
+        if query_matrix.ndim != 2 or query_matrix.shape[1] not in shard.matrices:
+            return results, coverage
+
+        vectors, chunk_ids, chunk_document_ids = shard.matrices[query_matrix.shape[1]]
+        query_norms = np.linalg.norm(query_matrix, axis=1)
+        active = np.flatnonzero(query_norms > 0)
+        if active.size == 0 or len(vectors) == 0:
+            return results, coverage
+        active_matrix = query_matrix[active] / query_norms[active, None]
+        heaps = [TopKHeap(k) for _ in active]
+
+        for start in range(0, len(vectors), SCORE_BLOCK_SIZE):
+            end = start + SCORE_BLOCK_SIZE
+            block_chunk_ids = np.asarray(chunk_ids[start:end])
+            block_document_ids = np.asarray(chunk_document_ids[start:end])
+
+            if allowed_chunks is not None:
+                mask = np.isin(block_chunk_ids, allowed_chunks)
+            elif allowed_documents is not None:
+                mask = np.isin(block_document_ids, allowed_documents)
+            else:
+                mask = None
+            if mask is not None and not mask.any():
+                continue
+
+            scores = np.asarray(vectors[start:end]) @ active_matrix.T
+            if mask is not None:
+                scores[~mask] = -np.inf
+
+            for column, heap in enumerate(heaps):
+                column_scores = scores[:, column]
+                top_n = min(k, len(column_scores))
+                if top_n == 0:
+                    continue
+                candidates = np.argpartition(-column_scores, top_n - 1)[:top_n]
+                for row in candidates:
+                    score = float(column_scores[row])
+                    if score >= min_similarity and score > heap.threshold():
+                        heap.push(score, int(block_chunk_ids[row]), int(block_document_ids[row]))
+
+        for query_index, heap in zip(active, heaps):
+            results[query_index] = heap.results()
+        return results, coverage
+
+    @staticmethod
+    def _resolve_scope(
+        db: Session,
+        shard: IndexShard,
+        user_id: int,
+        document_ids: Optional[List[int]],
+        collection_ids: Optional[List[int]],
+        filters: Optional[SearchFilters],
+        only_completed: bool
+    ) -> Tuple[Optional[np.ndarray], Optional[np.ndarray], Dict[str, Any]]:
+        """
+        Returns:
+            Кортеж (разрешенные ID документов или None, разрешенные ID чанков или None, сводка покрытия)
+        """
+        if has_chunk_filters(filters):
+            rows = scoped_chunk_query(
+                db,
+                (DocumentChunk.id, DocumentChunk.document_id, DocumentChunk.embedding.isnot(None)),
+                user_id=user_id,
+                document_ids=document_ids,
+                collection_ids=collection_ids,
+                only_completed=only_completed,
+                filters=filters
+            ).yield_per(STREAM_BATCH_SIZE)
+            totals: Counter = Counter()
+            embedded: Counter = Counter()
+            chunk_ids = []
+            for chunk_id, document_id, has_embedding in rows:
+                totals[document_id] += 1
+                if has_embedding:
+                    embedded[document_id] += 1
+                    chunk_ids.append(chunk_id)
+            return None, np.asarray(chunk_ids, dtype=np.int64), build_coverage(totals, embedded)
+
+        scoped = document_ids or collection_ids or only_completed or filters is not None
+        if scoped:
+            allowed = [row.id for row in scoped_document_query(
+                db,
+                (Document.id,),
+                user_id=user_id,
+                document_ids=document_ids,
+                collection_ids=collection_ids,
+                only_completed=only_completed,
+                filters=filters
+            ).all()]
+        else:
+            allowed = list(shard.documents)
+
+        totals = Counter({d: shard.documents[d][0] for d in allowed if d in shard.documents})
+        embedded = Counter({d: shard.documents[d][1] for d in allowed if d in shard.documents})
+        return (
+            np.asarray(allowed, dtype=np.int64) if scoped else None,
+            None,
+            build_coverage(totals, embedded)
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "resident_shards": len(self._shards),
+                "resident_bytes": self._resident_bytes,
+                "memory_limit_bytes": self.memory_limit_bytes,
+                "evictions": self._evictions,
+                "building": len(self._building),
+                "builds": self._builds
+            }
+
+vector_index = ShardedVectorIndex(
+    root_dir=settings.VECTOR_INDEX_DIR,
+    memory_limit_bytes=settings.VECTOR_INDEX_MEMORY_LIMIT_MB * 1024 * 1024,
+    build_workers=settings.VECTOR_INDEX_BUILD_WORKERS
+)
+
+metrics.register_collector("vector_index", vector_index.stats)
+
+def scoped_top_k_batch(
+    db: Session,
+    user_id: int,
+    query_embeddings: List[List[float]],
+    k: int,
+    min_similarity: float = 0.0,
+    document_ids: Optional[List[int]] = None,
+    collection_ids: Optional[List[int]] = None,
+    filters: Optional[SearchFilters] = None,
+    only_completed: bool = False
+) -> Tuple[List[List[Tuple[float, int, int]]], Dict[str, Any]]:
+    """
+    Top-k поиск чанков пользователя в области поиска
+
+    Использует шардированный индекс, если он включен, иначе потоково сканирует БД.
+    Пока шард текущей версии корпуса строится или при ошибке индекса поиск
+    также откатывается к сканированию БД.
+    """
+    if settings.VECTOR_INDEX_ENABLED:
+        try:
+            found = vector_index.top_k_batch(
+                db, user_id, query_embeddings, k, min_similarity,
+                document_ids=document_ids,
+                collection_ids=collection_ids,
+                filters=filters,
+                only_completed=only_completed
+            )
+            if found is not None:
+                return found
+            metrics.increment("vector_index.building_fallback")
+        except Exception as e:
+            logger.error(f"Vector index search failed for user {user_id}, falling back to DB scan: {str(e)}")
+            metrics.increment("vector_index.fallback")
+
+    rows = scoped_chunk_query(
+        db,
+        (DocumentChunk.id, DocumentChunk.document_id, DocumentChunk.embedding),
+        user_id=user_id,
+        document_ids=document_ids,
+        collection_ids=collection_ids,
+        only_completed=only_completed,
+        filters=filters
+    ).yield_per(STREAM_BATCH_SIZE)
+    return stream_top_k_batch(rows, query_embeddings, k, min_similarity)
+
+def scoped_top_k(
+    db: Session,
+    user_id: int,
+    query_embedding: List[float],
+    k: int,
+    min_similarity: float = 0.0,
+    **scope
+) -> Tuple[List[Tuple[float, int, int]], Dict[str, Any]]:
+    """Одиночный вариант scoped_top_k_batch"""
+    results, coverage = scoped_top_k_batch(db, user_id, [query_embedding], k, min_similarity, **scope)
+    return results[0], coverage
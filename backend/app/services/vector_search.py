@@ -0,0 +1,582 @@
+import heapq
+import json
+import logging
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import false, select
+from sqlalchemy.orm import Session
+
+from app.db.models.document import (
+    Document,
+    DocumentChunk,
+    DocumentSection,
+    ProcessingStatus,
+    document_collection_association
+)
+from app.schemas.document import SearchFilters
+
+logger = logging.getLogger(__name__)
+
+# Сколько строк забирать из БД за один раз при потоковом сканировании чанков
+STREAM_BATCH_SIZE = 500
+
+# Доля эмбеддинга заголовка в сводном эмбеддинге документа
+TITLE_EMBEDDING_WEIGHT = 0.2
+
+# Во сколько раз больше дочерних чанков отбирать, когда результаты схлопываются
+# в родительские секции (несколько чанков одной секции дают один результат)
+PARENT_EXPANSION_FACTOR = 3
+
+# embedding_model чанка без текста: эмбеддинг ему не нужен, поэтому он не ждет
+# дозаполнения и не учитывается в покрытии
+EMPTY_CHUNK_MODEL = "empty"
+
+def embeddable_chunk():
+    """SQL-условие: чанк не помечен как пустой"""
+    return DocumentChunk.embedding_model.is_distinct_from(EMPTY_CHUNK_MODEL)
+
+def decode_embedding(value: Any) -> Optional[np.ndarray]:
+    """
+    Преобразует сохраненный эмбеддинг (JSON-строка или список) в numpy-вектор
+
+    Returns:
+        Вектор float32 или None, если эмбеддинг отсутствует или поврежден
+    """
+    if value is None or value == "":
+        return None
+
+    try:
+        if isinstance(value, (str, bytes)):
+            value = json.loads(value)
+        vector = np.asarray(value, dtype=np.float32)
+    except (ValueError, TypeError):
+        return None
+
+    if vector.ndim != 1 or vector.size == 0:
+        return None
+    return vector
+
+def metadata_predicate(key: str, value: Any):
+    """
+    Строит SQL-условие на значение ключа chunk_metadata
+
+    Тип извлечения выбирается по типу значения, чтобы сравнение работало одинаково
+    в PostgreSQL и SQLite. Список значений означает "любое из".
+    """
+    values = value if isinstance(value, (list, tuple, set)) else [value]
+    if not values:
+        return false()
+
+    sample = next(iter(values))
+    element = DocumentChunk.chunk_metadata[key]
+    if isinstance(sample, bool):
+        element = element.as_boolean()
+    elif isinstance(sample, int):
+        element = element.as_integer()
+    elif isinstance(sample, float):
+        element = element.as_float()
+    else:
+        element = element.as_string()
+        values = [str(v) for v in values]
+
+    return element.in_(list(values)) if len(values) > 1 else element == list(values)[0]
+
+def apply_document_filters(query, filters: Optional[SearchFilters]):
+    """Применяет фильтры уровня документа (тип файла, дата загрузки)"""
+    if filters is None:
+        return query
+
+    if filters.file_types:
+        query = query.filter(Document.file_type.in_([t.lower().lstrip(".") for t in filters.file_types]))
+    if filters.created_after:
+        query = query.filter(Document.created_at >= filters.created_after)
+    if filters.created_before:
+        query = query.filter(Document.created_at <= filters.created_before)
+
+    return query
+
+def apply_chunk_filters(query, filters: Optional[SearchFilters]):
+    """Применяет фильтры уровня чанка (диапазон страниц, ключи chunk_metadata)"""
+    if filters is None:
+        return query
+
+    if filters.page_from is not None:
+        query = query.filter(DocumentChunk.page_number >= filters.page_from)
+    if filters.page_to is not None:
+        query = query.filter(DocumentChunk.page_number <= filters.page_to)
+    for key, value in (filters.metadata or {}).items():
+        query = query.filter(metadata_predicate(key, value))
+
+    return query
+
+def has_chunk_filters(filters: Optional[SearchFilters]) -> bool:
+    """Заданы ли фильтры уровня чанка"""
+    return filters is not None and (
+        filters.page_from is not None or filters.page_to is not None or bool(filters.metadata)
+    )
+
+def apply_scope(
+    query,
+    user_id: int,
+    document_ids: Optional[List[int]] = None,
+    collection_ids: Optional[List[int]] = None,
+    only_completed: bool = False,
+    filters: Optional[SearchFilters] = None
+):
+    """
+    Ограничивает запрос с уже присоединенной таблицей Document областью поиска
+
+    Фильтр по коллекциям выражается подзапросом, поэтому строки не дублируются
+    и не требуется GROUP BY. Фильтры уровня документа применяются здесь же,
+    до подсчета сходства.
+    """
+    query = query.filter(Document.user_id == user_id)
+    query = apply_document_filters(query, filters)
+
+    if only_completed:
+        query = query.filter(Document.processing_status == ProcessingStatus.COMPLETED)
+
+    if document_ids:
+        query = query.filter(Document.id.in_(document_ids))
+
+    if collection_ids:
+        query = query.filter(
+            Document.id.in_(
+                select(document_collection_association.c.document_id).where(
+                    document_collection_association.c.collection_id.in_(collection_ids)
+                )
+            )
+        )
+
+    return query
+
+def scoped_chunk_query(
+    db: Session,
+    columns: Sequence[Any],
+    user_id: int,
+    document_ids: Optional[List[int]] = None,
+    collection_ids: Optional[List[int]] = None,
+    only_completed: bool = False,
+    filters: Optional[SearchFilters] = None
+):
+    """
+    Строит единый запрос по чанкам пользователя в заданной области поиска
+
+    Все фильтры компилируются в SQL-условия, поэтому отсеянные чанки не читаются
+    из БД и не участвуют в подсчете сходства.
+
+    Args:
+        db: Сессия базы данных
+        columns: Выбираемые колонки (например, id, document_id, embedding)
+        user_id: ID пользователя
+        document_ids: IDs документов для поиска
+        collection_ids: IDs коллекций для поиска
+        only_completed: Искать только в полностью обработанных документах
+        filters: Структурные фильтры поиска
+    """
+    query = db.query(*columns).join(Document, DocumentChunk.document_id == Document.id).filter(embeddable_chunk())
+    query = apply_scope(query, user_id, document_ids, collection_ids, only_completed, filters)
+    return apply_chunk_filters(query, filters)
+
+def scoped_document_query(
+    db: Session,
+    columns: Sequence[Any],
+    user_id: int,
+    document_ids: Optional[List[int]] = None,
+    collection_ids: Optional[List[int]] = None,
+    only_completed: bool = False,
+    filters: Optional[SearchFilters] = None
+):
+    """
+    Строит запрос по документам пользователя в заданной области поиска
+
+    Применяются только фильтры уровня документа; фильтры чанков проверяются
+    при последующем поиске по чанкам.
+    """
+    query = db.query(*columns).select_from(Document)
+    return apply_scope(query, user_id, document_ids, collection_ids, only_completed, filters)
+
+class TopKHeap:
+    """Ограниченная куча, хранящая k лучших результатов (score, chunk_id, document_id)"""
+
+    def __init__(self, k: int):
+        self.k = max(0, k)
+        self._heap: List[Tuple[float, int, int]] = []
+
+    def push(self, score: float, chunk_id: int, document_id: int) -> None:
+        if self.k == 0:
+            return
+        item = (score, chunk_id, document_id)
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, item)
+        elif score > self._heap[0][0]:
+            heapq.heapreplace(self._heap, item)
+
+    def threshold(self) -> float:
+        """Минимальный скор, который еще может попасть в кучу"""
+        return self._heap[0][0] if len(self._heap) >= self.k else float("-inf")
+
+    def results(self) -> List[Tuple[float, int, int]]:
+        """Возвращает результаты по убыванию скора"""
+        return sorted(self._heap, reverse=True)
+
+def score_batch(
+    heaps: List[TopKHeap],
+    query_matrix: np.ndarray,
+    batch: List[Tuple[int, int, np.ndarray]],
+    min_similarity: float
+) -> None:
+    """
+    Векторно считает косинусное сходство пачки чанков со всеми запросами и обновляет кучи
+
+    Args:
+        heaps: Кучи результатов, по одной на строку query_matrix
+        query_matrix: Нормированные эмбеддинги запросов (запросы x размерность)
+        batch: Пачка (chunk_id, document_id, вектор)
+        min_similarity: Минимальное сходство
+    """
+    if not batch or not heaps:
+        return
+
+    matrix = np.vstack([vector for _, _, vector in batch])
+    norms = np.linalg.norm(matrix, axis=1)
+    norms[norms == 0] = 1.0
+    # (пачка x размерность) @ (размерность x запросы) -> (пачка x запросы)
+    scores = (matrix @ query_matrix.T) / norms[:, None]
+
+    for column, heap in enumerate(heaps):
+        column_scores = scores[:, column]
+        # В кучу могут попасть только k лучших чанков пачки
+        if heap.k < len(batch):
+            candidates = np.argpartition(-column_scores, heap.k - 1)[:heap.k] if heap.k else []
+        else:
+            candidates = range(len(batch))
+
+        for row_index in candidates:
+            score = float(column_scores[row_index])
+            if score >= min_similarity and score > heap.threshold():
+                chunk_id, document_id, _ = batch[row_index]
+                heap.push(score, chunk_id, document_id)
+
+def build_coverage(totals: Counter, embedded: Counter) -> Dict[str, Any]:
+    """
+    Формирует сводку покрытия эмбеддингами
+
+    Args:
+        totals: Количество чанков по документам
+        embedded: Количество чанков с эмбеддингами по документам
+
+    Returns:
+        Общий процент покрытия и проценты для документов, покрытых не полностью
+    """
+    total_chunks = sum(totals.values())
+    embedded_chunks = sum(embedded.values())
+
+    return {
+        "total_chunks": total_chunks,
+        "embedded_chunks": embedded_chunks,
+        "coverage_percent": round(embedded_chunks / total_chunks * 100, 2) if total_chunks else 100.0,
+        "partial_documents": {
+            document_id: round(embedded[document_id] / count * 100, 2)
+            for document_id, count in totals.items()
+            if embedded[document_id] < count
+        }
+    }
+
+def stream_top_k(
+    rows: Iterable[Tuple[int, int, Any]],
+    query_embedding: List[float],
+    k: int,
+    min_similarity: float = 0.0,
+    batch_size: int = STREAM_BATCH_SIZE
+) -> Tuple[List[Tuple[float, int, int]], Dict[str, Any]]:
+    """
+    Потоково считает top-k чанков по косинусному сходству
+
+    Память ограничена размером пачки и размером кучи и не зависит от размера корпуса.
+    Чанки без эмбеддингов пропускаются (их дозаполняет фоновый воркер) и учитываются
+    в сводке покрытия.
+
+    Args:
+        rows: Итератор строк (chunk_id, document_id, embedding)
+        query_embedding: Эмбеддинг запроса
+        k: Количество возвращаемых результатов
+        min_similarity: Минимальное сходство
+        batch_size: Размер пачки для векторного подсчета
+
+    Returns:
+        Кортеж (список (score, chunk_id, document_id) по убыванию, сводка покрытия эмбеддингами)
+    """
+    results, coverage = stream_top_k_batch(rows, [query_embedding], k, min_similarity, batch_size)
+    return results[0], coverage
+
+def stream_top_k_batch(
+    rows: Iterable[Tuple[int, int, Any]],
+    query_embeddings: List[List[float]],
+    k: int,
+    min_similarity: float = 0.0,
+    batch_size: int = STREAM_BATCH_SIZE
+) -> Tuple[List[List[Tuple[float, int, int]]], Dict[str, Any]]:
+    """
+    Потоково считает top-k чанков сразу для нескольких запросов
+
+    Корпус читается один раз: каждая пачка чанков умножается на матрицу запросов
+    одним матричным произведением, и для каждого запроса ведется своя куча.
+
+    Args:
+        rows: Итератор строк (chunk_id, document_id, embedding)
+        query_embeddings: Эмбеддинги запросов
+        k: Количество возвращаемых результатов на запрос
+        min_similarity: Минимальное сходство
+        batch_size: Размер пачки для векторного подсчета
+
+    Returns:
+        Кортеж (списки (score, chunk_id, document_id) по убыванию для каждого запроса,
+        сводка покрытия эмбеддингами)
+    """
+    heaps = [TopKHeap(k) for _ in query_embeddings]
+    totals: Counter = Counter()
+    embedded: Counter = Counter()
+
+    query_matrix = np.asarray(query_embeddings, dtype=np.float32)
+    if query_matrix.ndim != 2 or query_matrix.size == 0:
+        return [[] for _ in query_embeddings], build_coverage(totals, embedded)
+
+    # Запросы с нулевым вектором (ошибка эмбеддинга) ничего не находят
+    query_norms = np.linalg.norm(query_matrix, axis=1)
+    active = np.flatnonzero(query_norms > 0)
+    active_heaps = [heaps[i] for i in active]
+    active_matrix = query_matrix[active] / query_norms[active, None]
+    dimension = query_matrix.shape[1]
+
+    batch: List[Tuple[int, int, np.ndarray]] = []
+
+    for chunk_id, document_id, raw_embedding in rows:
+        totals[document_id] += 1
+        vector = decode_embedding(raw_embedding)
+        if vector is None:
+            continue
+        embedded[document_id] += 1
+        if vector.shape[0] != dimension:
+            # Эмбеддинг создан другой моделью - сравнивать нельзя
+            continue
+
+        batch.append((chunk_id, document_id, vector))
+        if len(batch) >= batch_size:
+            score_batch(active_heaps, active_matrix, batch, min_similarity)
+            batch = []
+
+    score_batch(active_heaps, active_matrix, batch, min_similarity)
+
+    return [heap.results() for heap in heaps], build_coverage(totals, embedded)
+
+def top_k_documents(
+    rows: Iterable[Tuple[int, Any]],
+    query_embedding: List[float],
+    k: int,
+    batch_size: int = STREAM_BATCH_SIZE
+) -> Tuple[List[Tuple[float, int]], List[int], int]:
+    """
+    Потоково отбирает k документов, ближайших к запросу по сводным эмбеддингам
+
+    Args:
+        rows: Итератор строк (document_id, summary_embedding)
+        query_embedding: Эмбеддинг запроса
+        k: Количество отбираемых документов
+        batch_size: Размер пачки для векторного подсчета
+
+    Returns:
+        Кортеж (список (score, document_id) по убыванию; IDs документов без пригодного
+        сводного эмбеддинга; всего документов)
+    """
+    query = np.asarray(query_embedding, dtype=np.float32)
+    query_norm = float(np.linalg.norm(query)) or 1.0
+    heap: List[Tuple[float, int]] = []
+    pending: List[int] = []
+    total = 0
+    batch_ids: List[int] = []
+    batch_vectors: List[np.ndarray] = []
+
+    def score_pending_batch() -> None:
+        if not batch_ids:
+            return
+        matrix = np.vstack(batch_vectors)
+        norms = np.linalg.norm(matrix, axis=1)
+        norms[norms == 0] = 1.0
+        scores = (matrix @ query) / (norms * query_norm)
+        for document_id, score in zip(batch_ids, scores.tolist()):
+            if len(heap) < k:
+                heapq.heappush(heap, (score, document_id))
+            elif score > heap[0][0]:
+                heapq.heapreplace(heap, (score, document_id))
+        batch_ids.clear()
+        batch_vectors.clear()
+
+    for document_id, raw_embedding in rows:
+        total += 1
+        vector = decode_embedding(raw_embedding)
+        if vector is None or vector.shape != query.shape:
+            # Сводный вектор еще не посчитан (или другой моделью) - сравнить нельзя
+            pending.append(document_id)
+            continue
+        batch_ids.append(document_id)
+        batch_vectors.append(vector)
+        if len(batch_ids) >= batch_size:
+            score_pending_batch()
+    score_pending_batch()
+
+    return sorted(heap, reverse=True), pending, total
+
+def mean_embedding(raw_embeddings: Iterable[Any]) -> Optional[np.ndarray]:
+    """
+    Потоково считает среднее нормированных векторов
+
+    Векторы другой размерности (созданные другой моделью) пропускаются.
+
+    Returns:
+        Нормированный средний вектор или None, если векторов нет
+    """
+    total: Optional[np.ndarray] = None
+    for raw_embedding in raw_embeddings:
+        vector = decode_embedding(raw_embedding)
+        if vector is None:
+            continue
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            continue
+        if total is None:
+            total = np.zeros_like(vector)
+        elif vector.shape != total.shape:
+            continue
+        total += vector / norm
+
+    if total is None:
+        return None
+    norm = np.linalg.norm(total)
+    return total / norm if norm else None
+
+def summary_embedding(
+    chunks_mean: np.ndarray,
+    title_embedding: Optional[List[float]] = None,
+    title_weight: float = TITLE_EMBEDDING_WEIGHT
+) -> List[float]:
+    """
+    Смешивает средний вектор чанков с эмбеддингом заголовка в сводный вектор документа
+
+    Args:
+        chunks_mean: Нормированный средний вектор чанков
+        title_embedding: Эмбеддинг заголовка (или имени файла)
+        title_weight: Доля заголовка в сводном векторе
+
+    Returns:
+        Нормированный сводный вектор
+    """
+    vector = chunks_mean
+    title_vector = decode_embedding(title_embedding)
+    if title_vector is not None and title_vector.shape == chunks_mean.shape:
+        title_norm = np.linalg.norm(title_vector)
+        if title_norm:
+            vector = (1 - title_weight) * chunks_mean + title_weight * title_vector / title_norm
+
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector = vector / norm
+    return [float(value) for value in vector]
+
+def fetch_chunk_details(db: Session, chunk_ids: List[int]) -> Dict[int, Any]:
+    """
+    Загружает содержимое и метаданные только для выбранных чанков одним запросом
+
+    Returns:
+        Словарь {chunk_id: строка с полями чанка и документа}
+    """
+    if not chunk_ids:
+        return {}
+
+    rows = db.query(
+        DocumentChunk.id,
+        DocumentChunk.document_id,
+        DocumentChunk.content,
+        DocumentChunk.chunk_order,
+        DocumentChunk.page_number,
+        DocumentChunk.chunk_metadata,
+        DocumentChunk.parent_id,
+        Document.filename,
+        Document.title,
+        Document.file_type
+    ).join(Document, DocumentChunk.document_id == Document.id).filter(
+        DocumentChunk.id.in_(chunk_ids)
+    ).all()
+
+    return {row.id: row for row in rows}
+
+def fetch_parent_sections(db: Session, section_ids: Iterable[int]) -> Dict[int, Any]:
+    """
+    Загружает родительские секции одним запросом
+
+    Returns:
+        Словарь {section_id: строка с полями секции}
+    """
+    section_ids = set(section_ids) - {None}
+    if not section_ids:
+        return {}
+
+    rows = db.query(
+        DocumentSection.id,
+        DocumentSection.content,
+        DocumentSection.section_order
+    ).filter(DocumentSection.id.in_(section_ids)).all()
+
+    return {row.id: row for row in rows}
+
+def collapse_to_parents(
+    db: Session,
+    results: List[Dict[str, Any]],
+    parent_ids: Dict[int, Optional[int]],
+    sections: Optional[Dict[int, Any]] = None
+) -> List[Dict[str, Any]]:
+    """
+    Заменяет найденные дочерние чанки их родительскими секциями (small-to-big)
+
+    Чанки одной секции схлопываются в один результат с оценкой лучшего из них,
+    порядок результатов сохраняется. Чанки без секции возвращаются как есть.
+
+    Args:
+        results: Результаты поиска (с ключами chunk_id и content) в порядке убывания оценки
+        parent_ids: Словарь {chunk_id: ID родительской секции или None}
+        sections: Заранее загруженные секции из fetch_parent_sections
+    """
+    if sections is None:
+        sections = fetch_parent_sections(db, (parent_ids.get(result["chunk_id"]) for result in results))
+    if not sections:
+        return results
+
+    collapsed = []
+    by_section: Dict[int, Dict[str, Any]] = {}
+    for result in results:
+        section = sections.get(parent_ids.get(result["chunk_id"]))
+        if section is None:
+            collapsed.append(result)
+            continue
+
+        if section.id in by_section:
+            by_section[section.id]["matched_chunk_ids"].append(result["chunk_id"])
+            continue
+
+        parent = {
+            **result,
+            "content": section.content,
+            "matched_content": result["content"],
+            "section_id": section.id,
+            "matched_chunk_ids": [result["chunk_id"]]
+        }
+        metadata = result.get("metadata")
+        if isinstance(metadata, dict) and "chunk_index" in metadata:
+            # Секция не склеивается с соседними чанками по порядку дочернего чанка
+            parent["metadata"] = {**metadata, "chunk_index": None, "section_index": section.section_order}
+        by_section[section.id] = parent
+        collapsed.append(parent)
+
+    return collapsed
@@ -1,11 +1,17 @@
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 import logging
 
+from app.api.deps import require_internal_access
 from app.api.routes import api_router
 from app.core.config import settings
+from app.core.metrics import metrics
 from app.db.init_db import init_db
 from app.db.session import SessionLocal
+from app.services.batch_execution import batch_poll_worker
+from app.services.circuit_breaker import provider_health
+from app.services.embedding_backfill import embedding_backfill_worker
+from app.services.model_catalog import model_catalog_refresher
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -28,6 +34,21 @@ async def init_data():
     finally:
         db.close()
 
+@app.on_event("startup")
+async def start_background_workers():
+    if settings.EMBEDDING_BACKFILL_ENABLED:
+        embedding_backfill_worker.start()
+    if settings.BATCH_EXECUTION_ENABLED:
+        batch_poll_worker.start()
+    if settings.MODEL_CATALOG_REFRESH_ENABLED:
+        model_catalog_refresher.start()
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    await embedding_backfill_worker.stop()
+    await batch_poll_worker.stop()
+    await model_catalog_refresher.stop()
+
 # Configure CORS
 origins = [
     "http://localhost",
@@ -64,6 +85,17 @@ def root():
 def health_check():
     return {"status": "ok", "message": "API is healthy and running"}
 
+@app.get("/health/providers", dependencies=[Depends(require_internal_access)])
+def provider_health_check():
+    """Circuit breaker state per provider and model"""
+    providers = provider_health()
+    degraded = [name for name, entry in providers.items() if entry["status"] != "ok"]
+    return {"status": "degraded" if degraded else "ok", "degraded": degraded, "providers": providers}
+
+@app.get("/metrics", dependencies=[Depends(require_internal_access)])
+def get_metrics():
+    return metrics.snapshot()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
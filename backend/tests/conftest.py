@@ -0,0 +1,28 @@
+import os
+
+# Настройки без значений по умолчанию; тестам реальная БД и ключи не нужны
+os.environ.setdefault("SECRET_KEY", "test-secret-key")
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+@pytest.fixture
+def session_factory(tmp_path):
+    """Фабрика сессий отдельной файловой SQLite БД со всеми таблицами"""
+    from app.db.base import Base
+    from app.db.models import document, test, user_settings  # noqa: F401
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+@pytest.fixture
+def db(session_factory):
+    session = session_factory()
+    try:
+        yield session
+    finally:
+        session.close()
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from app.core.config import settings
+from app.db.models.analytics import PromptAnalytics
+from app.db.models.prompt import Prompt
+from app.db.models import test as test_models
+from app.db.models.user import User
+from app.services.batch_execution import (
+    BATCH_ENDED,
+    BATCH_IN_PROGRESS,
+    BatchPollWorker,
+    BatchRequest,
+    FileBatchBackend,
+    batch_custom_id,
+    submit_batch_test
+)
+
+VARIABLES = [{"query": "first"}, {"query": "second"}, {"query": "third"}]
+
+@pytest.fixture
+def prompt(db):
+    user = User(email="batch@example.com", hashed_password="x")
+    db.add(user)
+    db.commit()
+    prompt = Prompt(name="Batch", content=[{"type": "text", "role": "user", "content": "{{query}}"}], user_id=user.id)
+    db.add(prompt)
+    db.commit()
+    return prompt
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    # Воркер создает бэкенд сам, по настройкам
+    directory = str(tmp_path / "batches")
+    monkeypatch.setattr(settings, "BATCH_FILE_BACKEND_DIR", directory)
+    return FileBatchBackend(directory)
+
+def submit(db, backend, prompt) -> test_models.Test:
+    requests = [
+        BatchRequest(
+            custom_id=batch_custom_id(index),
+            model="gpt-4o-mini",
+            messages=[{"role": "user", "content": variables["query"]}],
+            parameters={"max_tokens": 10}
+        )
+        for index, variables in enumerate(VARIABLES)
+    ]
+    return asyncio.run(submit_batch_test(
+        db, backend, prompt.user_id, prompt, "openai", "gpt-4o-mini", {"max_tokens": 10}, requests, VARIABLES
+    ))
+
+def write_results(backend, batch_id, results):
+    """Фейковый сервер: атомарно публикует results.jsonl"""
+    path = os.path.join(backend.directory, batch_id, "results.jsonl")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+    os.replace(path + ".tmp", path)
+
+def test_submit_poll_and_store_results(db, session_factory, backend, prompt):
+    test = submit(db, backend, prompt)
+    batch_id = test.test_config["batch_id"]
+    assert test.status == "running"
+
+    with open(os.path.join(backend.directory, batch_id, "requests.jsonl"), encoding="utf-8") as f:
+        submitted = [json.loads(line) for line in f]
+    assert [entry["custom_id"] for entry in submitted] == ["item-0", "item-1", "item-2"]
+
+    worker = BatchPollWorker(session_factory=session_factory)
+    assert asyncio.run(backend.poll(batch_id))["status"] == BATCH_IN_PROGRESS
+    assert asyncio.run(worker.run_once()) == 0
+
+    usage = {"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5}
+    write_results(backend, batch_id, [
+        {"custom_id": "item-0", "response": {"content": "one", "usage": usage}},
+        {"custom_id": "item-1", "error": "invalid_request"}
+    ])
+    assert asyncio.run(backend.poll(batch_id))["status"] == BATCH_ENDED
+    assert asyncio.run(worker.run_once()) == 1
+    # Повторный проход ничего не дописывает
+    assert asyncio.run(worker.run_once()) == 0
+
+    db.expire_all()
+    test = db.query(test_models.Test).filter(test_models.Test.id == test.id).one()
+    assert test.status == "completed"
+    assert test.test_config["succeeded"] == 1
+
+    results = {row.metrics["custom_id"]: row for row in db.query(test_models.TestResult).filter(test_models.TestResult.test_id == test.id)}
+    assert sorted(results) == ["item-0", "item-1", "item-2"]
+    assert results["item-0"].response == {"content": "one"}
+    assert results["item-0"].metrics["variables"] == {"query": "first"}
+    assert results["item-1"].response is None
+    assert results["item-1"].metrics["error"] == "invalid_request"
+    assert results["item-2"].metrics["error"] == "No result returned by the batch"
+
+    analytics = db.query(PromptAnalytics).filter(PromptAnalytics.prompt_id == prompt.id).all()
+    assert [row.average_token_count for row in analytics] == [5]
+
+def test_cancel_stops_test(db, session_factory, backend, prompt):
+    test = submit(db, backend, prompt)
+    batch_id = test.test_config["batch_id"]
+
+    asyncio.run(backend.cancel(batch_id))
+    test.test_config = {**test.test_config, "cancel_requested": True}
+    db.commit()
+
+    poll = asyncio.run(backend.poll(batch_id))
+    assert (poll["status"], poll["provider_status"]) == (BATCH_ENDED, "cancelled")
+
+    worker = BatchPollWorker(session_factory=session_factory)
+    assert asyncio.run(worker.run_once()) == 1
+
+    db.expire_all()
+    test = db.query(test_models.Test).filter(test_models.Test.id == test.id).one()
+    assert test.status == "stopped"
+    rows = db.query(test_models.TestResult).filter(test_models.TestResult.test_id == test.id).all()
+    assert len(rows) == len(VARIABLES)
+    assert all(row.response is None for row in rows)
+
+def test_cancel_unknown_batch(backend):
+    with pytest.raises(ValueError):
+        asyncio.run(backend.cancel("batch_missing"))
+
+def test_concurrent_pollers_store_results_once(db, session_factory, backend, prompt):
+    test = submit(db, backend, prompt)
+    write_results(backend, test.test_config["batch_id"], [
+        {"custom_id": batch_custom_id(index), "response": {"content": "ok", "usage": {"total_tokens": 1}}}
+        for index in range(len(VARIABLES))
+    ])
+
+    # Оба воркера прочитали тест в статусе running до того, как один из них его завершил
+    worker = BatchPollWorker(session_factory=session_factory)
+    first, second = session_factory(), session_factory()
+    try:
+        first_test = first.query(test_models.Test).filter(test_models.Test.id == test.id).one()
+        second_test = second.query(test_models.Test).filter(test_models.Test.id == test.id).one()
+        assert asyncio.run(worker.poll_test(first, first_test)) is True
+        assert asyncio.run(worker.poll_test(second, second_test)) is False
+    finally:
+        first.close()
+        second.close()
+
+    assert db.query(test_models.TestResult).filter(test_models.TestResult.test_id == test.id).count() == len(VARIABLES)
+    assert db.query(PromptAnalytics).filter(PromptAnalytics.prompt_id == prompt.id).count() == len(VARIABLES)
@@ -0,0 +1,29 @@
+from app.services.context_packer import estimate_tokens, pack_context
+
+def chunk(order: int, similarity: float, words: int = 80):
+    return {
+        "document_id": 1,
+        "chunk_id": order + 1,
+        "content": " ".join(f"w{order}_{index}" for index in range(words)),
+        "similarity": similarity,
+        "metadata": {"chunk_index": order}
+    }
+
+def test_adjacent_chunks_over_budget_fill_it_partially():
+    # Пять соседних чанков по ~105 токенов склеиваются в один фрагмент больше бюджета
+    results = [chunk(order, 0.9 - order * 0.1) for order in range(5)]
+    packed = pack_context(results, token_budget=300)
+
+    assert packed["context"]
+    assert packed["stats"]["context_tokens"] <= 300
+    assert packed["stats"]["selected_spans"] == 1
+    # Берутся самые релевантные чанки, и они остаются склеенными
+    assert packed["spans"][0]["chunk_orders"] == [0, 1]
+    assert packed["stats"]["dropped_chunks"] == 3
+
+def test_chunk_larger_than_budget_is_skipped():
+    results = [chunk(0, 0.9, words=400), chunk(5, 0.5)]
+    packed = pack_context(results, token_budget=200)
+
+    assert packed["spans"][0]["chunk_orders"] == [5]
+    assert estimate_tokens(packed["context"]) <= 200
@@ -0,0 +1,52 @@
+import asyncio
+
+from app.db.models.document import Document, DocumentChunk
+from app.db.models.user import User
+from app.services.embedding_backfill import EmbeddingBackfillWorker, get_document_coverage
+from app.services.vector_search import EMPTY_CHUNK_MODEL
+
+class FakeEmbeddingService:
+    model_name = "fake-model"
+
+    def __init__(self):
+        self.encoded = []
+
+    async def ensure_loaded(self):
+        pass
+
+    def encode(self, texts):
+        self.encoded.extend(texts)
+        return [[1.0, float(len(text))] for text in texts]
+
+def test_empty_chunks_do_not_block_summary(db, session_factory):
+    user = User(email="backfill@example.com", hashed_password="x")
+    db.add(user)
+    db.commit()
+    document = Document(user_id=user.id, title="Doc", file_path="doc.txt", file_type="txt")
+    db.add(document)
+    db.commit()
+    db.add_all([
+        DocumentChunk(document_id=document.id, content="some text", chunk_order=0),
+        DocumentChunk(document_id=document.id, content="   ", chunk_order=1),
+        DocumentChunk(document_id=document.id, content=None, chunk_order=2)
+    ])
+    db.commit()
+
+    service = FakeEmbeddingService()
+    worker = EmbeddingBackfillWorker(session_factory=session_factory, embedding_service=service, batch_size=10)
+
+    assert asyncio.run(worker.run_once()) == 3
+    assert service.encoded == ["some text", "Doc"]
+
+    db.expire_all()
+    chunks = db.query(DocumentChunk).order_by(DocumentChunk.chunk_order).all()
+    assert chunks[0].embedding is not None
+    assert [chunk.embedding_model for chunk in chunks[1:]] == [EMPTY_CHUNK_MODEL, EMPTY_CHUNK_MODEL]
+    assert db.query(Document).one().summary_embedding is not None
+
+    coverage = get_document_coverage(db, document.id)
+    assert (coverage["total_chunks"], coverage["embedded_chunks"]) == (1, 1)
+
+    # Работы не осталось: пустые чанки больше не выбираются
+    assert asyncio.run(worker.run_once()) == 0
+    assert asyncio.run(worker.run_once()) == 0
@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+import pytest
+
+from app.core.config import settings
+from app.integrations.llm_clients import get_llm_client
+from app.integrations.mock_llm import MockLLMClient
+from app.services import circuit_breaker, rate_limiter
+from app.services.rate_limiter import get_rate_limiter, rate_limited_call, rate_limited_stream
+
+MESSAGES = [{"role": "user", "content": "Summarize the quarterly report"}]
+
+@pytest.fixture(autouse=True)
+def fresh_limiters(monkeypatch):
+    # Лимитеры и выключатели глобальны: каждый тест начинает с пустого состояния
+    monkeypatch.setattr(rate_limiter, "_limiters", {})
+    monkeypatch.setattr(circuit_breaker, "_breakers", {})
+    monkeypatch.setattr(settings, "MOCK_LLM_ENABLED", True)
+    monkeypatch.setattr(settings, "MOCK_LLM_SEED", 7)
+
+def test_concurrent_load_through_rate_limiter():
+    client = get_llm_client("mock")
+    assert isinstance(client, MockLLMClient)
+    requests = 200
+    latency_ms = 20
+    parameters = {"max_tokens": 32, "mock": {"latency": {"distribution": "fixed", "ms": latency_ms}}}
+
+    async def run():
+        return await asyncio.gather(*(
+            rate_limited_call(client, "mock", MESSAGES, "mock-load", parameters, owner=index % 10)
+            for index in range(requests)
+        ))
+
+    start_time = time.monotonic()
+    responses = asyncio.run(run())
+    elapsed = time.monotonic() - start_time
+
+    assert len(responses) == requests
+    assert all(response["usage"]["output_tokens"] <= 32 for response in responses)
+    # Одинаковые запросы получают одинаковый детерминированный ответ
+    assert len({response["content"] for response in responses}) == 1
+    # Лимитер наращивает параллельность: запросы не выполняются по одному
+    assert elapsed < requests * latency_ms / 1000 / 2
+    limiter = get_rate_limiter("mock", client.api_key)
+    assert limiter.granted == requests
+    assert limiter.in_flight == 0
+
+def test_injected_rate_limits_are_retried(monkeypatch):
+    monkeypatch.setattr(settings, "RATE_LIMIT_MAX_RETRIES", 20)
+    client = MockLLMClient()
+    parameters = {"mock": {"latency": {"distribution": "fixed", "ms": 0}, "rate_limit_rate": 0.3, "retry_after_ms": 1}}
+
+    async def run():
+        return await asyncio.gather(*(
+            rate_limited_call(client, "mock", MESSAGES, "mock-throttled", parameters, owner=index)
+            for index in range(50)
+        ))
+
+    responses = asyncio.run(run())
+
+    assert len(responses) == 50
+    limiter = get_rate_limiter("mock", client.api_key)
+    assert limiter.throttled > 0
+    # 429 не считаются отказами провайдера
+    assert circuit_breaker.get_circuit_breaker("mock", "mock-throttled").state == circuit_breaker.CLOSED
+
+def test_stream_matches_completion():
+    client = MockLLMClient()
+
+    async def run():
+        completion = await rate_limited_call(client, "mock", MESSAGES, "mock-instant", {})
+        events = [event async for event in rate_limited_stream(client, "mock", MESSAGES, "mock-instant", {})]
+        return completion, events
+
+    completion, events = asyncio.run(run())
+
+    assert "".join(event["delta"] for event in events if "delta" in event) == completion["content"]
+    assert events[-1]["usage"] == completion["usage"]
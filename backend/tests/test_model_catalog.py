@@ -0,0 +1,71 @@
+import asyncio
+
+from app.integrations.llm_clients import LLMClientBase
+from app.services import model_catalog as model_catalog_module
+from app.services.model_catalog import ModelCatalog
+
+class AuthError(Exception):
+    status_code = 401
+
+class FakeClient(LLMClientBase):
+    def __init__(self, api_key, models=None, error=None):
+        self.models = models or ["model-a"]
+        self.error = error
+        self.calls = 0
+        super().__init__(api_key=api_key)
+
+    def _setup_client(self):
+        self.client = self
+
+    def get_available_models(self):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return self.models
+
+def test_entries_do_not_keep_clients(monkeypatch):
+    catalog = ModelCatalog()
+    client = FakeClient("user-key")
+    cached = {("openai", client.key_fingerprint): client}
+    monkeypatch.setattr(
+        model_catalog_module, "get_cached_llm_client",
+        lambda provider, fingerprint: cached.get((provider, fingerprint))
+    )
+
+    assert asyncio.run(catalog.get_models("openai", client)) == ["model-a"]
+    entry = catalog._entries.get(("openai", client.key_fingerprint))
+    assert "client" not in entry
+    assert "user-key" not in entry.values()
+
+    assert asyncio.run(catalog.refresh_all()) == 1
+    assert client.calls == 2
+
+    # Ключ заменен: клиента в кэше больше нет, старый ключ не используется
+    cached.clear()
+    assert asyncio.run(catalog.refresh_all()) == 0
+    assert client.calls == 2
+    assert catalog.stats()["entries"]["size"] == 0
+
+def test_idle_entries_expire(monkeypatch):
+    catalog = ModelCatalog(entry_ttl=60)
+    client = FakeClient("user-key")
+    monkeypatch.setattr(model_catalog_module, "get_cached_llm_client", lambda provider, fingerprint: client)
+
+    asyncio.run(catalog.get_models("openai", client))
+    catalog._entries.get(("openai", client.key_fingerprint))["requested_at"] -= 120
+
+    assert asyncio.run(catalog.refresh_all()) == 0
+    assert client.calls == 1
+    assert catalog.stats()["dropped"] == 1
+
+def test_rejected_key_is_dropped(monkeypatch):
+    catalog = ModelCatalog(max_auth_failures=2)
+    client = FakeClient("revoked-key", error=AuthError("invalid api key"))
+    monkeypatch.setattr(model_catalog_module, "get_cached_llm_client", lambda provider, fingerprint: client)
+
+    assert asyncio.run(catalog.get_models("groq", client)) == []
+    assert asyncio.run(catalog.refresh_all()) == 1
+    # Второй отказ подряд: запись удалена, дальше провайдер не вызывается
+    assert catalog.stats()["entries"]["size"] == 0
+    assert asyncio.run(catalog.refresh_all()) == 0
+    assert client.calls == 2
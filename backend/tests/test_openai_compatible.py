@@ -0,0 +1,101 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from app.integrations.openai_compatible import OpenAICompatibleClient, OpenAICompatibleError
+
+BASE_URL = "https://llm.test/v1"
+MESSAGES = [{"role": "user", "content": "Hello"}]
+
+def make_client(handler) -> OpenAICompatibleClient:
+    client = OpenAICompatibleClient("groq", BASE_URL, api_key="test-key")
+    client.close()
+    # Запросы уходят в обработчик вместо сети; заголовки клиента сохраняются
+    client.client = httpx.Client(base_url=BASE_URL, headers=client.client.headers, transport=httpx.MockTransport(handler))
+    client.async_client = httpx.AsyncClient(
+        base_url=BASE_URL, headers=client.async_client.headers, transport=httpx.MockTransport(handler)
+    )
+    return client
+
+def sse(*chunks) -> bytes:
+    lines = [f"data: {json.dumps(chunk)}\n\n" for chunk in chunks]
+    return "".join(lines + [": keep-alive\n\n", "data: [DONE]\n\n"]).encode("utf-8")
+
+def test_aprocess_prompt():
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200, json={
+            "choices": [{"message": {"role": "assistant", "content": "Hi there"}}],
+            "usage": {
+                "prompt_tokens": 12,
+                "completion_tokens": 3,
+                "total_tokens": 15,
+                "prompt_tokens_details": {"cached_tokens": 8}
+            }
+        })
+
+    client = make_client(handler)
+    response = asyncio.run(client.aprocess_prompt(MESSAGES, "llama-3.1-8b", {"temperature": 0.2}))
+    formatted = client.format_response(response)
+
+    assert requests[0].url == f"{BASE_URL}/chat/completions"
+    assert requests[0].headers["Authorization"] == "Bearer test-key"
+    assert json.loads(requests[0].content) == {"model": "llama-3.1-8b", "messages": MESSAGES, "temperature": 0.2}
+    assert formatted["content"] == "Hi there"
+    assert formatted["usage"]["total_tokens"] == 15
+    assert formatted["usage"]["cache_read_tokens"] == 8
+
+def test_astream_prompt_reads_usage_chunk_and_stops_at_done():
+    payloads = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        payloads.append(json.loads(request.content))
+        body = sse(
+            {"choices": [{"delta": {"role": "assistant"}}]},
+            {"choices": [{"delta": {"content": "Hel"}}]},
+            {"choices": [{"delta": {"content": "lo"}}]},
+            # С include_usage последний чанк без choices несет usage всего ответа
+            {"choices": [], "usage": {"prompt_tokens": 5, "completion_tokens": 2, "total_tokens": 7}}
+        ) + b'data: {"choices": [{"delta": {"content": "after done"}}]}\n\n'
+        return httpx.Response(200, content=body, headers={"Content-Type": "text/event-stream"})
+
+    client = make_client(handler)
+
+    async def collect():
+        return [event async for event in client.astream_prompt(MESSAGES, "llama-3.1-8b", {})]
+
+    events = asyncio.run(collect())
+
+    assert payloads[0]["stream"] is True
+    assert payloads[0]["stream_options"] == {"include_usage": True}
+    assert [event["delta"] for event in events if "delta" in event] == ["Hel", "lo"]
+    assert events[-1]["usage"]["total_tokens"] == 7
+    assert events[-1]["usage"]["prompt_tokens"] == 5
+
+def test_rate_limit_error_keeps_status_and_headers():
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(
+            429,
+            json={"error": {"message": "Rate limit reached"}},
+            headers={"retry-after": "7"}
+        )
+
+    client = make_client(handler)
+
+    with pytest.raises(OpenAICompatibleError) as error:
+        asyncio.run(client.aprocess_prompt(MESSAGES, "llama-3.1-8b", {}))
+    assert error.value.status_code == 429
+    assert error.value.headers["retry-after"] == "7"
+    assert "Rate limit reached" in str(error.value)
+
+    async def consume():
+        async for _ in client.astream_prompt(MESSAGES, "llama-3.1-8b", {}):
+            pass
+
+    with pytest.raises(OpenAICompatibleError) as error:
+        asyncio.run(consume())
+    assert error.value.status_code == 429
@@ -0,0 +1,49 @@
+import json
+import time
+
+from app.db.models.document import Document, DocumentChunk
+from app.db.models.user import User
+from app.services import vector_index as vector_index_module
+from app.services.search_cache import corpus_versions
+from app.services.vector_index import ShardedVectorIndex, scoped_top_k_batch
+
+def add_document(db, user_id, vectors):
+    document = Document(user_id=user_id, title="doc", file_path="doc.txt", file_type="txt")
+    db.add(document)
+    db.flush()
+    for order, vector in enumerate(vectors):
+        db.add(DocumentChunk(document_id=document.id, content="chunk", chunk_order=order, embedding=json.dumps(vector)))
+    corpus_versions.bump_document(db, user_id, document.id)
+    db.commit()
+    return document
+
+def wait_for_builds(index, builds):
+    deadline = time.time() + 5
+    while index.stats()["builds"] < builds or index.stats()["building"]:
+        assert time.time() < deadline, "shard build did not finish"
+        time.sleep(0.01)
+
+def test_stale_shard_falls_back_to_db_scan(db, session_factory, tmp_path, monkeypatch):
+    user = User(email="index@example.com", hashed_password="x")
+    db.add(user)
+    db.commit()
+    first = add_document(db, user.id, [[1.0, 0.0], [0.0, 1.0]])
+
+    index = ShardedVectorIndex(str(tmp_path / "index"), 1 << 30, session_factory=session_factory)
+    monkeypatch.setattr(vector_index_module, "vector_index", index)
+
+    # Шарда еще нет: поиск сканирует БД, построение идет в фоне
+    assert index.top_k_batch(db, user.id, [[1.0, 0.0]], 5) is None
+    wait_for_builds(index, 1)
+    results, _ = index.top_k_batch(db, user.id, [[1.0, 0.0]], 5)
+    assert {document_id for _, _, document_id in results[0]} == {first.id}
+
+    # Новый документ меняет версию корпуса: прежний шард не используется
+    second = add_document(db, user.id, [[1.0, 0.1]])
+    assert index.top_k_batch(db, user.id, [[1.0, 0.0]], 5) is None
+    results, _ = scoped_top_k_batch(db, user.id, [[1.0, 0.0]], 5)
+    assert second.id in {document_id for _, _, document_id in results[0]}
+
+    wait_for_builds(index, 2)
+    results, _ = index.top_k_batch(db, user.id, [[1.0, 0.0]], 5)
+    assert second.id in {document_id for _, _, document_id in results[0]}